@@ -2,6 +2,9 @@ import numpy as np
 from multiprocessing.managers import BaseManager
 import time
 
+from Spike_matrix import Spike_matrix # unpickles the spikes of the responses
+from Spike_stream import Spike_stream, SPIKE_STREAM_PORT
+
 class Communication:
     """
     Communication class for electrophysiology which can switch the mode of operation, send stimuli and receive electrophysiology data
@@ -74,7 +77,7 @@ class Communication:
         """
         Get the resposne when main is in stimulation mode
         Returns:
-            dict: Returns the response from the simulation
+            dict: Returns the response from the simulation, the spikes are a Spike_matrix indexed with [nw, el]
         """
         counter = 0
         try:
@@ -112,7 +115,7 @@ class Communication:
         """
         Get the resposne when main is in spontaneous mode
         Returns:
-            dict: Returns the spontaneous spikes from the simulation
+            dict: Returns the spontaneous spikes from the simulation as Spike_matrix
         """
         counter = 0
         try: 
@@ -128,12 +131,26 @@ class Communication:
             if self.new_connection() != -1:
                 return self.empty_spont_q()
             
+    def spike_stream(self, port=SPIKE_STREAM_PORT, timeout=None):
+        """
+        Subscribe to the stream of spontaneous spike chunks, several clients can subscribe at the same time
+        Args:
+            port: int, port of the spike stream
+            timeout: float, seconds to wait for a chunk before the iteration stops, None waits forever
+        Returns:
+            Spike_stream: iterator over dicts with chunk_id, dropped and the Spike_matrix as spontaneous_spikes
+        """
+        return Spike_stream(self.host, port, timeout)
+
     def send_stimulus(self, stim_sequence, index=None):
         """
-        Send the stimulus to the main script which then sends it via USB to the SoC
+        Send the stimulus to the main script which then sends it via USB to the SoC.
+        The stimulus for the next period (index of the last response + 1) is sent out at once. A stimulus for a later
+        period, up to STIM_QUEUE_LEN (8) periods ahead, is encoded when it arrives and sent out at the deadline of its
+        period unless it was replaced by an other stimulus for the same period, an empty stim_sequence cancels it.
         Args:
-            stim_sequence: list, list of stimuli
-            index: int, index of the stimulus
+            stim_sequence: list, list of stimuli, or the id of a program registered with register_stimulus
+            index: int, index of the period of the stimulus
         Returns:
             None
         """
@@ -146,6 +163,16 @@ class Communication:
             if self.new_connection() != -1:
                 return self.send_stimulus(stim_sequence, index)
 
+    def register_stimulus(self, program_id, stim_sequence):
+        """
+        Register a stimulus that is compiled once and then sent with send_stimulus(program_id, index).
+        The program belongs to the running stimulation mode, register again after changing or restarting the mode.
+        Args:
+            program_id: hashable id of the program, e.g. a str
+            stim_sequence: array, rows of (delay, network, electrode) as for send_stimulus
+        """
+        self.send_stimulus((program_id, np.asarray(stim_sequence)), 'register')
+
     def send_control(self, control_dict):
         """
         Send the control dictionary to the main script to change the settings like the mode of operation
@@ -158,3 +185,23 @@ class Communication:
             print("Failed to put stimulus on queue with error {e}")
             if self.new_connection() != -1:
                 return self.send_control(control_dict)
+
+    def set_timing(self, cycle=None, min_delay=None, response_period=None, start_delay=None, profile=None):
+        """
+        Change the timing of the stimulation periods, applied from the next period. The values are in ms,
+        response_period + min_delay must be shorter than the cycle.
+        Args:
+            cycle: float, time between two periods, STIMULUS_CYCLE
+            min_delay: float, time before a period the stimulus must be received, MIN_PKG_DELAY
+            response_period: float, length of the closed loop response segment, RESPONSE_IMPORTANT_PERIOD
+            start_delay: float, time until the first period after the start of the stimulation, START_ID_INIT
+            profile: bool, report the time used per period as 'cycle_profile' in the responses
+        """
+        timing = {
+            'cycle': cycle, 
+            'min_delay': min_delay, 
+            'response_period': response_period, 
+            'start_delay': start_delay, 
+            'profile': profile, 
+        }
+        self.send_control({'timing': {key: value for key, value in timing.items() if value is not None}})
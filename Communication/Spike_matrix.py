@@ -0,0 +1,130 @@
+"""
+Compact spike matrix of the closed loop responses and spontaneous spike chunks sent to the Jupyter client.
+The spike times of all networks and electrodes are stored in compressed sparse row form: one flat float32 array of
+times grouped by cell, the uint16 cell index (network*electrodes + electrode) of every spike and the offsets of the cells.
+Only the times and offsets are pickled, the object arrays of tuples used before cost one Python object per cell and spike.
+Indexing with [nw, el] returns the spike times of one electrode as array view, [nw] the list of all electrodes of a network.
+to_bytes/from_bytes give a binary form without pickle for the spike stream, see Spike_stream.
+"""
+import struct
+import numpy as np
+
+MATRIX_HEADER = struct.Struct('<HHI') # networks, electrodes, number of spikes, followed by the uint32 offsets and float32 times
+UNMAPPED_CELL = 0xFFFF # cell of receive channels that are not part of a network, their spikes are dropped
+
+class Spike_matrix:
+    """Spike times in ms per network and electrode, cell k = nw*electrodes + el holds times[offsets[k]:offsets[k+1]].
+    Args:
+        times: float32 spike times grouped by cell
+        offsets: start of every cell in times, length networks*electrodes+1
+        shape: (networks, electrodes)
+        index: uint16 cell of every spike, derived from the offsets if None
+    """
+    __slots__ = ('times', 'offsets', 'shape', 'index')
+
+    def __init__(self, times, offsets, shape, index=None):
+        self.times = np.asarray(times, dtype=np.float32)
+        self.offsets = np.asarray(offsets, dtype=np.uint32)
+        self.shape = (int(shape[0]), int(shape[1]))
+        if self.offsets.shape[0] != self.shape[0]*self.shape[1] + 1:
+            raise ValueError(f"Offsets of length {self.offsets.shape[0]} do not fit the shape {self.shape}")
+        if index is None:
+            index = np.repeat(np.arange(self.shape[0]*self.shape[1], dtype=np.uint16), np.diff(self.offsets))
+        self.index = np.asarray(index, dtype=np.uint16)
+
+    @classmethod
+    def empty(cls, shape):
+        """Matrix without spikes"""
+        return cls(np.zeros(0, dtype=np.float32), np.zeros(shape[0]*shape[1] + 1, dtype=np.uint32), shape)
+
+    @classmethod
+    def from_cells(cls, cells, times, shape):
+        """Group spike times by their cell nw*electrodes + el, the order of the spikes within a cell is kept"""
+        cells = np.asarray(cells, dtype=np.uint16)
+        order = np.argsort(cells, kind='stable')
+        offsets = np.zeros(shape[0]*shape[1] + 1, dtype=np.uint32)
+        np.cumsum(np.bincount(cells, minlength=shape[0]*shape[1]), out=offsets[1:])
+        return cls(np.asarray(times, dtype=np.float32)[order], offsets, shape, cells[order])
+
+    @classmethod
+    def from_spikes(cls, channels, pkgs, start_id, map_matrix, shape, pkg_in_ms):
+        """Build the matrix from the receive channels and package ids of detected spikes.
+        Spikes of channels without a cell, see channel_cells, are dropped.
+        Args:
+            channels: receive channel of every spike
+            pkgs: package id of every spike
+            start_id: package id of time 0
+            map_matrix: receive channel to (network, electrode), ELECTRODE_MAPPING.mapping_recv2network
+            shape: (networks, electrodes)
+            pkg_in_ms: duration of one package in ms
+        Returns:
+            Spike_matrix: spike times relative to start_id
+        """
+        channel_cells = cls.channel_cells(map_matrix, shape)
+        channels = np.asarray(channels, dtype=np.int64)
+        cells = np.full(channels.shape[0], UNMAPPED_CELL, dtype=np.uint16)
+        is_channel = channels < channel_cells.shape[0]
+        cells[is_channel] = channel_cells[channels[is_channel]]
+        is_mapped = cells != UNMAPPED_CELL
+        times = (np.asarray(pkgs, dtype=np.int64) - start_id).astype(np.float32)*np.float32(pkg_in_ms)
+        return cls.from_cells(cells[is_mapped], times[is_mapped], shape)
+
+    @staticmethod
+    def channel_cells(map_matrix, shape):
+        """Cell nw*electrodes + el of every receive channel for the mapping ELECTRODE_MAPPING.mapping_recv2network,
+        UNMAPPED_CELL for rows with a negative network or electrode"""
+        map_matrix = np.asarray(map_matrix)
+        cells = (map_matrix[:,0]*shape[1] + map_matrix[:,1]).astype(np.uint16)
+        cells[np.any(map_matrix < 0, axis=1)] = UNMAPPED_CELL
+        return cells
+
+    @classmethod
+    def from_bytes(cls, buffer, pos=0):
+        """Read a matrix written by to_bytes at byte position pos, times and offsets are views into the buffer"""
+        networks, electrodes, n_spikes = MATRIX_HEADER.unpack_from(buffer, pos)
+        pos += MATRIX_HEADER.size
+        offsets = np.frombuffer(buffer, dtype='<u4', count=networks*electrodes + 1, offset=pos)
+        times = np.frombuffer(buffer, dtype='<f4', count=n_spikes, offset=pos + offsets.nbytes)
+        return cls(times, offsets, (networks, electrodes))
+
+    def to_bytes(self):
+        """Binary form: MATRIX_HEADER, offsets as little endian uint32 and times as little endian float32"""
+        return b''.join((
+            MATRIX_HEADER.pack(self.shape[0], self.shape[1], self.times.shape[0]),
+            self.offsets.astype('<u4', copy=False).tobytes(),
+            self.times.astype('<f4', copy=False).tobytes(),
+        ))
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            nw, el = key
+            if not (-self.shape[0] <= nw < self.shape[0] and -self.shape[1] <= el < self.shape[1]):
+                raise IndexError(f"Index {key} is out of bounds for spike matrix of shape {self.shape}")
+            cell = (nw % self.shape[0])*self.shape[1] + el % self.shape[1]
+            return self.times[self.offsets[cell]:self.offsets[cell+1]]
+        return [self[key, el] for el in range(self.shape[1])]
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        for nw in range(self.shape[0]):
+            yield self[nw]
+
+    def __reduce__(self):
+        return (Spike_matrix, (self.times, self.offsets, self.shape))
+
+    def __repr__(self):
+        return f"Spike_matrix(shape={self.shape}, spikes={self.times.shape[0]})"
+
+    def counts(self):
+        """Number of spikes per network and electrode"""
+        return np.diff(self.offsets).reshape(self.shape)
+
+    def to_object_array(self):
+        """Object array of spike time arrays as in the former format, for code that expects a numpy array"""
+        spike_mat = np.empty(self.shape, dtype=object)
+        for nw in range(self.shape[0]):
+            for el in range(self.shape[1]):
+                spike_mat[nw, el] = self[nw, el]
+        return spike_mat
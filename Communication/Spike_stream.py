@@ -0,0 +1,195 @@
+"""
+TCP stream of the spontaneous spike chunks to any number of Jupyter clients.
+Every chunk is serialised once by the spike processor (encode_chunk) and the same bytes are written to all subscribers.
+Each subscriber has a bounded queue of frames sent by its own thread, a slow subscriber loses its oldest frames
+instead of blocking the readout. The number of frames a subscriber lost so far is sent in front of every frame.
+Wire format per frame: ENVELOPE (frame length, dropped frames), CHUNK_HEADER (magic, chunk id, start package id), Spike_matrix.to_bytes.
+"""
+import socket
+import struct
+import threading
+import collections
+
+from Spike_matrix import Spike_matrix
+
+SPIKE_STREAM_PORT = 0x1242
+SPIKE_STREAM_QUEUE_LEN = 64 # frames queued per subscriber before the oldest is dropped, also used by main.py via Client_config
+CHUNK_MAGIC = b'IKSP'
+CHUNK_HEADER = struct.Struct('<4sQI') # magic, chunk id, package id of time 0
+ENVELOPE = struct.Struct('<IQ') # length of the following frame in bytes, frames dropped for this subscriber so far
+
+def encode_chunk(chunk_id, start_id, spike_matrix):
+    """Serialise a chunk of spikes with times in ms after the package start_id"""
+    return CHUNK_HEADER.pack(CHUNK_MAGIC, chunk_id, start_id) + spike_matrix.to_bytes()
+
+def decode_chunk(frame):
+    """Inverse of encode_chunk, the spike times are a view into frame.
+    Returns:
+        dict: chunk_id, pkg_id (package id of time 0) and the Spike_matrix as spontaneous_spikes
+    """
+    magic, chunk_id, start_id = CHUNK_HEADER.unpack_from(frame, 0)
+    if magic != CHUNK_MAGIC:
+        raise ValueError(f"Invalid spike chunk, magic is {magic}")
+    return {
+        'chunk_id': chunk_id,
+        'pkg_id': start_id,
+        'spontaneous_spikes': Spike_matrix.from_bytes(frame, CHUNK_HEADER.size),
+    }
+
+class Spike_stream_subscriber:
+    """Connection of one client with its frame queue and counters.
+    Args:
+        connection: connected TCP socket
+        queue_len: frames queued before the oldest is dropped
+    """
+    def __init__(self, connection, queue_len):
+        self.connection = connection
+        self.queue = collections.deque()
+        self.queue_len = queue_len
+        self.condition = threading.Condition()
+        self.sent = 0
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, frame):
+        """Queue a frame without blocking, returns False if the oldest frame had to be dropped"""
+        with self.condition:
+            dropped = len(self.queue) >= self.queue_len
+            if dropped:
+                self.queue.popleft()
+                self.dropped += 1
+            self.queue.append(frame)
+            self.condition.notify()
+        return not dropped
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def run(self):
+        """Send the queued frames until the client disconnects or the subscriber is closed"""
+        try:
+            while True:
+                with self.condition:
+                    while not self.queue and not self.closed:
+                        self.condition.wait()
+                    if self.closed:
+                        break
+                    frame = self.queue.popleft()
+                    dropped = self.dropped
+                self.connection.sendall(ENVELOPE.pack(len(frame), dropped))
+                self.connection.sendall(frame)
+                self.sent += 1
+        except OSError:
+            pass
+        finally:
+            self.closed = True
+            self.connection.close()
+
+class Spike_stream_server:
+    """Accepts subscribers on a TCP port and distributes the published frames to all of them.
+    Args:
+        ip: IP to listen on
+        port: TCP port
+        queue_len: frames queued per subscriber before the oldest is dropped
+    """
+    def __init__(self, ip='127.0.0.1', port=SPIKE_STREAM_PORT, queue_len=SPIKE_STREAM_QUEUE_LEN):
+        self.address = (ip, port)
+        self.queue_len = queue_len
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.published = 0
+        self.server_socket = None
+
+    def start(self):
+        """Listen and accept subscribers in a daemon thread"""
+        self.server_socket = socket.create_server(self.address)
+        threading.Thread(target=self.accept_thread, daemon=True).start()
+        print(f"Starting spike stream at {self.address[0]}:{hex(self.address[1])[2:]}")
+
+    def accept_thread(self):
+        while True:
+            try:
+                connection, address = self.server_socket.accept()
+            except OSError:
+                break
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            subscriber = Spike_stream_subscriber(connection, self.queue_len)
+            with self.lock:
+                self.subscribers.append(subscriber)
+            threading.Thread(target=subscriber.run, daemon=True).start()
+            print(f"Spike stream subscriber connected from {address[0]}:{address[1]}")
+
+    def publish(self, frame):
+        """Queue an encoded chunk for all subscribers, returns the number of subscribers that dropped a frame"""
+        self.published += 1
+        with self.lock:
+            self.subscribers = [subscriber for subscriber in self.subscribers if not subscriber.closed]
+            subscribers = list(self.subscribers)
+        return sum(not subscriber.put(frame) for subscriber in subscribers)
+
+    def stats(self):
+        """Published frames and the sent and dropped frames of every connected subscriber"""
+        with self.lock:
+            return {
+                'published': self.published,
+                'subscribers': [
+                    {'sent': subscriber.sent, 'dropped': subscriber.dropped, 'queued': len(subscriber.queue)}
+                    for subscriber in self.subscribers],
+            }
+
+    def close(self):
+        if self.server_socket is not None:
+            self.server_socket.close()
+        with self.lock:
+            for subscriber in self.subscribers:
+                subscriber.close()
+            self.subscribers = []
+
+class Spike_stream:
+    """Client iterator over the spike chunks of a Spike_stream_server, see decode_chunk for the items.
+    Every item also holds 'dropped', the number of chunks this client lost because it read too slowly.
+    Args:
+        host: address of the lab host PC
+        port: TCP port of the spike stream
+        timeout: seconds to wait for a chunk before the iteration stops, None waits forever
+    """
+    def __init__(self, host='127.0.0.1', port=SPIKE_STREAM_PORT, timeout=None):
+        self.connection = socket.create_connection((host, port))
+        self.connection.settimeout(timeout)
+        self.dropped = 0
+        self.received = 0
+
+    def recv_exact(self, size):
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        pos = 0
+        while pos < size:
+            n = self.connection.recv_into(view[pos:])
+            if not n:
+                raise ConnectionError("Spike stream closed by the server")
+            pos += n
+        return buffer
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            size, self.dropped = ENVELOPE.unpack(self.recv_exact(ENVELOPE.size))
+            chunk = decode_chunk(self.recv_exact(size))
+        except (ConnectionError, socket.timeout):
+            raise StopIteration
+        self.received += 1
+        chunk['dropped'] = self.dropped
+        return chunk
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
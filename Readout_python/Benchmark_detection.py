@@ -0,0 +1,81 @@
+"""
+Offline benchmark of the readout filter and spike detection kernel in inkubeSpike.
+Synthetic UDP packages are processed sample by sample and block wise, the results are compared and the throughput is reported.
+Only the SNEO detection releases spikes, the default build (DEF USE_SNEO = 0 in inkubeSpike.pyx) follows an onset
+without ever firing. The spike channels and package ids are then empty and the benchmark fails, to compare them build with
+DEF USE_SNEO = 1 and run 'python setup_filter.py build_ext --inplace' again.
+"""
+import sys
+import time
+import argparse
+import numpy as np
+
+from Client_config import (
+    CHANNELS,
+    FS,
+    MAX_PKG_ID,
+)
+from inkubeSpike import run_detection
+
+PKG_LEN = 2048 # bytes per UDP package
+CHANNEL_OFFSET = 234 # position of the first channel in the package in 16 bit words
+
+def make_packages(n, start_id=0, noise=20., spike_rate=5., spike_amp=300., seed=0):
+    """Generate synthetic UDP packages with gaussian noise and negative spikes
+    Args:
+        n: number of packages
+        start_id: package id of the first package
+        noise: standard deviation of the noise in LSB
+        spike_rate: mean spike rate per channel in Hz
+        spike_amp: spike amplitude in LSB
+        seed: seed of the random generator
+    Returns:
+        uint8 array of shape (n, PKG_LEN)
+    """
+    rng = np.random.default_rng(seed)
+    data = rng.normal(0, noise, (n, CHANNELS))
+    spikes = rng.random((n, CHANNELS)) < spike_rate/FS
+    data[spikes] -= spike_amp
+
+    words = np.zeros((n, PKG_LEN//2), dtype=np.uint16)
+    words[:,CHANNEL_OFFSET:CHANNEL_OFFSET+2*CHANNELS:2] = (np.round(data).astype(np.int32) + 2**15).astype(np.uint16)
+    packages = words.view(np.uint8)
+    pkg_ids = ((np.arange(n, dtype=np.int64) + start_id) % MAX_PKG_ID).astype(np.uint32)
+    packages[:,2:6] = pkg_ids.view(np.uint8).reshape(n, 4)
+    return packages
+
+def benchmark(packages, thresh, block_len, num_threads, repeats=3):
+    """Run the detection several times and return the best run time in seconds and the last result"""
+    best = np.inf
+    for _ in range(repeats):
+        t_start = time.perf_counter()
+        result = run_detection(packages, thresh, block_len, num_threads)
+        best = min(best, time.perf_counter() - t_start)
+    return best, result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the spike detection kernel')
+    parser.add_argument('-n', type=int, default=10*FS, help='number of packages')
+    parser.add_argument('--block', type=int, default=64, help='packages per block')
+    parser.add_argument('--threads', type=int, default=1, help='number of OpenMP threads')
+    parser.add_argument('--thresh', type=float, default=100., help='spike detection threshold')
+    args = parser.parse_args()
+
+    packages = make_packages(args.n)
+
+    t_single, single = benchmark(packages, args.thresh, 1, args.threads)
+    t_block, block = benchmark(packages, args.thresh, args.block, args.threads)
+
+    for name, a, b in zip(['spike channels', 'spike package ids', 'signal'], single, block):
+        assert np.array_equal(a.view(np.uint8), b.view(np.uint8)), f'Block wise {name} differ from sample wise processing'
+
+    if not len(block[0]):
+        print(
+            f'ERROR: {args.n} packages, 0 spikes detected, only the detection signal was compared. '
+            f'The spike outputs are only tested with a build with DEF USE_SNEO = 1 in inkubeSpike.pyx', file=sys.stderr)
+    else:
+        print(f'{args.n} packages, {len(block[0])} spikes, results identical')
+    for name, t in [('sample wise', t_single), (f'block of {args.block}', t_block)]:
+        print(f'{name:>14}: {args.n/t:10.0f} samples/s, {args.n/t/args.threads:10.0f} samples/s per core, {args.n/t/FS:6.1f}x real time')
+    if not len(block[0]):
+        sys.exit(1)
@@ -1,7 +1,7 @@
 import numpy as np
 from ctypes import *
 import scipy.signal as sig
-from sys import platform
+from sys import platform, path
 import os
 from datetime import datetime
 
@@ -13,6 +13,9 @@ elif platform == "win32":
 else:
     print(f"Error: Operating System not supported")
 
+# Spike_matrix is shared with the Jupyter client in the Communication folder
+path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Communication'))
+
 from Electrode_mapping import Electrode_mapping
 
 if LINUX:
@@ -39,6 +42,7 @@ MIN_STIM_COMMAND_DELAY = int(60e-3*FS) # in samples, for open loop stimulation,
 
 """Software settings"""
 TEST_SERVER       = False # if True the localhost test server for debugging is used
+TEST_USB_LOOPBACK = False # with TEST_SERVER send the USB commands to Packet_generator.py instead of printing them
 DO_STIMULATE      = True # if True the stimulation is enabled
 CONTROL_NETWORKS  = True # if True the closed loop stimulation is enabled
 DO_OPEN_CONTROL_PORT = True # if True the control port is opened for the Jupyter client to send environment commands
@@ -76,7 +80,14 @@ FILT_ORDER = 3 # order of the FIR filter
 
 SPIKE_THRESH = 6 # factor with which the MAD of the signal is multiplied to get the threshold
 MAX_LIST_LEN = 128*240
+SPONT_FLUSH_PKGS = 50_000 # in samples, a spontaneous chunk is sent when it spans this many packages (~2.9 s), 0 to disable
+SPONT_FLUSH_SPIKES = MAX_LIST_LEN # a spontaneous chunk is sent when it holds this many spikes, at most MAX_LIST_LEN
+SPONT_FLUSH_TIME = 0. # in s, latency budget of a spontaneous chunk after its first spike, also without new spikes, 0 uses SPONT_FLUSH_PKGS/FS
+SPIKE_RING_LEN = 2**18 # records in the shared spike ring between readout and spike processor, must be a power of two
+SPIKE_RING_HEADER = 6 # counters of the spike ring: written, read, dropped records, the waiting flag, the detected package and the wake package of the spike processor
 MIN_SPIKE_THRESH = 100 # minimum value in threshed data, should be uV
+NOISE_TRACK_TIME = 1. # in s, time constant of the running noise estimate of the readout
+NOISE_UPDATE_TIME = 0.5 # in s, period of the noise histogram in the GUI, the readout sets the thresholds every 256 samples
 
 """Environment and level settings"""
 MAX_LEN_ENV_Q = 100
@@ -86,9 +97,11 @@ MAX_LEN_LVL_Q = 100
 
 DO_SAVE_ENV = False # save the environment data
 DO_SAVE_LVL = False # save the medium level data
+DO_RECORD = False # continuously record the raw data stream to disk
+RECORD_FILTERED = False # also record the filtered signal, triples the data rate
 
 """Data storage settings"""
-if DO_SAVE_ENV or DO_SAVE_LVL or DO_STORE_SPIKE_SHAPES:
+if DO_SAVE_ENV or DO_SAVE_LVL or DO_STORE_SPIKE_SHAPES or DO_RECORD:
     # Get the directory where the current script is located
     current_dir = os.path.dirname(os.path.abspath(__file__))
 
@@ -154,6 +167,11 @@ SHARED_NOISE_BINS = 16
 SHARED_NOISE_MAX = 50 # 100uV times LSB resolution
 DO_FLIP_INKULEVEL = 6_000
 
+''' Recording constants '''
+RECORD_RING_LEN = 2**16 # samples in the shared ring between readout and recorder (~3.8 s), must be a power of two
+RECORD_CHUNK_LEN = 1024 # samples per disk write, keeps the writes a multiple of 4096 bytes
+RECORD_FILE_LEN = (10*60*FS)//RECORD_CHUNK_LEN*RECORD_CHUNK_LEN # samples per file, ~10 min
+
 ''' Spike detection constants '''
 BLIND_DURATION = np.int8(2e-3*FS) # in samples, careful must be less than 128
 DETECT_DURATION = np.int8(1e-3*FS)
@@ -173,7 +191,10 @@ WORD_LENGTH_IN_BYTES = (64 + 1 + 1) * 4  # 64 commands, 1 timing word, 1 handsha
 ''' USB Send constants '''
 VENDOR_ID  = 0x33FF
 PRODUCT_ID = 0x1234
-USB_PREAMBLE = 0x01020304fdfeff00 # in hex, with last byte as command id, check USB_com class for more
+USB_PREAMBLE = 0x01020304fdfeff00 # in hex, with last byte as command id, check COMMAND_IDS
+COMMAND_IDS = {'port': 1, 'intan': 2, 'fpga': 3, 'recv_reset': 4} # last byte of USB_PREAMBLE for the command of a transfer
+USB_BATCH_WORDS = 1 # stimulation command words packed into one USB bulk transfer with one handshake, above 1 the SoC has to parse several words per transfer
+USB_WINDOW_WORDS = 16 # command words in flight before the receive counter acknowledged them, below 128 for the 8 bit counter, the SoC command FIFO must hold them
 
 ''' Cmmunication constants for UDP and network socket '''
 SEND_PORT = 0xb230 
@@ -188,6 +209,8 @@ else:
 
 CONTROL_CLIENT_PORT = 0x1240
 ENV_CONTROL_PORT = 0x1241
+# TCP stream of the spontaneous spike chunks, defined with the client in Communication/Spike_stream.py
+from Spike_stream import SPIKE_STREAM_PORT, SPIKE_STREAM_QUEUE_LEN
 
 ''' determine filter coefficients '''
 # use bandpass instead
@@ -203,7 +226,8 @@ if LINUX:
         DETECT_DURATION, 
         SPIKE_THRESH, 
         status_pos, 
-        MIN_SPIKE_THRESH
+        MIN_SPIKE_THRESH, 
+        NOISE_TRACK_TIME
     )
 
 # overwrite constants for testing
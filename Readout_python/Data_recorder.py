@@ -0,0 +1,180 @@
+"""
+Continuous recording of the data stream to disk.
+The readout copies every sample (package id, status words, raw and optionally filtered data) to a shared record ring.
+The recording process follows the ring and writes it in large aligned chunks to a sequence of files.
+Each file starts with a RECORD_HEADER_LEN byte JSON header followed by a flat array of records, see record_dtype.
+"""
+import os
+import json
+import time
+import numpy as np
+from datetime import datetime
+
+from Client_config import (
+    FS,
+    CHANNELS,
+    MAX_PKG_ID,
+    status_pos,
+)
+from inkubeSpike import (
+    record_dtype,
+    read_ring_counter,
+)
+
+RECORD_HEADER_LEN = 4096 # bytes, keeps the records page aligned
+RECORD_FORMAT = 'inkube recording'
+RECORD_VERSION = 1
+VOLT_LSB = 0.195 # in uV
+
+def make_header(dtype, filtered, file_id, first_pkg_id):
+    """Create the padded JSON header of a recording file
+    Args:
+        dtype: numpy dtype of one record
+        filtered: True if the filtered signal is recorded
+        file_id: number of the file in the recording
+        first_pkg_id: package id of the first record in the file
+    Returns:
+        header as bytes of length RECORD_HEADER_LEN
+    """
+    header = {
+        'format': RECORD_FORMAT,
+        'version': RECORD_VERSION,
+        'dtype': dtype.descr,
+        'header_len': RECORD_HEADER_LEN,
+        'fs': FS,
+        'channels': CHANNELS,
+        'volt_lsb': VOLT_LSB,
+        'status_pos': list(status_pos),
+        'max_pkg_id': MAX_PKG_ID,
+        'filtered': bool(filtered),
+        'file_id': file_id,
+        'first_pkg_id': int(first_pkg_id),
+        'start_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3],
+    }
+    header_bytes = json.dumps(header).encode('utf-8')
+    if len(header_bytes) >= RECORD_HEADER_LEN:
+        raise ValueError(f'Recording header exceeds {RECORD_HEADER_LEN} bytes')
+    return header_bytes + b' '*(RECORD_HEADER_LEN-len(header_bytes)-1) + b'\n'
+
+def read_header(file_path):
+    """Read the header of a recording file
+    Args:
+        file_path: path of the recording file
+    Returns:
+        header dictionary and numpy dtype of the records
+    """
+    with open(file_path, 'rb') as file:
+        header = json.loads(file.read(RECORD_HEADER_LEN).decode('utf-8'))
+    if header.get('format') != RECORD_FORMAT:
+        raise ValueError(f'{file_path} is not an inkube recording')
+    dtype = np.dtype([tuple(field[:2]) + ((tuple(field[2]),) if len(field) > 2 else ()) for field in header['dtype']])
+    return header, dtype
+
+def load_recording(file_path, mode='r'):
+    """Memory map a recording file
+    Args:
+        file_path: path of the recording file
+        mode: numpy memmap mode
+    Returns:
+        header dictionary and record array with the fields pkg_id, status, raw and (if recorded) filtered
+    """
+    header, dtype = read_header(file_path)
+    # the last file of a recording is closed on termination, only complete records are mapped
+    n_records = (os.path.getsize(file_path) - header['header_len']) // dtype.itemsize
+    records = np.memmap(file_path, dtype=dtype, mode=mode, offset=header['header_len'], shape=(n_records,))
+    return header, records
+
+def list_recording(folder):
+    """Return the recording files in a folder in recording order"""
+    return sorted(
+        os.path.join(folder, file_name) for file_name in os.listdir(folder)
+        if file_name.startswith('recording_') and file_name.endswith('.dat'))
+
+def record_process(
+        record_ring_data,
+        record_ring_seq,
+        filtered,
+        folder,
+        file_len,
+        chunk_len,
+        stop_event=None,
+    ):
+    """Follow the record ring of the readout and write it to disk
+    Args:
+        record_ring_data: shared uint8 array with the records, length is a power of two of records
+        record_ring_seq: shared uint64 array, position 0 is the number of records written by the readout
+        filtered: True if the readout copies the filtered signal to the ring
+        folder: folder for the recording files
+        file_len: records per file, a multiple of chunk_len
+        chunk_len: records per write, records are 4 byte multiples so 1024 records keep writes page aligned
+        stop_event: optional event to finish the current file and stop
+    """
+    print(f'PID:{os.getpid()} - Started recording process.')
+
+    dtype = record_dtype(filtered)
+    ring = np.frombuffer(record_ring_data, dtype=dtype)
+    ring_len = ring.shape[0]
+    if ring_len % chunk_len or file_len % chunk_len:
+        raise ValueError('Ring and file length must be multiples of the chunk length')
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    file = None
+    file_id = 0
+    file_records = 0
+    lost_records = 0
+
+    # start at the newest complete chunk
+    write = read_ring_counter(record_ring_seq)
+    read = write - write % chunk_len
+
+    while stop_event is None or not stop_event.is_set():
+        write = read_ring_counter(record_ring_seq)
+
+        if write - read > ring_len - chunk_len:
+            # recorder fell behind and the readout overwrote data, continue with the oldest intact chunk
+            skip = write - write % chunk_len - (ring_len - chunk_len) - read
+            lost_records += skip
+            read += skip
+            print(f'Warning: Recording lost {skip} samples, {lost_records} in total')
+
+        if write - read < chunk_len:
+            # wait for about a quarter chunk
+            time.sleep(chunk_len/FS/4)
+            continue
+
+        chunk = ring[read % ring_len:read % ring_len + chunk_len]
+
+        if file is None:
+            file = open(os.path.join(folder, f'recording_{file_id:05d}.dat'), 'wb', buffering=0)
+            file.write(make_header(dtype, filtered, file_id, chunk['pkg_id'][0]))
+            file_records = 0
+
+        file.write(chunk.data)
+
+        # the readout came close to the chunk while it was written, it may be partly overwritten
+        if read_ring_counter(record_ring_seq) - read > ring_len - chunk_len:
+            lost_records += chunk_len
+            print(f'Warning: Recording chunk may be overwritten during write, {lost_records} samples lost in total')
+
+        if hasattr(os, 'posix_fadvise'):
+            # written data is not read again, do not let it fill the page cache over long sessions
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+        read += chunk_len
+        file_records += chunk_len
+        if file_records >= file_len:
+            file.close()
+            file = None
+            file_id += 1
+
+    if file is not None:
+        file.close()
+    print(f'Recording stopped after {file_id+1} files, {lost_records} samples lost')
+
+if __name__ == '__main__':
+    import sys
+    for file_path in sys.argv[1:]:
+        header, records = load_recording(file_path)
+        print(f"{file_path}: {records.shape[0]} samples ({records.shape[0]/header['fs']:.1f} s), "
+              f"pkg {records['pkg_id'][0]} to {records['pkg_id'][-1]}, started {header['start_time']}")
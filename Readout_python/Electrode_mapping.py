@@ -149,6 +149,18 @@ class Electrode_mapping:
         self.mapping_recv2mea = np.argsort(self.mapping_mea2recv)
         self.mapping_recv2network = self.mapping_mea2network[self.mapping_recv2mea]
 
+        # first command of the chip in the stimulation word and bit of the electrode on the chip
+        self.mapping_mea2stim_chip, self.mapping_mea2stim_bit = self.get_stim_chip_from_source(
+            self.mapping_mea2fpga//60,(self.mapping_mea2fpga%60)//15,self.mapping_mea2fpga%15)
+
+        # dense tables for batch lookups of (network, electrode) rows, padded with -1 to the largest circuit
+        self.mapping_network2mea_dense = np.full((len(self.circuit_sizes),max(self.circuit_sizes)),-1,dtype=int)
+        for i, network in enumerate(self.mapping_network2mea):
+            self.mapping_network2mea_dense[i,:len(network)] = network
+        is_electrode = self.mapping_network2mea_dense >= 0
+        self.mapping_network2recv = np.where(is_electrode,self.mapping_mea2recv[self.mapping_network2mea_dense],-1)
+        self.mapping_network2stim = np.where(is_electrode,self.mapping_mea2fpga[self.mapping_network2mea_dense],-1)
+
     def mea2recv(self,ids=None):
         """mea2recv(ids=None): Returns the mapping from MCS MEA layout to the received UDP package."""
         if np.isscalar(ids):
@@ -200,18 +212,61 @@ class Electrode_mapping:
         else:
             return self.mapping_mea2network[ids,0],self.mapping_mea2network[ids,1]
     
+    def mea2stim_chip(self,ids=None):
+        """mea2stim_chip(ids=None): Returns the first command of the chip in the stimulation word and the bit of the electrode on the chip."""
+
+        if np.isscalar(ids):
+            ids = [ids]
+        if ids is None:
+            return self.mapping_mea2stim_chip,self.mapping_mea2stim_bit
+        else:
+            return self.mapping_mea2stim_chip[ids],self.mapping_mea2stim_bit[ids]
+
+    def recv2network(self,ids=None):
+        """recv2network(ids=None): Returns the mapping from the received UDP package to networks."""
+
+        if np.isscalar(ids):
+            ids = [ids]
+        if ids is None:
+            return self.mapping_recv2network[:,0],self.mapping_recv2network[:,1]
+        else:
+            return self.mapping_recv2network[ids,0],self.mapping_recv2network[ids,1]
+
     def network2mea(self,mapping):
-        """network2mea(mapping): Returns the mapping from networks with microstructure to MCS MEA layout."""
+        """network2mea(mapping): Returns the mapping from networks with microstructure to MCS MEA layout for an array of (network, electrode) rows."""
 
+        return self.lookup_network(self.mapping_network2mea_dense,mapping)
+
+    def network2recv(self,mapping):
+        """network2recv(mapping): Returns the received UDP package channels of an array of (network, electrode) rows."""
+
+        return self.lookup_network(self.mapping_network2recv,mapping)
+
+    def network2stim(self,mapping):
+        """network2stim(mapping): Returns the stimulation sources of an array of (network, electrode) rows, see mea2stim."""
+
+        return self.lookup_network(self.mapping_network2stim,mapping)
+
+    def lookup_network(self,table,mapping):
+        """lookup_network(table, mapping): Looks up (network, electrode) rows in a dense network table."""
+        mapping = np.asarray(mapping).astype(int,copy=False).reshape(-1,2)
+        ids = table[mapping[:,0],mapping[:,1]]
+        if np.any(ids < 0):
+            raise IndexError(f"Electrodes {mapping[ids < 0].tolist()} are not part of their network")
+        return ids
 
-        return [self.mapping_network2mea[mapping[ele,0]][mapping[ele,1]] for ele in range(mapping.shape[0])]
-        
     
     def get_id_from_source(self,mea,chip,el):
         """
         get_id_from_source(mea, chip, el): Returns the ID in the stimulation package sent via USB based on the given MEA, chip, and electrode.
         """
         return mea*4 + (el%15)*16 + chip
+
+    def get_stim_chip_from_source(self,mea,chip,el):
+        """
+        get_stim_chip_from_source(mea, chip, el): Returns the first command of the chip in the stimulation word and the bit of the electrode on the chip.
+        """
+        return mea*16 + chip*4, np.left_shift(1,el)
     
     
 if __name__ == '__main__':
@@ -381,10 +381,8 @@ class App(QtWidgets.QTabWidget):
         network_to_plot = self.network_state + self.mea_state * 15
         # print(f"Plotting network ID {network_to_plot}")
         if PLOT_NETWORKS:
-            new_channel_ids = ELECTRODE_MAPPING.mea2recv(
-                ELECTRODE_MAPPING.network2mea(
-                    np.array([[network_to_plot, el] for el in np.arange(MEA_NUM)])
-                )
+            new_channel_ids = ELECTRODE_MAPPING.network2recv(
+                np.array([[network_to_plot, el] for el in np.arange(MEA_NUM)])
             )
         else:
             new_channel_ids = ELECTRODE_MAPPING.mea2recv(
@@ -0,0 +1,324 @@
+"""
+End-to-end latency benchmark of the closed loop stimulation path without hardware.
+Runs the packet generator, the readout, the spike processor, stim_segmentation, prepare_commands_process and
+send_commands_process_USB (via UDP_test_com) on localhost with an echo client answering every segment with a stimulus.
+The stages are time stamped with Latency_probe, p50/p99/max per stage are printed and written as JSON.
+With --commands the throughput of the command transmit path is measured instead, see run_command_throughput.
+"""
+import os
+import json
+import time
+import argparse
+import datetime
+import subprocess
+import numpy as np
+import multiprocessing as mp
+import multiprocessing.sharedctypes as mp_shared
+from ctypes import *
+
+from Client_config import (
+    FS,
+    CHANNELS,
+    STATUS_LEN,
+    TEMP_BUF_LEN,
+    TEMP_STREAM_SIZE,
+    PLOT_BUF_LEN,
+    SPIKE_WAVELET_SHAPE,
+    SPIKE_RING_LEN,
+    SPIKE_RING_HEADER,
+    RECEIVE_PORT,
+    SEND_PORT,
+    ELECTRODE_MAPPING,
+    NETWORK_NUM,
+    ELECTRODES,
+    USB_BATCH_WORDS,
+    USB_WINDOW_WORDS,
+)
+from inkubeSpike import receive_process, c_spike_poll_process, write_thresholds, new_spike_event
+from onsite_Stimulation_processor import stim_segmentation, Stim_timing
+from Send_commands import prepare_commands_process, EMPTY_COMMAND_WORD
+from USB_communication import USB_com, UDP_test_com, send_commands_process_USB
+from USB_emulator import Emulated_SoC, Emulated_transport
+from Packet_generator import Packet_generator
+from Latency_probe import Latency_probe, PROBE_STAGES
+from Package_clock import Package_clock
+
+LOCAL_IP = '127.0.0.1'
+
+def echo_client(stim_pipe_client, stim_matrix, profile_pipe=None, ahead=0):
+    """Answer every segment immediately with the same stimulus, stands in for the Jupyter client.
+    With ahead the stimulus is queued that many periods after the next one, it is committed at the deadline of its period."""
+    while True:
+        response = stim_pipe_client.recv()
+        stim_pipe_client.send((response['index']+1+ahead, stim_matrix))
+        if profile_pipe is not None and 'cycle_profile' in response:
+            profile_pipe.send(response['cycle_profile'])
+
+def git_version():
+    """Return the git description of the working tree or None"""
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+def readout_process(probe, pkg_clock, recv_pkg_send, spike_ring, spike_ring_seq, spike_event, newest_recv_pkg, thresh):
+    """Readout of the generator stream with fixed thresholds, the plot buffers are not read"""
+    UDP_rcv_port = mp_shared.Value(c_uint16, 0)
+    plot_shared = mp_shared.synchronized(mp_shared.RawArray(c_float, PLOT_BUF_LEN * CHANNELS))
+    plot_sig = mp_shared.synchronized(mp_shared.RawArray(c_float, PLOT_BUF_LEN * CHANNELS))
+    plot_spike_wavelet = mp_shared.synchronized(mp_shared.RawArray(c_float, SPIKE_WAVELET_SHAPE[0]*SPIKE_WAVELET_SHAPE[1]*SPIKE_WAVELET_SHAPE[2]))
+    plot_spike_wavelet_id = mp_shared.synchronized(mp_shared.RawArray(c_uint32, SPIKE_WAVELET_SHAPE[0]*SPIKE_WAVELET_SHAPE[1]))
+    plot_spikes = mp_shared.synchronized(mp_shared.RawArray(c_uint8, PLOT_BUF_LEN * CHANNELS))
+    plot_status = mp_shared.synchronized(mp_shared.RawArray(c_uint32, PLOT_BUF_LEN * STATUS_LEN))
+    plot_temp = mp_shared.synchronized(mp_shared.RawArray(c_uint32, TEMP_STREAM_SIZE * TEMP_BUF_LEN))
+    plot_loc = mp_shared.synchronized(mp_shared.RawArray(c_uint16, 1))
+    spike_thresh_array = mp_shared.synchronized(mp_shared.RawArray(c_float, CHANNELS))
+    spike_thresh_seq = mp_shared.RawArray(c_uint64, 1)
+    # fixed thresholds, the automatic update from the noise estimate is off
+    write_thresholds(spike_thresh_array, spike_thresh_seq, thresh)
+
+    return mp.Process(
+        target=receive_process,
+        name='continuous_FPGA_data_readout',
+        args=(
+            UDP_rcv_port, LOCAL_IP, (LOCAL_IP, RECEIVE_PORT), spike_ring, spike_ring_seq,
+            plot_shared, plot_sig, plot_spike_wavelet, plot_spike_wavelet_id, plot_spikes, plot_loc,
+            recv_pkg_send, spike_thresh_array, plot_status, plot_temp, newest_recv_pkg, 0,
+        ),
+        kwargs={'thresh_seq': spike_thresh_seq, 'spike_event_fd': spike_event, 'latency_probe': probe, 'pkg_clock': pkg_clock},
+    )
+
+def run_benchmark(duration=30., speed=1., thresh=100., spike_rate=5., timing_ms=None, ahead=0):
+    """Run the closed loop for duration seconds and return the latency report.
+    timing_ms changes the period timing as the 'timing' command of main.py, the cycle profile is reported with it.
+    ahead queues the stimuli periods ahead instead of answering for the next period, see Stim_period_queue.
+    """
+    probe = Latency_probe()
+    stim_timing = Stim_timing()
+    if timing_ms:
+        stim_timing.set_ms({**timing_ms, 'profile': True})
+    profile_recv, profile_send = mp.Pipe(duplex=False)
+
+    command_pipe_recv, command_pipe_send = mp.Pipe(duplex=False)
+    send_pipe_recv, send_pipe_send = mp.Pipe(duplex=False)
+    raster_plot_pipe_recv, raster_plot_pipe_send = mp.Pipe(duplex=False)
+    detected_spike_share_recv, detected_spike_share_send = mp.Pipe(duplex=False)
+    recv_pkg_recv, recv_pkg_send = mp.Pipe(duplex=False)
+    stim_pipe_server, stim_pipe_client = mp.Pipe(duplex=True)
+
+    spike_ring = mp_shared.RawArray(c_uint32, SPIKE_RING_LEN)
+    spike_ring_seq = mp_shared.RawArray(c_uint64, SPIKE_RING_HEADER)
+    spike_event = new_spike_event()
+
+    newest_recv_pkg = mp_shared.synchronized(mp_shared.RawArray(c_uint32, 4))
+    for i in range(3):
+        newest_recv_pkg[i] = 2**22
+    pkg_clock = Package_clock(FS*speed)
+    plot_channels = mp.Value("i", 0)
+
+    segment_ids = mp_shared.synchronized(mp_shared.RawArray(c_uint32, 6))
+    segment_ids[0] = 2**22
+    segment_ids[1] = 0
+    store_event = mp.Event()
+    period_over_event = mp.Event()
+    stim_event = mp.Event()
+    spont_event = mp.Event()
+
+    # the generator is bound before the readout sends its whitelist package
+    generator = Packet_generator(LOCAL_IP, speed, spike_rate=spike_rate)
+
+    processes = [
+        mp.Process(target=generator.run, name='packet_generator', args=(duration+5,)),
+        readout_process(probe, pkg_clock, recv_pkg_send, spike_ring, spike_ring_seq, spike_event, newest_recv_pkg, thresh),
+        mp.Process(
+            target=c_spike_poll_process,
+            name='spike_processor',
+            args=(
+                spike_ring, spike_ring_seq, segment_ids, detected_spike_share_send,
+                ELECTRODE_MAPPING.mapping_recv2network, NETWORK_NUM, ELECTRODES,
+                store_event, period_over_event, spont_event,
+            ),
+            kwargs={'spike_event_fd': spike_event, 'latency_probe': probe},
+        ),
+        mp.Process(
+            target=prepare_commands_process,
+            name='prepare_commands',
+            args=(command_pipe_recv, send_pipe_send, newest_recv_pkg),
+            kwargs={'latency_probe': probe},
+        ),
+        mp.Process(
+            target=send_commands_process_USB,
+            name='send_via_USB',
+            args=(UDP_test_com((LOCAL_IP, SEND_PORT)), send_pipe_recv, recv_pkg_recv, 100e-3),
+            kwargs={'latency_probe': probe},
+        ),
+        mp.Process(
+            target=echo_client,
+            name='echo_client',
+            args=(stim_pipe_client, np.array([[0, 0, 0]]), profile_send, ahead),
+        ),
+    ]
+    for process in processes:
+        process.start()
+
+    # start the closed loop as mode 2 of main.py
+    pkg_clock.wait_started()
+    period_over_event.set()
+    store_event.set()
+    time.sleep(.5)
+    stim_event.set()
+    p_segment_stimulation = mp.Process(
+        target=stim_segmentation,
+        name='stim_segmentation',
+        args=(
+            command_pipe_send, pkg_clock, plot_channels, raster_plot_pipe_send, segment_ids,
+            stim_pipe_server, detected_spike_share_recv, period_over_event, stim_event, stim_timing,
+        ),
+        kwargs={'latency_probe': probe},
+    )
+    p_segment_stimulation.start()
+    processes.append(p_segment_stimulation)
+
+    # the raster plot is not shown, its pipe is emptied
+    cycle_profile = None
+    t_end = time.time() + duration
+    while time.time() < t_end:
+        while raster_plot_pipe_recv.poll(.1):
+            raster_plot_pipe_recv.recv()
+        while profile_recv.poll():
+            cycle_profile = profile_recv.recv()
+
+    for process in processes:
+        process.terminate()
+
+    return {
+        'version': git_version(),
+        'date': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'duration_s': duration,
+        'speed': speed,
+        'thresh': thresh,
+        'ahead': ahead,
+        'timing': stim_timing.read(),
+        'cycle_profile': cycle_profile,
+        'stages': probe.report(),
+    }
+
+def run_command_throughput(
+        frames=2000, batch_words=USB_BATCH_WORDS, window_words=USB_WINDOW_WORDS, frame_words=4, speed=1., timeout=60., 
+        emulated=False, loss=0., delay=0.):
+    """Put frames of frame_words immediate stimulation command words on the send pipe at once and measure the
+    acknowledged command words per second of send_commands_process_USB with batch_words words per transfer and
+    window_words words in flight. The commands go via UDP to the packet generator and its counter through the readout,
+    with emulated they are written to an Emulated_SoC in the send process that loses a fraction loss of the transfers
+    and returns the counter after delay seconds."""
+    probe = Latency_probe()
+
+    send_pipe_recv, send_pipe_send = mp.Pipe(duplex=False)
+    recv_pkg_recv, recv_pkg_send = mp.Pipe(duplex=False)
+    if emulated:
+        com = USB_com(Emulated_transport(Emulated_SoC(), recv_pkg_send, delay, loss))
+        processes = []
+    else:
+        com = UDP_test_com((LOCAL_IP, SEND_PORT))
+        spike_ring = mp_shared.RawArray(c_uint32, SPIKE_RING_LEN)
+        spike_ring_seq = mp_shared.RawArray(c_uint64, SPIKE_RING_HEADER)
+        newest_recv_pkg = mp_shared.synchronized(mp_shared.RawArray(c_uint32, 4))
+        pkg_clock = Package_clock(FS*speed)
+        generator = Packet_generator(LOCAL_IP, speed, spike_rate=0)
+        processes = [
+            mp.Process(target=generator.run, name='packet_generator', args=(timeout+5,)),
+            readout_process(probe, pkg_clock, recv_pkg_send, spike_ring, spike_ring_seq, new_spike_event(), newest_recv_pkg, 1e6),
+        ]
+    processes.append(mp.Process(
+        target=send_commands_process_USB,
+        name='send_via_USB',
+        args=(com, send_pipe_recv, recv_pkg_recv, 100e-3),
+        kwargs={'batch_words': batch_words, 'window_words': window_words, 'latency_probe': probe},
+    ))
+    for process in processes:
+        process.start()
+    if not emulated:
+        pkg_clock.wait_started()
+    time.sleep(.5)
+
+    # immediate execution, package id with the MSB set
+    frame = bytearray(EMPTY_COMMAND_WORD * frame_words)
+    for i in range(frame_words):
+        frame[i*len(EMPTY_COMMAND_WORD)+4:i*len(EMPTY_COMMAND_WORD)+8] = (0x80000000).to_bytes(4, byteorder='little')
+    t_start = time.perf_counter()
+    for _ in range(frames):
+        send_pipe_send.send((2, frame))
+    acknowledged_pos = probe.event_pos['frame_acknowledged']
+    while probe.stamps[acknowledged_pos] < frames and time.perf_counter() - t_start < timeout:
+        time.sleep(1e-3)
+    elapsed = time.perf_counter() - t_start
+    acknowledged = probe.stamps[acknowledged_pos]
+
+    for process in processes:
+        process.terminate()
+        process.join()
+
+    return {
+        'emulated': emulated,
+        'loss': loss,
+        'batch_words': batch_words,
+        'window_words': window_words,
+        'frame_words': frame_words,
+        'frames': acknowledged,
+        'duration_s': elapsed,
+        'commands_per_s': acknowledged*frame_words/elapsed,
+        'usb_ack': probe.report()['usb_ack'],
+    }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the latency of every stage of the closed loop path')
+    parser.add_argument('--duration', type=float, default=30., help='seconds of closed loop stimulation')
+    parser.add_argument('--speed', type=float, default=1., help='multiple of the real sampling rate')
+    parser.add_argument('--thresh', type=float, default=100., help='spike detection threshold')
+    parser.add_argument('--spike-rate', type=float, default=5., help='spike rate per channel in Hz')
+    parser.add_argument('--cycle-ms', type=float, help='stimulation cycle in ms, reports the cycle profile')
+    parser.add_argument('--min-delay-ms', type=float, help='time before a period the stimulus must be received in ms')
+    parser.add_argument('--response-ms', type=float, help='closed loop response period in ms')
+    parser.add_argument('--ahead', type=int, default=0, help='periods the echo client queues its stimulus ahead')
+    parser.add_argument('--commands', type=int, help='measure the command throughput with this number of frames instead')
+    parser.add_argument('--batch', type=int, nargs='+', default=[USB_BATCH_WORDS], help='command words per USB transfer for --commands')
+    parser.add_argument('--window', type=int, nargs='+', default=[USB_WINDOW_WORDS], help='command words in flight for --commands')
+    parser.add_argument('--emulated', action='store_true', help='write the commands to an emulated SoC in the send process for --commands')
+    parser.add_argument('--loss', type=float, default=0., help='fraction of USB transfers the emulated SoC loses')
+    parser.add_argument('--delay', type=float, default=0., help='seconds until the emulated SoC returns the receive counter')
+    parser.add_argument('--out', default='latency_report.json', help='JSON file for the report')
+    args = parser.parse_args()
+
+    if args.commands:
+        results = []
+        for window_words in args.window:
+            for batch_words in args.batch:
+                result = run_command_throughput(
+                    args.commands, batch_words, window_words, speed=args.speed, emulated=args.emulated, loss=args.loss, delay=args.delay)
+                print(
+                    f"window {window_words:3d} batch {batch_words:3d} words: {result['frames']} frames in {result['duration_s']:.3f} s, "
+                    f"{result['commands_per_s']:10.0f} commands/s, ack p50 {result['usb_ack']['p50_ms']:.3f} ms")
+                results.append(result)
+        with open(args.out, 'w') as file:
+            json.dump({'version': git_version(), 'throughput': results}, file, indent=2)
+        print(f'Report written to {args.out}')
+    else:
+        timing_ms = {
+            key: value for key, value in 
+            (('cycle', args.cycle_ms), ('min_delay', args.min_delay_ms), ('response_period', args.response_ms))
+            if value is not None}
+        report = run_benchmark(args.duration, args.speed, args.thresh, args.spike_rate, timing_ms, args.ahead)
+        for stage in PROBE_STAGES:
+            result = report['stages'][stage]
+            if result['count']:
+                print(f"{stage:>18}: n={result['count']:6d}  p50 {result['p50_ms']:8.3f} ms  p99 {result['p99_ms']:8.3f} ms  max {result['max_ms']:8.3f} ms")
+            else:
+                print(f"{stage:>18}: no samples")
+        if report['cycle_profile'] is not None:
+            print(f"cycle profile: {report['cycle_profile']}")
+        with open(args.out, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f'Report written to {args.out}')
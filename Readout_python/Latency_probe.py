@@ -0,0 +1,116 @@
+"""
+Time stamps along the closed loop stimulation path, from the UDP package to the USB write.
+Every process stamps events with a key (package id, segment end or command frame id) into one shared array.
+The latency of a stage is the time between its start and end event with the same key, see PROBE_STAGES.
+A process only stamps if it is given the probe as its latency_probe argument, probe_stamp is a no-op for None.
+The probe is passed explicitly as module state is not inherited by processes started with spawn or forkserver.
+"""
+import time
+import numpy as np
+import multiprocessing.sharedctypes as mp_shared
+from ctypes import c_int64
+
+PROBE_LEN = 2**14 # stamps kept per event, older stamps are overwritten
+PKG_TIME_POS = 2048-8 # byte position of the send time (perf_counter_ns) in synthetic packages, unused by the FPGA format
+
+PROBE_EVENTS = (
+    'pkg_sent', # packet generator sent the package, read from the package
+    'pkg_received', # readout received the block, key is the id of its last package
+    'pkg_detected', # readout finished filtering and detection of the block
+    'segment_spikes_sent', # spike processor sent the spikes of a segment, key is the segment end
+    'segment_response_sent', # stim_segmentation sent the segment to the client
+    'stimulus_received', # stim_segmentation received the stimulus of the client
+    'commands_queued', # stim_segmentation put a stimulus on the command pipe, key is the stimulus package id
+    'commands_prepared', # prepare_commands_process built the command frame
+    'frame_queued', # prepare_commands_process put the frame on the send pipe, key is the frame id
+    'frame_written', # send_commands_process_USB wrote the frame
+    'frame_acknowledged', # the receive counter in the data stream confirmed the frame
+    'usb_command_written', # USB_transfer_engine wrote a command, key is its number*4 + command id
+    'usb_command_acknowledged', # the receive counter confirmed the command
+)
+
+# stage: start event, end event, True if the keys match exactly, else the first start key at or after the end key is used
+PROBE_STAGES = {
+    'udp_receive': ('pkg_sent', 'pkg_received', True),
+    'detection': ('pkg_received', 'pkg_detected', True),
+    'spike_pipe': ('pkg_detected', 'segment_spikes_sent', False),
+    'segmentation': ('segment_spikes_sent', 'segment_response_sent', True),
+    'client_round_trip': ('segment_response_sent', 'stimulus_received', True),
+    'prepare_commands': ('commands_queued', 'commands_prepared', True),
+    'usb_write': ('frame_queued', 'frame_written', True),
+    'usb_handshake': ('frame_written', 'frame_acknowledged', True),
+    'usb_ack': ('usb_command_written', 'usb_command_acknowledged', True),
+}
+
+class Latency_probe:
+    """Shared table of time stamps, one ring of (key, time in ns) per event with a single writing process.
+    Args:
+        probe_len: stamps kept per event
+    """
+    def __init__(self, probe_len=PROBE_LEN):
+        self.probe_len = probe_len
+        self.event_len = 1 + 2*probe_len
+        self.stamps = mp_shared.RawArray(c_int64, len(PROBE_EVENTS)*self.event_len)
+        self.event_pos = {event: i*self.event_len for i, event in enumerate(PROBE_EVENTS)}
+
+    def stamp(self, event, key, t=None):
+        """Store the time t in ns (now if None) of an event with its key"""
+        if t is None:
+            t = time.perf_counter_ns()
+        pos = self.event_pos[event]
+        n = self.stamps[pos]
+        self.stamps[pos + 1 + 2*(n % self.probe_len)] = key
+        self.stamps[pos + 2 + 2*(n % self.probe_len)] = t
+        self.stamps[pos] = n + 1
+
+    def events(self, event):
+        """Return the keys and times in ns of the stored stamps of an event in stamp order"""
+        pos = self.event_pos[event]
+        n = self.stamps[pos]
+        table = np.frombuffer(self.stamps, dtype=np.int64)[pos+1:pos+self.event_len].reshape(-1, 2)
+        if n > self.probe_len:
+            table = np.roll(table, -(n % self.probe_len), axis=0)
+        else:
+            table = table[:n]
+        return table[:,0].copy(), table[:,1].copy()
+
+    def stage_latency(self, stage):
+        """Return the latencies of a stage in ms"""
+        start_event, end_event, exact = PROBE_STAGES[stage]
+        start_keys, start_times = self.events(start_event)
+        end_keys, end_times = self.events(end_event)
+        if not len(start_keys) or not len(end_keys):
+            return np.zeros(0)
+
+        order = np.argsort(start_keys, kind='stable')
+        start_keys = start_keys[order]
+        start_times = start_times[order]
+        pos = np.searchsorted(start_keys, end_keys, side='left')
+        valid = pos < len(start_keys)
+        if exact:
+            valid[valid] = start_keys[pos[valid]] == end_keys[valid]
+        latency = (end_times[valid] - start_times[pos[valid]])*1e-6
+        # keys repeat after the package id wraparound, those matches are dropped
+        return latency[latency >= 0]
+
+    def report(self):
+        """Return count, p50, p99 and max latency in ms of every stage"""
+        report = {}
+        for stage in PROBE_STAGES:
+            latency = self.stage_latency(stage)
+            report[stage] = {
+                'count': int(latency.shape[0]),
+                'p50_ms': float(np.percentile(latency, 50)) if latency.shape[0] else None,
+                'p99_ms': float(np.percentile(latency, 99)) if latency.shape[0] else None,
+                'max_ms': float(latency.max()) if latency.shape[0] else None,
+            }
+        return report
+
+def probe_stamp(latency_probe, event, key):
+    """Stamp an event with the probe of the process, nothing happens if the process has no probe"""
+    if latency_probe is not None:
+        latency_probe.stamp(event, key)
+
+def frame_key(command_frame):
+    """Key of a command frame, the execution package id of its first command word"""
+    return int.from_bytes(command_frame[4:8], byteorder='little')
@@ -0,0 +1,76 @@
+"""
+Package clock of the readout, the id of the newest received package shared with all processes.
+The readout publishes the id once per received block without a lock and counts the publications in a second word.
+A consumer that waits for package X sleeps with a timer until shortly before X is predicted from FS and then on the
+counter with a futex, it is woken by the first block that reaches X instead of polling with 1 ms sleeps.
+The words are read by inkubeSpike.pyx, their positions match the PKG_CLOCK_* constants there.
+"""
+import time
+import multiprocessing.sharedctypes as mp_shared
+from ctypes import c_uint32
+
+from Client_config import FS
+from inkubeSpike import pkg_clock_wait, pkg_diff
+
+PKG_CLOCK_ID = 0 # newest received package id, PKG_CLOCK_IDLE until the first package
+PKG_CLOCK_SEQ = 1 # number of blocks published by the readout
+PKG_CLOCK_WAITERS = 2 # consumers sleeping on PKG_CLOCK_SEQ, the readout only wakes them if not 0
+PKG_CLOCK_LEN = 3
+PKG_CLOCK_IDLE = 2**22 # above MAX_PKG_ID, the readout did not receive a package yet
+PKG_CLOCK_WAKE_MARGIN = 2e-3 # in s, the timer ends this long before the predicted arrival, the futex waits the rest
+PKG_CLOCK_MAX_WAIT = 0.1 # in s, longest futex wait, a stalled stream is checked again after it
+
+class Package_clock:
+    """Shared package clock, created before the processes are started and passed to the readout and the consumers.
+    Args:
+        fs: packages per second used to predict the arrival of a package
+    """
+    def __init__(self, fs=FS):
+        self.fs = fs
+        self.clock = mp_shared.RawArray(c_uint32, PKG_CLOCK_LEN)
+        self.clock[PKG_CLOCK_ID] = PKG_CLOCK_IDLE
+
+    def now(self):
+        """Newest received package id, PKG_CLOCK_IDLE before the readout started"""
+        return self.clock[PKG_CLOCK_ID]
+
+    def started(self):
+        return self.clock[PKG_CLOCK_ID] != PKG_CLOCK_IDLE
+
+    def time_until(self, pkg_id):
+        """Predicted seconds until pkg_id is received, 0 or negative if it was received"""
+        return pkg_diff(pkg_id, self.now())/self.fs
+
+    def wait_started(self):
+        """Block until the readout received its first package"""
+        while not self.started():
+            pkg_clock_wait(self.clock, self.clock[PKG_CLOCK_SEQ], PKG_CLOCK_MAX_WAIT)
+
+    def wait_until(self, pkg_id, ready=None):
+        """Block until the package pkg_id is received or ready returns True.
+        Args:
+            pkg_id: package id with wraparound at MAX_PKG_ID
+            ready: callable blocking until an other condition holds with a timeout in s, e.g. Connection.poll or Event.wait
+        Returns:
+            bool: True if ready returned True before pkg_id was received
+        """
+        while True:
+            # the counter is read first, a block published after the id was read ends the futex wait at once
+            seq = self.clock[PKG_CLOCK_SEQ]
+            current_id = self.clock[PKG_CLOCK_ID]
+            wait_time = 0.
+            if current_id != PKG_CLOCK_IDLE:
+                ahead = pkg_diff(pkg_id, current_id)
+                if ahead <= 0:
+                    return False
+                wait_time = ahead/self.fs - PKG_CLOCK_WAKE_MARGIN
+
+            if wait_time > 0:
+                if ready is None:
+                    time.sleep(wait_time)
+                elif ready(wait_time):
+                    return True
+            else:
+                if ready is not None and ready(0):
+                    return True
+                pkg_clock_wait(self.clock, seq, PKG_CLOCK_MAX_WAIT)
@@ -0,0 +1,163 @@
+"""
+Synthetic FPGA data stream for load tests without hardware (TEST_SERVER = True).
+Sends 2048 byte UDP packages in the format parsed by full_readout at a multiple of the real sampling rate.
+The packages carry noise, injected spikes, the package id with wraparound at MAX_PKG_ID, temperature words and the receive counter.
+Commands forwarded by UDP_test_com (TEST_USB_LOOPBACK = True) are applied to an Emulated_SoC, its receive counter
+is returned in the data stream as the handshake of the SoC.
+"""
+import os
+import time
+import socket
+import argparse
+import threading
+import numpy as np
+
+from Client_config import (
+    FS,
+    MAX_PKG_ID,
+    RECEIVE_PORT,
+    SEND_PORT,
+    status_pos,
+)
+from Benchmark_detection import make_packages
+from Latency_probe import PKG_TIME_POS
+from USB_emulator import Emulated_SoC
+
+POOL_LEN = 2**14 # distinct packages that are cycled, ~0.9 s of data
+SEND_BATCH = 16 # packages sent between two rate checks
+TEMP_RAW = 0x2500 # raw value of the temperature words
+STATUS_RAW = 37 # value of the second status word
+
+class Packet_generator:
+    """Emulates the UDP uplink and the command handshake of the SoC.
+    Args:
+        host_ip: IP the generator listens on, the readout sends its whitelist package there
+        speed: multiple of the real sampling rate FS
+        noise: standard deviation of the noise in LSB
+        spike_rate: mean spike rate per channel in Hz
+        spike_amp: spike amplitude in LSB
+        drop_rate: probability that a package is not sent
+        start_id: package id of the first package, set close to MAX_PKG_ID to test the wraparound
+        seed: seed of the random generator
+    """
+    def __init__(
+            self,
+            host_ip='127.0.0.1',
+            speed=1.,
+            noise=20.,
+            spike_rate=5.,
+            spike_amp=300.,
+            drop_rate=0.,
+            start_id=0,
+            seed=0,
+        ):
+        self.speed = speed
+        self.drop_rate = drop_rate
+        self.pkg_id = start_id % MAX_PKG_ID
+        self.device = Emulated_SoC()
+        self.rng = np.random.default_rng(seed)
+
+        self.pool = make_packages(POOL_LEN, 0, noise, spike_rate, spike_amp, seed)
+        status = self.pool[:,2:2+4*16].view(np.uint32)
+        status[:,5:12] = TEMP_RAW
+        self.pool.view(np.uint16)[:,27:35] = TEMP_RAW
+        self.pool[:,2+4*status_pos[1]:6+4*status_pos[1]].view(np.uint32)[:] = STATUS_RAW
+
+        self.data_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.data_socket.bind((host_ip, RECEIVE_PORT))
+        self.command_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.command_socket.bind((host_ip, SEND_PORT))
+        self.readout_address = None
+        self.sent = 0
+        self.dropped = 0
+
+    def handle_command(self, data: bytes):
+        """Apply a command as written to the USB bulk port and update the receive counter"""
+        port = self.device.port
+        self.device.handle(data)
+        # port, the readout address is otherwise taken from the whitelist package
+        if self.device.port != port and self.readout_address is not None:
+            self.readout_address = (self.readout_address[0], self.device.port)
+
+    def command_thread(self):
+        """Receive the commands and answer them through the receive counter of the data stream"""
+        while True:
+            data, _ = self.command_socket.recvfrom(65536)
+            self.handle_command(data)
+
+    def wait_for_readout(self):
+        """Block until the readout sends its whitelist package and return its address"""
+        print(f'Waiting for the readout on port {RECEIVE_PORT}')
+        _, self.readout_address = self.data_socket.recvfrom(2048)
+        print(f'Readout connected from {self.readout_address}')
+        return self.readout_address
+
+    def run(self, duration=None):
+        """Send packages at speed times the real rate until duration in seconds has passed"""
+        if self.readout_address is None:
+            self.wait_for_readout()
+        threading.Thread(target=self.command_thread, daemon=True).start()
+
+        t_pkg = 1/(FS*self.speed)
+        n_total = None if duration is None else int(duration*FS*self.speed)
+        ids = np.zeros(SEND_BATCH, dtype=np.uint32)
+        n = 0
+        late = 0.
+        t_start = time.perf_counter()
+        t_report = t_start
+        while n_total is None or n < n_total:
+            batch = self.pool[np.arange(n, n+SEND_BATCH) % POOL_LEN]
+            ids[:] = (self.pkg_id + np.arange(SEND_BATCH)) % MAX_PKG_ID
+            batch[:,2:6] = ids.view(np.uint8).reshape(SEND_BATCH, 4)
+            batch[:,1] = self.device.recv_counter
+            # send time for the latency probe, one stamp per batch
+            batch[:,PKG_TIME_POS:PKG_TIME_POS+8] = np.array([time.perf_counter_ns()], dtype=np.int64).view(np.uint8)
+            keep = self.rng.random(SEND_BATCH) >= self.drop_rate if self.drop_rate else np.ones(SEND_BATCH, dtype=bool)
+
+            for p in range(SEND_BATCH):
+                if keep[p]:
+                    self.data_socket.sendto(batch[p].data, self.readout_address)
+            self.sent += int(keep.sum())
+            self.dropped += SEND_BATCH - int(keep.sum())
+            self.pkg_id = (self.pkg_id + SEND_BATCH) % MAX_PKG_ID
+            n += SEND_BATCH
+
+            # keep the rate, sleep when ahead and count the time when behind
+            t_ahead = t_start + n*t_pkg - time.perf_counter()
+            if t_ahead > 0:
+                time.sleep(t_ahead)
+            else:
+                late = max(late, -t_ahead)
+
+            if time.perf_counter() - t_report > 5:
+                t_report = time.perf_counter()
+                print(f'Sent {self.sent} packages ({self.sent/(t_report-t_start):.0f}/s), '
+                      f'dropped {self.dropped}, max lag {late*1e3:.1f} ms, recv counter {self.device.recv_counter}')
+                late = 0.
+
+        return self.sent, self.dropped
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Send a synthetic FPGA data stream to the readout')
+    parser.add_argument('--speed', type=float, default=1., help='multiple of the real sampling rate, e.g. 1, 2 or 10')
+    parser.add_argument('--duration', type=float, default=None, help='seconds of data to send, endless if not set')
+    parser.add_argument('--noise', type=float, default=20., help='noise standard deviation in LSB')
+    parser.add_argument('--spike-rate', type=float, default=5., help='spike rate per channel in Hz')
+    parser.add_argument('--spike-amp', type=float, default=300., help='spike amplitude in LSB')
+    parser.add_argument('--drop-rate', type=float, default=0., help='probability to drop a package')
+    parser.add_argument('--start-id', type=int, default=0, help='first package id')
+    parser.add_argument('--ip', default='127.0.0.1', help='IP to listen on')
+    args = parser.parse_args()
+
+    print(f'PID:{os.getpid()} - Started packet generator.')
+    generator = Packet_generator(
+        args.ip,
+        args.speed,
+        args.noise,
+        args.spike_rate,
+        args.spike_amp,
+        args.drop_rate,
+        args.start_id,
+    )
+    sent, dropped = generator.run(args.duration)
+    print(f'Done: sent {sent}, dropped {dropped} packages')
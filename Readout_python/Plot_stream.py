@@ -419,8 +419,11 @@ class UpdateData(QtCore.QThread):
     def run(self):
         while True:
             if self.app_current.currentIndex() == SIGNAL_TAB_ID or self.app_current.currentIndex() == STATUS_TAB_ID:
-                while self.plot_position_in_array[0] % self.step < 0.9 * self.step:
-                    time.sleep(0.05 * self.step / FS)
+                # sleep until the plot position is predicted to reach the update point instead of polling
+                plot_step_loc = self.plot_position_in_array[0] % self.step
+                while plot_step_loc < 0.9 * self.step:
+                    time.sleep((0.9 * self.step - plot_step_loc) / FS)
+                    plot_step_loc = self.plot_position_in_array[0] % self.step
                 current_loc = int(self.plot_position_in_array[0]) * CHANNELS
                 if self.app_current.currentIndex() == SIGNAL_TAB_ID:                                    
                     thresh_channels = np.ones(self.ch_num.shape[0])
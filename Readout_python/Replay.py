@@ -0,0 +1,186 @@
+"""
+Offline replay of recorded sessions through the readout filter and spike detection kernel in inkubeSpike.
+Accepts raw package files (consecutive 2048 byte UDP packages) and recordings of Data_recorder.
+Thresholds are estimated per file from the median of the absolute detection signal as the readout does (set_noise_thresh), files are replayed in parallel processes.
+The detection path (SNEO or high pass) is fixed when inkubeSpike is compiled, see USE_SNEO.
+"""
+import os
+import time
+import argparse
+import functools
+import numpy as np
+import scipy.signal as sig
+import multiprocessing as mp
+
+from Client_config import (
+    FS,
+    CHANNELS,
+    SPIKE_THRESH,
+    MIN_SPIKE_THRESH,
+    F_CORNER,
+    FILT_ORDER,
+    status_pos,
+)
+from inkubeSpike import SpikeDetector
+from Benchmark_detection import PKG_LEN, CHANNEL_OFFSET
+from Data_recorder import RECORD_FORMAT, load_recording
+
+REPLAY_CHUNK_LEN = 2**16 # packages converted and processed per call, ~3.8 s or 128 MB
+CALIB_LEN = 2*4340 # packages used for the threshold estimate, 0.5 s
+
+def is_recording(file_path):
+    """Return True if the file is a recording of Data_recorder"""
+    with open(file_path, 'rb') as file:
+        return file.read(64).find(RECORD_FORMAT.encode('utf-8')) >= 0
+
+def records_to_packages(records):
+    """Rebuild UDP packages from recorded samples
+    Args:
+        records: record array of Data_recorder
+    Returns:
+        uint8 array of shape (n, PKG_LEN)
+    """
+    n = records.shape[0]
+    words = np.zeros((n, PKG_LEN//2), dtype=np.uint16)
+    words[:,CHANNEL_OFFSET:CHANNEL_OFFSET+2*CHANNELS:2] = (records['raw'].astype(np.int32) + 2**15).astype(np.uint16)
+    packages = words.view(np.uint8)
+    status = packages[:,2:2+4*(max(status_pos)+1)].view(np.uint32)
+    for s, pos in enumerate(status_pos):
+        status[:,pos] = records['status'][:,s]
+    status[:,0] = records['pkg_id']
+    return packages
+
+def open_packages(file_path):
+    """Open a raw package file or a recording
+    Returns:
+        number of packages and a function returning the packages start to stop as contiguous uint8 array
+    """
+    if is_recording(file_path):
+        _, records = load_recording(file_path)
+        return records.shape[0], lambda start, stop: records_to_packages(records[start:stop])
+    n_pkg = os.path.getsize(file_path) // PKG_LEN
+    packages = np.memmap(file_path, dtype=np.uint8, mode='r', shape=(n_pkg, PKG_LEN))
+    return n_pkg, lambda start, stop: np.ascontiguousarray(packages[start:stop])
+
+def high_pass(f_corner):
+    """Return the filter coefficients of the readout high pass for a corner frequency in Hz"""
+    return sig.iirfilter(FILT_ORDER, f_corner, btype='highpass', ftype='butter', fs=FS, output='ba')
+
+def estimate_thresh(packages, thresh_factor, min_thresh, filt_b, filt_a):
+    """Estimate the spike thresholds from the median absolute detection signal as the readout does
+    Args:
+        packages: uint8 array of shape (n, PKG_LEN)
+        thresh_factor: factor with which the MAD is multiplied
+        min_thresh: lower limit of the threshold
+        filt_b, filt_a: high pass coefficients
+    Returns:
+        threshold per channel
+    """
+    detector = SpikeDetector(np.inf, filt_b, filt_a)
+    _, _, signal = detector.process(packages)
+    lower_lim = min_thresh/thresh_factor
+    median = np.median(np.abs(signal), axis=0)
+    median[median < lower_lim] = lower_lim
+    return (thresh_factor*median).astype(np.float32)
+
+def replay_file(
+        file_path,
+        thresh=None,
+        thresh_factor=SPIKE_THRESH,
+        min_thresh=MIN_SPIKE_THRESH,
+        f_corner=F_CORNER,
+        chunk_len=REPLAY_CHUNK_LEN,
+        block_len=64,
+        num_threads=1,
+    ):
+    """Replay one file through the spike detection
+    Args:
+        file_path: raw package file or recording
+        thresh: spike threshold, scalar or per channel, estimated from the start of the file if None
+        thresh_factor: factor with which the MAD is multiplied
+        min_thresh: lower limit of the estimated threshold
+        f_corner: corner frequency of the high pass in Hz
+        chunk_len: packages per call of the detector
+        block_len: packages per block of the kernel
+        num_threads: OpenMP threads per file
+    Returns:
+        dictionary with spike channels (uint8), spike package ids (uint32), thresholds, number of samples and run time in seconds
+    """
+    t_start = time.perf_counter()
+    filt_b, filt_a = high_pass(f_corner)
+    n_pkg, get_packages = open_packages(file_path)
+
+    if thresh is None:
+        thresh = estimate_thresh(get_packages(0, min(CALIB_LEN, n_pkg)), thresh_factor, min_thresh, filt_b, filt_a)
+    detector = SpikeDetector(thresh, filt_b, filt_a)
+
+    spike_ch = []
+    spike_pkg = []
+    for start in range(0, n_pkg, chunk_len):
+        ch, pkg, _ = detector.process(get_packages(start, min(start+chunk_len, n_pkg)), block_len, num_threads, False)
+        spike_ch.append(ch)
+        spike_pkg.append(pkg)
+
+    return {
+        'file': file_path,
+        'spike_ch': np.concatenate(spike_ch) if spike_ch else np.zeros(0, dtype=np.uint8),
+        'spike_pkg': np.concatenate(spike_pkg) if spike_pkg else np.zeros(0, dtype=np.uint32),
+        'thresh': np.broadcast_to(np.asarray(thresh, dtype=np.float32), (CHANNELS,)),
+        'samples': n_pkg,
+        'seconds': time.perf_counter() - t_start,
+    }
+
+def replay(files, processes=None, **kwargs):
+    """Replay several files in parallel processes
+    Args:
+        files: list of raw package files or recordings
+        processes: number of worker processes, number of files or cores if None
+        kwargs: passed to replay_file
+    Returns:
+        list of the replay_file results in the order of files
+    """
+    processes = processes or min(len(files), os.cpu_count())
+    t_start = time.perf_counter()
+    if processes <= 1:
+        results = [replay_file(file_path, **kwargs) for file_path in files]
+    else:
+        with mp.Pool(processes) as pool:
+            results = pool.map(functools.partial(replay_file, **kwargs), files)
+    t_total = time.perf_counter() - t_start
+
+    n_samples = sum(result['samples'] for result in results)
+    for result in results:
+        print(f"{result['file']}: {result['samples']} samples, {len(result['spike_ch'])} spikes, "
+              f"{result['samples']/result['seconds']:.0f} samples/s")
+    print(f'Total: {n_samples} samples in {t_total:.2f} s with {processes} processes, '
+          f'{n_samples/t_total:.0f} samples/s, {n_samples/t_total/FS:.1f}x real time')
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay recorded sessions through the spike detection')
+    parser.add_argument('files', nargs='+', help='raw package files or recordings')
+    parser.add_argument('--thresh', type=float, default=None, help='fixed spike threshold instead of the MAD estimate')
+    parser.add_argument('--thresh-factor', type=float, default=SPIKE_THRESH, help='factor with which the MAD is multiplied')
+    parser.add_argument('--f-corner', type=float, default=F_CORNER, help='corner frequency of the high pass in Hz')
+    parser.add_argument('--processes', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--threads', type=int, default=1, help='OpenMP threads per file')
+    parser.add_argument('--out', default=None, help='folder to save the spikes of every file as npz')
+    args = parser.parse_args()
+
+    results = replay(
+        args.files,
+        args.processes,
+        thresh=args.thresh,
+        thresh_factor=args.thresh_factor,
+        f_corner=args.f_corner,
+        num_threads=args.threads,
+    )
+    if args.out is not None:
+        os.makedirs(args.out, exist_ok=True)
+        for result in results:
+            file_name = os.path.splitext(os.path.basename(result['file']))[0]
+            np.savez(
+                os.path.join(args.out, f'{file_name}_spikes.npz'),
+                spike_ch=result['spike_ch'],
+                spike_pkg=result['spike_pkg'],
+                thresh=result['thresh'])
@@ -6,6 +6,7 @@ import numpy as np
 import multiprocessing as mp
 import threading
 import copy
+import collections
 from ctypes import *
 import os
 import multiprocessing.connection as con
@@ -21,6 +22,7 @@ from Client_config import (
     STIMULATOR_STEP_SETTING, 
     WORD_LENGTH_IN_BYTES, 
 )
+from Latency_probe import probe_stamp, frame_key
 
 def set_stimulus_timing_local(
     stim_duration, 
@@ -170,162 +172,145 @@ def get_command_pos_from_source(
     command = command % 4
     return (mea * 16) + (chip * 4) + command + 1
 
+# command words are handled as little endian uint32, a frame as array of words x WORD_SLOTS
+HEADER_SLOTS = 2 # handshake and timing word in front of the 64 commands of a word
+WORD_SLOTS = WORD_LENGTH_IN_BYTES // 4
+COMMAND_SLOTS = 64
+
+def command_value(reg, d):
+    """write_to_register as little endian uint32"""
+    return int.from_bytes(write_to_register(reg, d), byteorder='little')
+
+# register writes of every stimulated chip: (word after the onset word, command of the chip, register write, 
+# ORed with the electrode mask of the chip)
+STIM_CHIP_PHASES = [
+    (0, 0, command_value(STIMULATION_ON_REG, [0, 0]), True), # stimulation pulse on for the selected electrodes
+    (1, 0, command_value(STIMULATION_POL, [0, 0]), False), # flip polarity
+    (2, 0, command_value(STIMULATION_ON_REG, [0, 0]), False), # stimulation pulse off
+    (2, 1, command_value(48, [0, 0]), True), # start discharge on the selected electrodes
+    (3, 0, command_value(48, [0, 0]), False), # stop discharge
+    (3, 1, command_value(STIMULATION_POL, [0xFF, 0xFF]), False), # switch polarity back
+]
+
+FRAME_CACHE_LEN = 256 # encoded frames kept by the frame compiler
+
+class Frame_compiler:
+    """Encodes a stimulus into its command frame with templates compiled once per position flag.
+    A template holds the empty commands and the onset and offset commands, a stimulus only adds the package ids of
+    the words and the register writes of its chips with a few array operations into a reused frame.
+    The frames of the last cache_len electrode sets are cached, a repeated stimulus only patches the package ids.
+    Args:
+        stimulus_timing: package of every pulse phase relative to the onset, see set_stimulus_timing_local, the pulse
+            of Client_config if None
+        cache_len: number of encoded frames kept with LRU eviction
+    """
+    def __init__(self, stimulus_timing=None, cache_len=FRAME_CACHE_LEN):
+        if stimulus_timing is None:
+            stimulus_timing = set_stimulus_timing_local(STIMULATION_DURATION, DISCHARGE_TIME)
+        stimulus_timing = np.asarray(stimulus_timing, dtype=np.int64)
+        self.cache = collections.OrderedDict()
+        self.cache_len = cache_len
+        self.hits = 0
+        self.misses = 0
+        self.delays = []
+        self.templates = []
+        self.frames = []
+        for position_flag, delay_nums in enumerate(DELAYS_FLAG_DEPENDENT):
+            template = np.frombuffer(
+                EMPTY_COMMAND_WORD * len(delay_nums), dtype='<u4').reshape(len(delay_nums), WORD_SLOTS).copy()
+            # flag 1 is start, 2 is last, 3 is if only one package
+            if position_flag & 1:
+                template[0, HEADER_SLOTS:] = np.frombuffer(ONSET_COMMAND, dtype='<u4')
+            if position_flag & 2:
+                template[-1, HEADER_SLOTS:] = np.frombuffer(OFFSET_COMMAND, dtype='<u4')
+            self.templates.append(template)
+            self.frames.append(np.empty_like(template))
+            self.delays.append(stimulus_timing[delay_nums])
+
+        phases = np.array([(word, command, value, 0xFFFF*masked) for word, command, value, masked in STIM_CHIP_PHASES], dtype=np.int64)
+        self.phase_word = phases[:, 0:1]
+        self.phase_slot = HEADER_SLOTS + phases[:, 1:2]
+        self.phase_value = phases[:, 2:3]
+        self.phase_mask = phases[:, 3:4]
+
+    def encode(self, pkg_id, stim_chips, stim_bits, position_flag):
+        """Command frame of one stimulus.
+        Args:
+            pkg_id: package id of the pulse onset, with the MSB set the commands are executed immediately
+            stim_chips: first command of the chip of every electrode, ELECTRODE_MAPPING.mea2stim_chip
+            stim_bits: bit of every electrode on its chip
+            position_flag: 0 essential pulse, 1 start, 2 end, 3 start and end of a stimulus sequence
+        Returns:
+            bytearray: one word per pulse phase, ready for send_commands_process_USB
+        """
+        stim_chips = np.asarray(stim_chips, dtype=np.int64)
+        stim_bits = np.asarray(stim_bits, dtype=np.int64)
+        key = (position_flag, stim_chips.tobytes(), stim_bits.tobytes())
+        encoded = self.cache.get(key)
+        if encoded is None:
+            self.misses += 1
+            encoded = self.templates[position_flag].copy()
+            chip_masks = np.zeros(COMMAND_SLOTS, dtype=np.int64)
+            np.bitwise_or.at(chip_masks, stim_chips, stim_bits)
+            chips = np.flatnonzero(chip_masks)
+            encoded[(position_flag & 1) + self.phase_word, self.phase_slot + chips] = (
+                self.phase_value | (chip_masks[chips] & self.phase_mask))
+            self.cache[key] = encoded
+            if len(self.cache) > self.cache_len:
+                self.cache.popitem(last=False)
+        else:
+            self.hits += 1
+            self.cache.move_to_end(key)
+
+        frame = self.frames[position_flag]
+        np.copyto(frame, encoded)
+        frame[:, 1] = (pkg_id + self.delays[position_flag]) % MAX_PKG_ID + (pkg_id & 0x80000000)
+        return bytearray(frame)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'cached': len(self.cache)}
+
 def prepare_commands_process(
     command_pipe: con.Connection,
     command_to_send_pipe: con.Connection,
     newest_recv_pkg, 
+    latency_probe=None, 
 ):
     """Send stimulation commands when put on command pipe
     Args:
-        command_pipe: connection to receive stimulation commands
+        command_pipe: connection to receive stimulation commands, (package id, electrodes, position flag) or a frame
+            encoded ahead by Frame_compiler in place of the electrodes, see Stim_period_queue
         command_to_send_pipe: connection to send commands to the USB process
         newest_recv_pkg: shared array to store the latest received package id from the UDP stream
+        latency_probe: Latency_probe stamped with the prepared and queued frames, None for no stamps
     """
-    commands_in_stim = 3 # maximum number of commands executed at the same timepoint (package id)
-
-    stimulus_timing_local = set_stimulus_timing_local(STIMULATION_DURATION, DISCHARGE_TIME)
+    frame_compiler = Frame_compiler()
 
-    #  empty_command_frame = repeat(copy.copy(EMPTY_COMMAND_WORD), MAX_COMMANDS_IN_SEND)
     while True:
-        stim_chips = []
         # receive the start package of the pulse, the active electrodes and the flag whether the on and off pulses should be sent
         pkg_id, electrode_array, position_flag = command_pipe.recv()
-        # print(f"Current delays: {[stimulus_timing_shared[i] for i in range(6)]}")
-        # print(f"Received command from command pipe via server connection {pkg_id}, {electrode_array}, {position_flag}")
+        probe_key = pkg_id
         # if pkg id < 0 set first bit 1 for immediate execution and relative offset
         if pkg_id < 0:
             pkg_id = 0x80000000
             print("Send out package now as negative id")
 
-        commands_in_stim = len(DELAYS_FLAG_DEPENDENT[position_flag]) 
-        command_frame = copy.copy(EMPTY_COMMAND_WORD) * (commands_in_stim) # send all commands executed at a certain timepoint simultaneously to send process
-
-        for pos, delay_num in enumerate(DELAYS_FLAG_DEPENDENT[position_flag]):
-            send_pkg_id = np.uint32((pkg_id + stimulus_timing_local[delay_num]) % MAX_PKG_ID + (pkg_id & 0x80000000))
-            command_frame[
-                pos * WORD_LENGTH_IN_BYTES + 4 : pos * WORD_LENGTH_IN_BYTES + 8
-            ] = bytearray([(send_pkg_id >> (i * 8)) % 256 for i in range(4)])
-            # print(f"Prepared command with pkg_id on pos {pos} at {delay_num}: {send_pkg_id}")
-            # print(f"package execution {pos}, {delay_num}, delay {DELAYS_FULL_COMMAND[delay_num]} id {send_pkg_id}")
-
-        # for i in range(commands_in_stim):
-        #     print(f"Before command fill in Execute ID {i}: {command_frame[i*WORD_LENGTH_IN_BYTES+4:i*WORD_LENGTH_IN_BYTES+8]}")
-
-        # translate mea positions to stimulation encoding in command word
-        electrode_sources = ELECTRODE_MAPPING.mea2stim(electrode_array)
-        # print(f'Received electrodes {electrode_array} and translated into {electrode_sources}')
-
-        # add onset and offset commands to first and last stimulus in sequence
-        # flag 1 is start, 2 is last, 3 is if only one package
-        if position_flag == 1 or position_flag == 3:
-            command_frame[8:WORD_LENGTH_IN_BYTES] = ONSET_COMMAND
-            start_package = 1
+        if isinstance(electrode_array, bytearray): # encoded by the stimulation process ahead of the deadline
+            command_frame = electrode_array
         else:
-            start_package = 0
+            # translate mea positions to stimulation encoding in command word
+            stim_chips, stim_bits = ELECTRODE_MAPPING.mea2stim_chip(electrode_array)
+            command_frame = frame_compiler.encode(pkg_id, stim_chips, stim_bits, position_flag)
 
         if position_flag == 2 or position_flag == 3:
-            command_frame[-WORD_LENGTH_IN_BYTES + 8 :] = OFFSET_COMMAND
-            
             # pass readout the offset
-            newest_recv_pkg[1] = send_pkg_id
+            newest_recv_pkg[1] = frame_key(command_frame[-WORD_LENGTH_IN_BYTES:])
             # pass stimulus on package, TODO: add for number of stimuli slots 
             newest_recv_pkg[2] = np.uint32((pkg_id+1) % MAX_PKG_ID)
-            # print(f"New onset {position_flag}, {send_pkg_id}, {send_pkg_id-pkg_id}, {pos}, {DELAYS_FULL_COMMAND[delay_num]}")
-
-        # for every stimulation electrode activate chip in commands
-        for electrode_source in electrode_sources:
-            mea = electrode_source // 60
-            chip = (electrode_source % 60) // 15
-            el = electrode_source % 15
-            # print(f'Sending to mea {mea} and chip {chip} with el {el}')
-            command_pos = get_command_pos_from_source((mea, chip)) + 1
-
-            stim_el_pos = np.uint16(1 << el)
-            d = [(stim_el_pos >> 8) % 256, stim_el_pos % 256]  # MSB, LSB
-            # print(d)
-            if command_pos not in stim_chips:
-                # Package ----------------------------------------------------------------------------------
-                # write to on register, goes to all electrode
-                package_num = start_package
-                command_frame[
-                    command_pos * 4
-                    + package_num * WORD_LENGTH_IN_BYTES : (command_pos + 1) * 4
-                    + package_num * WORD_LENGTH_IN_BYTES
-                ] = write_to_register(STIMULATION_ON_REG, d)
-
-                # Package ----------------------------------------------------------------------------------
-                package_num = start_package + 1
-                # write to switch polarity register
-                command_frame[
-                    (command_pos) * 4
-                    + package_num * WORD_LENGTH_IN_BYTES : (command_pos + 1) * 4
-                    + package_num * WORD_LENGTH_IN_BYTES
-                ] = write_to_register(STIMULATION_POL, [0x00] * 2)
-
-                # Package ----------------------------------------------------------------------------------
-                package_num = start_package + 2
-                # write to off register
-                command_frame[
-                    (command_pos) * 4
-                    + package_num * WORD_LENGTH_IN_BYTES : (command_pos + 1) * 4
-                    + package_num * WORD_LENGTH_IN_BYTES
-                ] = write_to_register(STIMULATION_ON_REG, [0] * 2)
-                # start discharge on selected electrodes
-                command_frame[
-                    (command_pos + 1) * 4
-                    + package_num * WORD_LENGTH_IN_BYTES : (command_pos + 2) * 4
-                    + package_num * WORD_LENGTH_IN_BYTES
-                ] = write_to_register(
-                    48, d # [0xFF] * 2
-                )  # d for only on stim electrodes and add to bottom else
-
-                # Package ----------------------------------------------------------------------------------
-                package_num = start_package + 3
-                # stop discharge
-                command_frame[
-                    (command_pos) * 4
-                    + package_num * WORD_LENGTH_IN_BYTES : (command_pos + 1) * 4
-                    + package_num * WORD_LENGTH_IN_BYTES
-                ] = write_to_register(48, [0] * 2) 
-                # write to switch polarity register (switch back)
-                command_frame[
-                    (command_pos + 1) * 4
-                    + package_num * WORD_LENGTH_IN_BYTES : (command_pos + 2) * 4
-                    + package_num * WORD_LENGTH_IN_BYTES
-                ] = write_to_register(STIMULATION_POL, [0xFF] * 2)
-
-                # add to list of activated chips
-                stim_chips.append(command_pos)
-            else:
-                package_num = start_package
-                # if chip is already stimulated add missing electrode to stimulation on word
-                d_temp = command_frame[
-                    command_pos * 4
-                    + package_num * WORD_LENGTH_IN_BYTES : command_pos * 4
-                    + 2
-                    + package_num * WORD_LENGTH_IN_BYTES
-                ]
-                d_flipped = [d[1], d[0]]  # now LSB leading
-                command_frame[
-                    command_pos * 4
-                    + package_num * WORD_LENGTH_IN_BYTES : command_pos * 4
-                    + 2
-                    + package_num * WORD_LENGTH_IN_BYTES
-                ] = [d_flipped[i] + d_temp[i] for i in range(2)]
-
-                # # start discharge on selected electrodes
-                package_num = start_package + 2
-                command_frame[
-                    (command_pos + 1) * 4
-                    + package_num * WORD_LENGTH_IN_BYTES : (command_pos + 2) * 4
-                    + package_num * WORD_LENGTH_IN_BYTES
-                ] = write_to_register(
-                    48, [d_flipped[i] + d_temp[i] for i in range(2)] # [0xFF] * 2
-                )  # d for only on stim electrodes
-
-        # if FPGA takes 3 commands or more at once send all, else split package
 
+        probe_stamp(latency_probe, 'commands_prepared', probe_key)
         command_to_send_pipe.send((2, command_frame))
+        probe_stamp(latency_probe, 'frame_queued', frame_key(command_frame))
 
 def send_write_to_register(
     command_to_send_pipe: con.Connection,
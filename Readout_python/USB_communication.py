@@ -2,17 +2,25 @@ from Client_config import (
     VENDOR_ID, 
     PRODUCT_ID, 
     USB_PREAMBLE, 
+    COMMAND_IDS, 
+    USB_BATCH_WORDS, 
+    USB_WINDOW_WORDS, 
     TEST_SERVER, 
     WORD_LENGTH_IN_BYTES, 
+    CLIENT_ADDRESS_PORT, 
 )
 
 import usb.core
 import usb.util
+import socket
 import time
 import numpy as np
 import multiprocessing as mp
 import multiprocessing.connection as con
 import os
+import collections
+
+from Latency_probe import probe_stamp, frame_key
 
 """
 Before you use USB communication make sure your device is reachable:
@@ -27,9 +35,10 @@ sudo nano /etc/udev/rules.d/01-inkube_usb_permissions.rules
 
 """
 
-class USB_com:
-    """Class for the USB communication from the host PC to the FPGA/SoC. This uses USB bulk communication on a single port."""
-    def __init__(self):
+class Libusb_transport:
+    """Bulk transfers to the FPGA/SoC through libusb, the transport of USB_com with the hardware."""
+    def __init__(self, bulk_port=1):
+        self.bulk_port = bulk_port
         self.dev = usb.core.find(idVendor=VENDOR_ID,idProduct=PRODUCT_ID)
         print(f'Connected USB device.')
         try:
@@ -39,8 +48,53 @@ class USB_com:
                 pass
         except Exception as e:
             print(f'Error: failed to connect USB device with {e}')
+
+    def write(self, data: bytearray):
+        """send data to the USB device."""
+        try:
+            self.dev.write(self.bulk_port, data)
+            # print(f'Send USB data: {[hex(int(d)) for d in data[12:min(len(data),32)]]}')
+            # print(f'Just sent {len(data)} bytes: {data}')
+        except Exception as e:
+            print(f'Warning: Failed to send USB data with {e}. Trying to detach kernel...')
+            self.dev.detach_kernel_driver(0)
+            self.write(data)
+
+    def close(self):
+        """Close the USB communication."""
+        try:
+            self.dev.close()
+        except Exception as e:
+            pass
+        self.dev.finalize()
+
+class UDP_transport:
+    """Sends the bulk transfers as UDP datagrams, e.g. to the emulated SoC of Packet_generator.py."""
+    def __init__(self, address=CLIENT_ADDRESS_PORT):
+        self.address = address
+        self.sckt = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        print(f'Connected USB loopback to {address}.')
+
+    def write(self, data: bytearray):
+        """send data to the packet generator."""
+        self.sckt.sendto(data, self.address)
+
+    def close(self):
+        """Close the loopback socket."""
+        self.sckt.close()
+
+class USB_com:
+    """Class for the USB communication from the host PC to the FPGA/SoC. This uses USB bulk communication on a single port.
+    Args:
+        transport: object with write(data) and close(), Libusb_transport if None. UDP_transport and 
+            USB_emulator.Emulated_transport replace the hardware for tests.
+    """
+    def __init__(self, transport=None):
+        if transport is None:
+            transport = Libusb_transport()
+        self.transport = transport
         self.bulk_port = 1
-        self.command_id = {'port': 1, 'intan': 2, 'fpga': 3, 'recv_reset': 4}
+        self.command_id = COMMAND_IDS
         self.command_preamble = {
             'port': self.prepare_preamble('port'), 
             'intan': self.prepare_preamble('intan'), 
@@ -50,14 +104,7 @@ class USB_com:
 
     def write_data(self, data: bytearray):
         """send data to the USB device."""
-        try:
-            self.dev.write(self.bulk_port, data)
-            # print(f'Send USB data: {[hex(int(d)) for d in data[12:min(len(data),32)]]}')
-            # print(f'Just sent {len(data)} bytes: {data}')
-        except Exception as e:
-            print(f'Warning: Failed to send USB data with {e}. Trying to detach kernel...')
-            self.dev.detach_kernel_driver(0)
-            self.write_data(data)
+        self.transport.write(data)
 
     def prepare_preamble(self, command_key):
         """Prepare the preamble for the USB communication."""
@@ -87,17 +134,257 @@ class USB_com:
 
     def close(self):
         """Close the USB communication."""
-        try:
-            self.dev.close()
-        except Exception as e:
-            pass
-        self.dev.finalize()
+        self.transport.close()
+
+class UDP_test_com(USB_com):
+    """Replaces the USB device with the packet generator for load tests, the same bytes are sent via UDP to CLIENT_ADDRESS_PORT."""
+    def __init__(self, address=CLIENT_ADDRESS_PORT):
+        super().__init__(UDP_transport(address))
+
+# commands are sent by priority, in order within a priority: port and reset, stimulation, FPGA register writes
+COMMAND_PRIORITY = {1: 0, 2: 1, 3: 2}
+RESEND_ACK_FACTOR = 4 # the unacknowledged words are resent after this multiple of the mean acknowledgement time
+RESEND_MIN_TIMEOUT = 5e-3 # in s, shortest time without progress of the receive counter before a resend
+GIVE_UP_POLLS = 100 # retry timeouts without progress before the commands in flight are dropped
+
+class USB_command:
+    """Command from the send pipe with its transfers, numbered with the receive counter when it is sent.
+    Args:
+        command_id: 1 port, 2 intan commands, 3 fpga register writes
+        payload: port number, command frames or register writes
+    """
+    def __init__(self, command_id, payload):
+        self.command_id = command_id
+        self.payload = payload
+        self.frames = [payload] if command_id == 2 else []
+        self.words = len(payload) // WORD_LENGTH_IN_BYTES if command_id == 2 else 1
+        self.packages = ()
+        self.command_words = None
+        self.batch_len = 0
+        self.counter_start = 0
+        self.counter_end = 0
+        self.key = 0
+        self.t_written = 0
+
+    def add_frame(self, frame):
+        self.frames.append(frame)
+        self.words += len(frame) // WORD_LENGTH_IN_BYTES
+
+    def number(self, com, counter, batch_words):
+        """Build the transfers with the receive ids following counter, returns the counter after the command"""
+        self.counter_start = counter
+        if self.command_id == 1: # send port, resets the receive counter of the SoC
+            ignore_recv_word = bytearray(np.array([0, 1, 0, 0], dtype=np.uint8).tobytes())
+            recv_package_word = bytearray(np.array([1, 1, 0, 0], dtype=np.uint8).tobytes())
+            self.packages = (
+                (
+                    com.command_preamble['recv_reset'] 
+                    + ignore_recv_word
+                ), 
+                (
+                    com.command_preamble['port']
+                    + recv_package_word
+                    + b'\x08' # special case to set all ports at once
+                    + self.payload.to_bytes(2, byteorder='little')
+                )
+            )
+            self.counter_end = 1 # expect reset + 1 port
+        elif self.command_id == 2:
+            command_words = bytearray().join(self.frames)
+            for i in range(self.words):
+                command_words[i * WORD_LENGTH_IN_BYTES] = (counter + 1 + i) % 256
+                # for non zero in byte 2 the receive id is checked
+                command_words[i * WORD_LENGTH_IN_BYTES + 1] = 0xFF
+            # batch_words commands per transfer, with 1 every command is sent separately
+            self.command_words = command_words
+            self.batch_len = max(batch_words, 1) * WORD_LENGTH_IN_BYTES
+            self.packages = self.packages_from(com, 0)
+            self.counter_end = (counter + self.words) % 256
+        else:
+            recv_package_word = bytearray(np.array([(counter + 1) % 256, 255, 0, 0], dtype=np.uint8).tobytes())
+            self.packages = (com.command_preamble['fpga'] + recv_package_word + self.payload, )
+            self.counter_end = (counter + 1) % 256
+        return self.counter_end
+
+    def packages_from(self, com, word):
+        """Transfers of the stimulation command words from word on"""
+        start = word * WORD_LENGTH_IN_BYTES
+        return tuple(
+            com.command_preamble['intan'] + self.command_words[i:i+self.batch_len]
+            for i in range(start, len(self.command_words), self.batch_len))
+
+    def unacknowledged_packages(self, com, is_rcv_pkg):
+        """Transfers of the words the receive counter has not reached, the received words of a batch are not resent"""
+        received = (is_rcv_pkg - self.counter_start) % 256
+        if self.command_id == 2 and 0 < received < self.words:
+            return self.packages_from(com, received)
+        return self.packages
+
+class USB_transfer_engine:
+    """Sends the commands of the send pipe with a sliding window against the 8 bit receive counter of the SoC.
+    Up to window_words command words are in flight, the receive counter in the data stream acknowledges them in order.
+    The SoC rejects every word whose receive id does not follow its counter, after a lost transfer the counter stops
+    below the words in flight. When it does not move for RESEND_ACK_FACTOR times the mean acknowledgement time (at
+    least RESEND_MIN_TIMEOUT, at most retry_timeout) the words are resent from the first unacknowledged one, the
+    timeout doubles with every resend without progress. Every loss halves the window, every acknowledged window grows
+    it by one word up to window_words. The port command resets the counter and waits for an empty window. The time from the write to the acknowledgement of every command is stamped as usb_ack in Latency_probe.
+    Args:
+        com (USB_com): USB communication object.
+        recv_pkg_id (multiprocessing.connection.Connection): Pipe with the receive counter of the SoC.
+        retry_timeout (float): Longest time in s without progress of the counter before the words are resent.
+        batch_words (int): Stimulation command words per USB bulk transfer, see USB_BATCH_WORDS.
+        window_words (int): Command words in flight, see USB_WINDOW_WORDS.
+        latency_probe (Latency_probe): Probe stamped with the written and acknowledged commands, None for no stamps.
+    """
+    def __init__(
+            self, com, recv_pkg_id, retry_timeout=500e-4, batch_words=USB_BATCH_WORDS, window_words=USB_WINDOW_WORDS, 
+            latency_probe=None):
+        if not 0 < window_words < 128:
+            raise ValueError(f"Window of {window_words} words does not fit the 8 bit receive counter")
+        self.com = com
+        self.recv_pkg_id = recv_pkg_id
+        self.retry_timeout = retry_timeout
+        self.batch_words = batch_words
+        self.window_words = window_words
+        self.window = float(window_words) # current window, halved with every loss and grown by one word per window
+        self.latency_probe = latency_probe
+        self.queues = {priority: collections.deque() for priority in sorted(set(COMMAND_PRIORITY.values()))}
+        self.in_flight = collections.deque()
+        self.words_in_flight = 0
+        self.counter = 0 # receive id of the last word sent
+        self.is_rcv_pkg = 0 # last receive counter of the SoC
+        self.t_progress = 0 # time of the last progress of the receive counter or of the first write into an empty window
+        self.t_resend = 0 # time of the last resend, t_progress before the first
+        self.resends = 0 # resends since the last progress
+        self.ack_time = retry_timeout/RESEND_ACK_FACTOR # mean time from write to acknowledgement
+        self.commands = 0
+
+    def queue(self, command_id, payload):
+        queue = self.queues[COMMAND_PRIORITY[command_id]]
+        # add the stimulation frames to the last queued stimulation command up to batch_words words
+        if (command_id == 2 and queue and queue[-1].words + len(payload) // WORD_LENGTH_IN_BYTES <= self.batch_words):
+            queue[-1].add_frame(payload)
+        else:
+            queue.append(USB_command(command_id, payload))
+
+    def next_command(self):
+        for queue in self.queues.values():
+            if queue:
+                return queue
+        return None
+
+    def dispatch(self):
+        """Write the queued commands while the window has space"""
+        while True:
+            queue = self.next_command()
+            if queue is None:
+                return
+            command = queue[0]
+            if self.in_flight and (command.command_id == 1 or self.words_in_flight + command.words > self.window):
+                return
+            queue.popleft()
+            self.counter = command.number(self.com, self.counter, self.batch_words)
+            self.commands += 1
+            command.key = self.commands*4 + command.command_id
+            command.t_written = time.perf_counter()
+            for send_package in command.packages:
+                self.com.write_data(send_package)
+            probe_stamp(self.latency_probe, 'usb_command_written', command.key)
+            for frame in command.frames:
+                probe_stamp(self.latency_probe, 'frame_written', frame_key(frame))
+            if not self.in_flight:
+                self.t_progress = self.t_resend = command.t_written
+            self.in_flight.append(command)
+            self.words_in_flight += command.words
+
+    def acknowledge(self, is_rcv_pkg):
+        """Remove the commands the receive counter reached, returns True on progress"""
+        progress = (is_rcv_pkg - self.is_rcv_pkg) % 256 < 128 and is_rcv_pkg != self.is_rcv_pkg
+        self.is_rcv_pkg = is_rcv_pkg
+        t_ack = time.perf_counter()
+        while self.in_flight and (is_rcv_pkg - self.in_flight[0].counter_end) % 256 < 128:
+            command = self.in_flight.popleft()
+            self.words_in_flight -= command.words
+            if command.t_written is not None: # the acknowledgement of a resent command is ambiguous and not measured
+                self.ack_time += (t_ack - command.t_written - self.ack_time)/8
+            self.window = min(self.window + command.words/self.window, self.window_words)
+            probe_stamp(self.latency_probe, 'usb_command_acknowledged', command.key)
+            for frame in command.frames:
+                probe_stamp(self.latency_probe, 'frame_acknowledged', frame_key(frame))
+        if progress:
+            self.t_progress = self.t_resend = t_ack
+            self.resends = 0
+        return progress
+
+    def resend_timeout(self):
+        """Time without progress before the next resend"""
+        timeout = max(RESEND_ACK_FACTOR*self.ack_time, RESEND_MIN_TIMEOUT) * 2**self.resends
+        return min(timeout, self.retry_timeout)
+
+    def resend(self):
+        """Resend the words in flight from the first one the receive counter has not reached, or drop them when the
+        counter did not move for GIVE_UP_POLLS retry timeouts"""
+        now = time.perf_counter()
+        if now - self.t_progress > GIVE_UP_POLLS*self.retry_timeout:
+            print('WARNING: Device seems unreachable. Please restart')
+            self.in_flight.clear()
+            self.words_in_flight = 0
+            self.counter = self.is_rcv_pkg
+            self.resends = 0
+            return
+        if not self.resends:
+            # the SoC rejects all words after a lost one, a smaller window wastes less transfers on a lossy link
+            self.window = max(self.window/2, 1.)
+        for n, command in enumerate(self.in_flight):
+            packages = command.unacknowledged_packages(self.com, self.is_rcv_pkg) if n == 0 else command.packages
+            for send_package in packages:
+                self.com.write_data(send_package)
+            command.t_written = None
+        self.resends += 1
+        self.t_resend = now
+        if self.resends > 1:
+            print(
+                f"WARNING: Resending {self.words_in_flight} words for the {self.resends}. time, recv pkg still is {self.is_rcv_pkg} - waiting for {self.in_flight[0].counter_end}"
+            )
+
+    def run(self, command_to_send_pipe):
+        """Send the commands of the pipe until its sending end is closed"""
+        while True:
+            self.dispatch()
+            timeout = None
+            if self.in_flight:
+                timeout = max(self.t_resend + self.resend_timeout() - time.perf_counter(), 0)
+            con.wait([command_to_send_pipe, self.recv_pkg_id], timeout)
+
+            # obtain the recv package id from the FPGA via UDP and then through the pipe from the readout process
+            while self.recv_pkg_id.poll():
+                self.acknowledge(int.from_bytes(self.recv_pkg_id.recv_bytes(1), byteorder='little'))
+            if self.in_flight and time.perf_counter() - self.t_resend >= self.resend_timeout():
+                self.resend()
+            # Receive prepared commands from Pipe
+            # command id indicates the type of command
+            # 1: send port, no recv package id, not via pipe
+            # 2: send intan commands, with recv package id (handshake), directly forwarded to ASIC by the FPGA
+            # 3: send fpga commands, with recv package id (handshake), these are register writes directly on the SoC for for example pumping
+            while command_to_send_pipe.poll():
+                try:
+                    command_id, command_to_send = command_to_send_pipe.recv()
+                except EOFError:
+                    print(f'PID:{os.getpid()} - Command pipe closed, stopping USB command transmit.')
+                    return
+                if command_id == 3 and len(command_to_send) > 500:
+                    print('WARNING: Too many register writes in command')
+                    continue
+                self.queue(command_id, command_to_send)
 
 def send_commands_process_USB(
     com: USB_com, 
     command_to_send_pipe: con.Connection, 
     recv_pkg_id: con.Connection,
     retry_timeout=500e-4,
+    batch_words=USB_BATCH_WORDS,
+    window_words=USB_WINDOW_WORDS,
+    latency_probe=None,
 ):
     """Process to send commands to the USB device.
     Args:
@@ -105,100 +392,16 @@ def send_commands_process_USB(
         command_to_send_pipe (multiprocessing.connection.Connection): Pipe to receive commands to send to the USB device.
         recv_pkg_id (multiprocessing.connection.Connection): Pipe to receive the incrementing counter of received data on the SoC which makes sure no data is dropped.
         retry_timeout (float, optional): Timeout for the retry. Defaults to 500e-4.
+        batch_words (int, optional): Stimulation command words per USB bulk transfer. Above 1 the queued stimulation frames 
+            are packed into the same transfers and acknowledged with one handshake. Defaults to USB_BATCH_WORDS.
+        window_words (int, optional): Command words in flight, see USB_transfer_engine. Defaults to USB_WINDOW_WORDS.
+        latency_probe (Latency_probe, optional): Probe stamped with the USB writes and acknowledgements. Defaults to None.
     """
     print(f'PID:{os.getpid()} - Started USB command transmit process.')
-    expected_rcv_pkg = 0 # increase to one because port has been send as 1
-    is_rcv_pkg = 0
 
     time.sleep(.1)
-    send_package_tuple = ()
-    if not TEST_SERVER:
-        while True:
-            # Receive prepared commands from Pipe
-            command_id, command_to_send = command_to_send_pipe.recv()
-            # command id indicates the type of command
-            # 1: send port, no recv package id, not via pipe
-            # 2: send intan commands, with recv package id (handshake), directly forwarded to ASIC by the FPGA
-            # 3: send fpga commands, with recv package id (handshake), these are register writes directly on the SoC for for example pumping
-            # 4: send reset command, with recv package id (handshake), not via pipe
-
-            if command_id == 1: # send port, no recv package id, not via pipe
-                ignore_recv_word = bytearray(np.array([0, 1, 0, 0], dtype=np.uint8).tobytes())
-                recv_package_word = bytearray(np.array([1, 1, 0, 0], dtype=np.uint8).tobytes())
-                send_package_tuple = (
-                    (
-                        com.command_preamble['recv_reset'] 
-                        + ignore_recv_word
-                    ), 
-                    (
-                        com.command_preamble['port']
-                        + recv_package_word
-                        + b'\x08' # special case to set all ports at once
-                        + command_to_send.to_bytes(2, byteorder='little')
-                    )
-                )
-                expected_rcv_pkg = 1 # expect reset + 1 port
-
-            if command_id == 2:
-                num_commands_in_frame = len(command_to_send) // WORD_LENGTH_IN_BYTES
-
-                # send commands separately
-                for i in range(num_commands_in_frame):
-                    command_to_send[i * WORD_LENGTH_IN_BYTES] = (
-                        is_rcv_pkg + 1 + i
-                    ) % 256
-                    # for non zero in byte 2 the receive id is checked
-                    command_to_send[i * WORD_LENGTH_IN_BYTES + 1] = 0xFF
-                                
-                expected_rcv_pkg = (expected_rcv_pkg + num_commands_in_frame) % 256
-                # Reset counter how often package has been sent
-                
-                send_package_tuple = ()
-                for i in range(num_commands_in_frame):
-                    send_package_tuple += (
-                        com.command_preamble['intan']+command_to_send[i*WORD_LENGTH_IN_BYTES:(i+1)*WORD_LENGTH_IN_BYTES], 
-                    )
-
-            elif command_id == 3:
-                if len(command_to_send) > 500:
-                    print('WARNING: Too many register writes in command')
-                    continue
-                else:
-                    expected_rcv_pkg = (expected_rcv_pkg + 1) % 256
-                    
-                    recv_package_word = bytearray(np.array([expected_rcv_pkg, 255, 0, 0], dtype=np.uint8).tobytes())
-                    send_package_tuple = (
-                            com.command_preamble['fpga']
-                            + recv_package_word 
-                            + command_to_send, 
-                        )
-
-            # send out data
-            counter = 1
-            
-            for send_package in send_package_tuple:
-                com.write_data(send_package)
-            while counter:
-                # obtain the recv package id from the FPGA via UDP and then through the pipe from the readout process          
-                if recv_pkg_id.poll(retry_timeout):
-                    is_rcv_pkg = int.from_bytes(recv_pkg_id.recv_bytes(1), byteorder='little')
-                    if expected_rcv_pkg == is_rcv_pkg:
-                        # when the recv package number in the UDP is correct all data arrived
-                        counter = 0
-                        # print(f'Done sending command {command_id} with {len(send_package)} Bytes')
-                    else:
-                        counter += 1
-                else:
-                    counter += 1
-                    if not counter % 10:
-                        for send_package in send_package_tuple:
-                            com.write_data(send_package)
-                        print(
-                            f"WARNING: Resending as counter is {counter}, recv pkg still is {is_rcv_pkg} - waiting for {expected_rcv_pkg}"
-                        )
-                    if counter > 100:
-                        print('WARNING: Device seems unreachable. Please restart')
-                        break
+    if com is not None:
+        USB_transfer_engine(com, recv_pkg_id, retry_timeout, batch_words, window_words, latency_probe).run(command_to_send_pipe)
 
     else:
         # when debugging with test server, just print the commands in hex that would be sent via USB
@@ -0,0 +1,140 @@
+"""
+Software stand-in for the SoC side of the USB command link, used without hardware.
+Emulated_SoC parses the bulk transfers written by USB_com (USB_PREAMBLE + command id), checks the receive ids of the
+command words and keeps the 8 bit receive counter that the SoC returns in byte 1 of every UDP package.
+Packet_generator.py puts the counter into its data stream, Emulated_transport answers in-process through the same
+pipe the readout uses, so send_commands_process_USB can be run with transfer loss and delay but without a readout.
+"""
+import time
+import random
+import threading
+import collections
+
+from Client_config import (
+    USB_PREAMBLE,
+    COMMAND_IDS, 
+    WORD_LENGTH_IN_BYTES,
+)
+
+PREAMBLE_LEN = 8
+
+class Emulated_SoC:
+    """Receive side of the SoC: preamble check, receive counter and receive id check.
+    A command word with a non zero byte 1 is only executed if its receive id in byte 0 follows the counter,
+    a resent word that was already received is rejected as on the SoC.
+    Args:
+        on_command: called with the command id and the word of every executed command, e.g. to record them in tests
+    """
+    def __init__(self, on_command=None):
+        self.on_command = on_command
+        self.recv_counter = 0
+        self.port = None
+        self.lock = threading.Lock()
+        self.transfers = 0
+        self.executed = 0
+        self.rejected = 0
+        self.invalid = 0
+
+    def accept(self, recv_id, checked):
+        """Count a received word if its receive id follows the counter"""
+        if checked and recv_id != (self.recv_counter + 1) % 256:
+            self.rejected += 1
+            return False
+        self.recv_counter = (self.recv_counter + 1) % 256
+        self.executed += 1
+        return True
+
+    def handle(self, data: bytes):
+        """Apply a bulk transfer and return the receive counter afterwards"""
+        with self.lock:
+            self.transfers += 1
+            if len(data) < PREAMBLE_LEN or int.from_bytes(data[:PREAMBLE_LEN-1], byteorder='big') != USB_PREAMBLE >> 8:
+                self.invalid += 1
+                print(f'Warning: Emulated SoC received a command with an invalid preamble')
+                return self.recv_counter
+            command_id = data[PREAMBLE_LEN-1]
+            body = data[PREAMBLE_LEN:]
+            if command_id == COMMAND_IDS['recv_reset']:
+                self.recv_counter = 0
+            elif command_id == COMMAND_IDS['intan']: # every stimulation command word of a batched transfer is counted
+                for pos in range(0, len(body) - WORD_LENGTH_IN_BYTES + 1, WORD_LENGTH_IN_BYTES):
+                    word = body[pos:pos+WORD_LENGTH_IN_BYTES]
+                    if self.accept(word[0], word[1]) and self.on_command is not None:
+                        self.on_command(command_id, bytes(word))
+            elif len(body) >= 4:
+                if command_id == COMMAND_IDS['port'] and len(body) >= 7:
+                    self.port = int.from_bytes(body[5:7], byteorder='little')
+                if self.accept(body[0], body[1]) and self.on_command is not None:
+                    self.on_command(command_id, bytes(body))
+            else:
+                self.invalid += 1
+            return self.recv_counter
+
+    def stats(self):
+        return {
+            'transfers': self.transfers,
+            'executed': self.executed,
+            'rejected': self.rejected,
+            'invalid': self.invalid,
+            'recv_counter': self.recv_counter,
+        }
+
+class Emulated_transport:
+    """Transport of USB_com that writes into an Emulated_SoC in the same process.
+    The receive counter is sent on counter_pipe like the readout does (send_bytes of one byte when it changes).
+    With a delay the counters are sent in order by one thread, started with the first delayed counter.
+    Args:
+        device: Emulated_SoC
+        counter_pipe: sending end of the receive counter pipe of send_commands_process_USB
+        delay: seconds until the counter is returned, the latency of the UDP stream and the readout
+        loss: probability that a transfer is lost
+        seed: seed of the loss
+    """
+    def __init__(self, device, counter_pipe, delay=0., loss=0., seed=0):
+        self.device = device
+        self.counter_pipe = counter_pipe
+        self.delay = delay
+        self.loss = loss
+        self.rng = random.Random(seed)
+        self.counter = device.recv_counter
+        self.lost = 0
+        self.delayed = collections.deque()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def write(self, data: bytearray):
+        if self.loss and self.rng.random() < self.loss:
+            self.lost += 1
+            return
+        counter = self.device.handle(bytes(data))
+        if counter != self.counter:
+            self.counter = counter
+            if self.delay:
+                self.send_delayed(counter)
+            else:
+                self.counter_pipe.send_bytes(bytes([counter]))
+
+    def send_delayed(self, counter):
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.delay_thread, daemon=True)
+                self.thread.start()
+            self.delayed.append((time.perf_counter() + self.delay, counter))
+            self.condition.notify()
+
+    def delay_thread(self):
+        """Send the delayed counters when they are due"""
+        while True:
+            with self.condition:
+                while not self.delayed:
+                    self.condition.wait()
+                t_due, counter = self.delayed[0]
+                wait_time = t_due - time.perf_counter()
+                if wait_time > 0:
+                    self.condition.wait(wait_time)
+                    continue
+                self.delayed.popleft()
+            self.counter_pipe.send_bytes(bytes([counter]))
+
+    def close(self):
+        pass
@@ -5,7 +5,11 @@ The `receive_process` function receives UDP data, initializes the readout proces
 The `connect_client` function creates a socket for UDP receive and sends an empty package to whitelist the firewall.
 The `full_readout` function performs the full readout process, including data filtering, spike detection
 """
-from cpython.mem cimport PyMem_Malloc
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+from libc.errno cimport errno, EINTR
+from libc.string cimport memset, memcpy
+from posix.time cimport timespec
+from posix.unistd cimport write as fd_write
 
 import os
 import numpy as pnp # this is the Python library
@@ -14,7 +18,11 @@ import time
 import cython
 import multiprocessing as mp
 import threading
+import select
 np.import_array()
+
+from Spike_matrix import Spike_matrix, UNMAPPED_CELL
+from Spike_stream import encode_chunk
 # from cython.cimports.cpython import array
 from cpython.buffer cimport Py_buffer
 from cpython.buffer cimport PyObject_GetBuffer
@@ -60,6 +68,39 @@ DEF SAVE_SPIKE_SHAPES = 0 # also for plotting activate this
 DEF USE_SNEO = 0 # use the smoothed non-linear energy operator for spike detection
 DEF ONLY_STIM = 0 # skip the readout and spike detection
 
+DEF PKG_LEN = 2048 # size of one UDP package from the FPGA in bytes
+DEF PKG_TIME_POS = PKG_LEN-8 # send time of synthetic packages, see Latency_probe
+DEF USE_RECVMMSG = 1 # receive several UDP packages per syscall (linux only)
+DEF RECV_BATCH = 64 # maximum number of packages fetched with one recvmmsg call, ~3.7 ms of data
+DEF READOUT_THREADS = 1 # OpenMP threads for the channel loop, one thread detects a block at 12x (SNEO) to 22x real time
+# so more threads only cost a fork and join per block and cores of the other processes, raise it if
+# 'python Benchmark_detection.py --threads 1' falls near 1x real time on the readout PC
+DEF SIMD_WIDTH = 16 # channel slices of threads are aligned to 16 floats, one 64 byte cache line and a multiple of every vector width
+
+DEF SPIKE_RING_WRITE = 0 # header position of the number of records written by the readout
+DEF SPIKE_RING_READ = 1 # header position of the number of records consumed by the spike processor
+DEF SPIKE_RING_OVERRUN = 2 # header position of the number of spikes dropped because the ring was full
+DEF SPIKE_RING_WAITING = 3 # header position of the flag set while the spike processor waits for the wakeup event
+DEF SPIKE_RING_DETECTED = 4 # header position of the newest package whose spikes are all in the ring, or'ed with SPIKE_RING_PKG_SET
+DEF SPIKE_RING_WAKE_AT = 5 # header position of the package the waiting spike processor is woken at, or'ed with SPIKE_RING_PKG_SET, 0 for none
+DEF SPIKE_RING_PKG_SET = 0x40000000 # above every package id, marks a package id in the header as set as package 0 is valid
+DEF SPIKE_POLL_INTERVAL = 0.0002 # in s, sleep of the spike processor when the ring is empty and no wakeup event is used
+DEF SPIKE_WAIT_TIMEOUT = 0.01 # in s, longest wait for spikes, mode changes (store_event) are seen after at most this time
+
+DEF PKG_CLOCK_ID = 0 # position of the newest received package id in the package clock, see Package_clock
+DEF PKG_CLOCK_SEQ = 1 # position of the number of published blocks, the futex word the consumers sleep on
+DEF PKG_CLOCK_WAITERS = 2 # position of the number of consumers sleeping on the futex word
+DEF PKG_CLOCK_POLL_INTERVAL = 0.0002 # in s, sleep of a package clock consumer where futex is not available
+
+DEF NOISE_MAX_STEP = 0.0625 # first step of the running noise estimate, the step then decays to NOISE_TRACK_STEP
+DEF NOISE_STEP_DECAY = 64 # samples in which the inverse step grows by one, a few seconds of fast settling after start
+DEF NOISE_FLOOR = 1e-3 # lower limit of the running median, keeps the multiplicative steps away from zero
+
+DEF RECORD_RING_WRITE = 0 # header position of the number of samples written to the record ring
+DEF RECORD_STATUS_POS = 4 # byte offset of the status words in a record, the package id is at 0
+DEF RECORD_RAW_POS = RECORD_STATUS_POS + 4*STATUS_LEN # byte offset of the raw channel data in a record
+DEF RECORD_FILTERED_POS = RECORD_RAW_POS + 2*CHANNELS # byte offset of the filtered channel data in a record
+
 ctypedef np.uint16_t BUFF_TYPE
 
 cdef np.float32_t[FILT_LEN] coeff_a
@@ -69,16 +110,84 @@ cdef np.int8_t BLIND_DURATION
 cdef np.int8_t DETECT_DURATION
 cdef np.float32_t THRESH_FACTOR
 cdef np.float32_t MIN_THRESH
+cdef np.float32_t NOISE_TRACK_STEP = 1e-4
 cdef np.float32_t FS = 20_000
 cdef np.int16_t MAX_VAL = 1000
 cdef np.uint8_t[STATUS_LEN] STATUS_POS
 
+cdef extern from "<sys/uio.h>" nogil:
+    cdef struct iovec:
+        void* iov_base
+        size_t iov_len
+
+cdef extern from "<sys/socket.h>" nogil:
+    ctypedef unsigned int socklen_t
+    cdef struct msghdr:
+        void* msg_name
+        socklen_t msg_namelen
+        iovec* msg_iov
+        size_t msg_iovlen
+        void* msg_control
+        size_t msg_controllen
+        int msg_flags
+    cdef struct mmsghdr:
+        msghdr msg_hdr
+        unsigned int msg_len
+    int recvmmsg(int sockfd, mmsghdr* msgvec, unsigned int vlen, int flags, timespec* timeout)
+    enum: MSG_WAITFORONE
+
 cdef extern from "math.h" nogil:
     cdef np.float32_t exp(np.float32_t x)
     cdef np.float32_t abs(np.float32_t x)
     cdef np.float32_t log(np.float32_t x)
     cdef np.float32_t cos(np.float32_t x)
     cdef np.float32_t pow(np.float32_t x, np.float32_t y)
+    cdef np.float32_t sqrt(np.float32_t x)
+    cdef np.float32_t fabsf(np.float32_t x)
+
+# acquire/release access to the spike ring counters, shared by the readout and the spike processor
+cdef extern from *:
+    """
+    static inline npy_uint64 ring_load_acquire(npy_uint64* p) { return __atomic_load_n(p, __ATOMIC_ACQUIRE); }
+    static inline void ring_store_release(npy_uint64* p, npy_uint64 v) { __atomic_store_n(p, v, __ATOMIC_RELEASE); }
+    static inline void seq_fence_release(void) { __atomic_thread_fence(__ATOMIC_RELEASE); }
+    static inline void seq_fence_acquire(void) { __atomic_thread_fence(__ATOMIC_ACQUIRE); }
+    static inline void ring_fence_full(void) { __atomic_thread_fence(__ATOMIC_SEQ_CST); }
+    static inline npy_uint64 ring_exchange(npy_uint64* p, npy_uint64 v) { return __atomic_exchange_n(p, v, __ATOMIC_SEQ_CST); }
+    """
+    np.uint64_t ring_load_acquire(np.uint64_t* p) nogil
+    void ring_store_release(np.uint64_t* p, np.uint64_t v) nogil
+    void seq_fence_release() nogil
+    void seq_fence_acquire() nogil
+    void ring_fence_full() nogil
+    np.uint64_t ring_exchange(np.uint64_t* p, np.uint64_t v) nogil
+
+# package clock words and the futex the consumers sleep on until the readout publishes the next block
+cdef extern from *:
+    """
+    #ifdef __linux__
+    #include <linux/futex.h>
+    #include <sys/syscall.h>
+    #include <unistd.h>
+    #include <limits.h>
+    static inline int futex_wait(npy_uint32* p, npy_uint32 expected, const struct timespec* timeout) { return (int)syscall(SYS_futex, p, FUTEX_WAIT, expected, timeout, NULL, 0); }
+    static inline void futex_wake_all(npy_uint32* p) { syscall(SYS_futex, p, FUTEX_WAKE, INT_MAX, NULL, NULL, 0); }
+    #define HAVE_FUTEX 1
+    #else
+    static inline int futex_wait(npy_uint32* p, npy_uint32 expected, const struct timespec* timeout) { return -1; }
+    static inline void futex_wake_all(npy_uint32* p) { }
+    #define HAVE_FUTEX 0
+    #endif
+    static inline npy_uint32 clock_load_acquire(npy_uint32* p) { return __atomic_load_n(p, __ATOMIC_ACQUIRE); }
+    static inline void clock_store_release(npy_uint32* p, npy_uint32 v) { __atomic_store_n(p, v, __ATOMIC_RELEASE); }
+    static inline npy_uint32 clock_add(npy_uint32* p, npy_int32 v) { return __atomic_add_fetch(p, v, __ATOMIC_SEQ_CST); }
+    """
+    int futex_wait(np.uint32_t* p, np.uint32_t expected, const timespec* timeout) nogil
+    void futex_wake_all(np.uint32_t* p) nogil
+    enum: HAVE_FUTEX
+    np.uint32_t clock_load_acquire(np.uint32_t* p) nogil
+    void clock_store_release(np.uint32_t* p, np.uint32_t v) nogil
+    np.uint32_t clock_add(np.uint32_t* p, np.int32_t v) nogil
 
 cdef ch_id_to_mea(np.uint8_t id):
     cdef np.uint8_t[3] loc
@@ -96,7 +205,8 @@ def set_constants(
         detect_dur, 
         th, 
         status_pos_set, 
-        min_spike_thresh):
+        min_spike_thresh, 
+        noise_track_time=1.):
     global MAX_PKG_ID
     if MAX_PKG_ID == 0:
         global coeff_a
@@ -120,16 +230,120 @@ def set_constants(
 
         global MIN_THRESH
         MIN_THRESH = <np.float32_t>min_spike_thresh
+        global NOISE_TRACK_STEP
+        NOISE_TRACK_STEP = <np.float32_t>(1/(fs*noise_track_time))
         # print("Initialised constants")
         # print(f"Constant blind: {BLIND_DURATION}, detect: {DETECT_DURATION}, filt_a {coeff_a}, filt_a {coeff_b} and max_pkg {MAX_PKG_ID}")
 
+# package time, the package ids count up to MAX_PKG_ID and wrap around to 0
+# ids are compared by their signed distance the shorter way around the counter, ~45 s in both directions
+
+cdef inline np.int32_t c_pkg_diff(np.uint32_t a, np.uint32_t b) noexcept nogil:
+    """signed distance a - b in packages, in [-MAX_PKG_ID/2, MAX_PKG_ID/2), a and b below MAX_PKG_ID"""
+    cdef np.int32_t d = <np.int32_t>a - <np.int32_t>b
+    if d >= MAX_PKG_ID >> 1:
+        d -= MAX_PKG_ID
+    elif d < -(MAX_PKG_ID >> 1):
+        d += MAX_PKG_ID
+    return d
+
+@cython.cdivision(True)
+cdef inline np.uint32_t c_pkg_add(np.uint32_t a, np.int64_t n) noexcept nogil:
+    """package id n packages after a, n can be negative"""
+    cdef np.int64_t s = (<np.int64_t>a + n) % MAX_PKG_ID
+    if s < 0:
+        s += MAX_PKG_ID
+    return <np.uint32_t>s
+
+cdef inline np.int8_t c_segment_position(np.uint32_t pkg, np.uint32_t start, np.uint32_t end) noexcept nogil:
+    """-1 if pkg is before the segment [start, end], 0 inside and 1 after it
+    a start above MAX_PKG_ID marks no segment (every package is after it), an end above MAX_PKG_ID an open segment"""
+    if start >= <np.uint32_t>MAX_PKG_ID:
+        return 1
+    if end >= <np.uint32_t>MAX_PKG_ID:
+        return 0
+    cdef np.int32_t d = c_pkg_diff(pkg, start)
+    if d < 0:
+        return -1
+    if d > c_pkg_diff(end, start):
+        return 1
+    return 0
+
+def pkg_diff(np.int64_t a, np.int64_t b):
+    """Signed distance a - b in packages with wraparound at MAX_PKG_ID, positive if a is after b"""
+    return c_pkg_diff(c_pkg_add(0, a), c_pkg_add(0, b))
+
+def pkg_add(np.int64_t a, np.int64_t n):
+    """Package id n packages after a with wraparound at MAX_PKG_ID"""
+    return c_pkg_add(c_pkg_add(0, a), n)
+
+def pkg_reached(np.int64_t current, np.int64_t target):
+    """True if current is at or after target"""
+    return c_pkg_diff(c_pkg_add(0, current), c_pkg_add(0, target)) >= 0
+
+def segment_position(np.uint32_t pkg, np.uint32_t start, np.uint32_t end):
+    """-1 if pkg is before the segment [start, end], 0 inside and 1 after it, see segment_ids of c_spike_poll_process"""
+    return c_segment_position(pkg, start, end)
+
+cdef class Segment_schedule:
+    """Closed loop segments every cycle packages, the current segment is [start, end] with end = start + length.
+    The boundaries of the current and the next segment are computed once per segment instead of per comparison.
+    Args:
+        start: package id of the first segment start
+        cycle: packages between two segment starts, STIMULUS_CYCLE
+        length: packages of a segment after its start, RESPONSE_IMPORTANT_PERIOD
+    """
+    cdef readonly np.uint32_t start
+    cdef readonly np.uint32_t end
+    cdef readonly np.uint32_t next_start
+    cdef readonly np.uint32_t cycle
+    cdef readonly np.uint32_t length
+
+    def __cinit__(self, np.int64_t start, np.uint32_t cycle, np.uint32_t length):
+        if MAX_PKG_ID == 0:
+            raise RuntimeError('Constants are not set, call set_constants first')
+        if not 0 < cycle < MAX_PKG_ID >> 1:
+            raise ValueError(f'Segment cycle must be between 0 and {MAX_PKG_ID >> 1} packages, got {cycle}')
+        self.cycle = cycle
+        self.length = length
+        self.set_start(c_pkg_add(0, start))
+
+    cdef void set_start(self, np.uint32_t start) noexcept:
+        self.start = start
+        self.end = c_pkg_add(start, self.length)
+        self.next_start = c_pkg_add(start, self.cycle)
+
+    def advance(self, np.uint32_t segments=1):
+        """Move on by a number of segments"""
+        self.set_start(c_pkg_add(self.start, <np.int64_t>segments*self.cycle))
+
+    def skip_to(self, np.uint32_t current, np.uint32_t min_delay):
+        """Skip the segments that start less than min_delay packages after current.
+        Returns:
+            number of skipped segments
+        """
+        cdef np.int32_t lag = c_pkg_diff(current, c_pkg_add(self.start, -<np.int64_t>min_delay))
+        cdef np.uint32_t skipped = 0
+        if lag > 0:
+            skipped = (lag + self.cycle - 1) // self.cycle
+            self.advance(skipped)
+        return skipped
+
+    def position(self, np.uint32_t pkg):
+        """-1 if pkg is before the current segment, 0 inside and 1 after it"""
+        return c_segment_position(pkg, self.start, self.end)
+
+    def __repr__(self):
+        return f'Segment_schedule(start={self.start}, end={self.end}, cycle={self.cycle})'
+
 # cdef short temperatures_stream[1024*(1+4)]
 
 def receive_process(
         UDP_recv_port, 
         PC_IP, 
         CLIENT_RECV_PORT, 
-        spike_pipe_a_write: mp.connection.Connection, 
+        spike_ring_records, 
+        spike_ring_seq, 
         plot_shared, 
         plot_signal, 
         plot_spike_wavelet, 
@@ -141,7 +355,16 @@ def receive_process(
         status_stream, 
         temp_stream, 
         current_pkg_id, 
-        plot_raw=0):
+        plot_raw=0, 
+        record_ring_data=None, 
+        record_ring_seq=None, 
+        record_filtered=0, 
+        noise_stats=None, 
+        thresh_seq=None, 
+        auto_thresh=None, 
+        spike_event_fd=None, 
+        latency_probe=None, 
+        pkg_clock=None):
 
     print(f'PID:{os.getpid()} - Started UDP data receive and process process.')
 
@@ -156,7 +379,8 @@ def receive_process(
     full_readout(
         sckt, 
         2048, 
-        spike_pipe_a_write,
+        spike_ring_records, 
+        spike_ring_seq, 
         plot_shared, 
         plot_signal, 
         plot_spike_wavelet, 
@@ -168,7 +392,16 @@ def receive_process(
         status_stream, 
         temp_stream, 
         current_pkg_id, 
-        do_plot_raw)
+        do_plot_raw, 
+        record_ring_data, 
+        record_ring_seq, 
+        record_filtered, 
+        noise_stats, 
+        thresh_seq, 
+        auto_thresh, 
+        spike_event_fd, 
+        latency_probe, 
+        pkg_clock)
 
 cdef connect_client(UDP_recv_port, PC_IP, CLIENT_RECV_PORT, timeout):
     new_socket = _socket.socket(family=AF_INET, type=SOCK_DGRAM)
@@ -187,12 +420,697 @@ cdef connect_client(UDP_recv_port, PC_IP, CLIENT_RECV_PORT, timeout):
 
     return new_socket
 
+cdef struct readout_state:
+    # filter coefficients, copied from the module constants when the state is initialised
+    np.float32_t coeff_a[FILT_LEN]
+    np.float32_t coeff_b[FILT_LEN]
+    np.float32_t SG[5]
+    np.float32_t BW[BW_LEN]
+    np.int32_t blind_duration
+    np.int32_t detect_duration
+
+    # ring buffers of the raw and filtered data stream, [sample][channel]
+    np.int16_t data_stream[BUFF_LEN][CHANNELS]
+    np.float32_t filtered_hp[N_LEN][CHANNELS]
+    np.float32_t filtered_out[N_LEN][CHANNELS]
+    np.float32_t kNEO[N_LEN+K_SNEO][CHANNELS]
+    np.float32_t SNEO[N_LEN+K_SNEO][CHANNELS]
+
+    # spike detection state machine, 32 bit to match the float lanes
+    np.int32_t blind_electrodes_array[CHANNELS]
+    np.float32_t max_peak[CHANNELS]
+    np.float32_t local_thresh[CHANNELS]
+    np.uint8_t spike_wavelet_pos[CHANNELS]
+    np.uint8_t spike_wavelet_id[CHANNELS]
+    np.uint8_t spike_detect[RECV_BATCH][CHANNELS]
+    np.int32_t plot_mask[CHANNELS]
+    np.uint8_t wavelet_event[CHANNELS]
+
+    # running noise estimate, median of the absolute detection signal and mean square of the filtered signal in uV^2
+    np.float32_t noise_median[CHANNELS]
+    np.float32_t noise_ms[CHANNELS]
+    np.float32_t track_step
+    np.float32_t track_step_min
+
+    # ring positions of the first sample of the next block
+    np.uint16_t loc
+    np.uint8_t out_loc
+    np.uint8_t sneo_loc
+    np.uint32_t plot_loc
+    np.uint32_t plot_len
+
+cdef struct readout_output:
+    # shared plot buffers, NULL if the block is not plotted (offline runs)
+    np.float32_t* plot_signal
+    np.float32_t* plot_shared
+    np.uint8_t* plot_spikes
+    np.float32_t* spike_wavelet
+    np.uint32_t* spike_wavelet_id
+    # package id of every sample in the block
+    np.uint32_t* pkg_ids
+    np.uint8_t do_plot_raw
+
+cdef readout_state* new_readout_state(np.uint32_t plot_len):
+    """allocate and reset filter and detection state for all channels"""
+    global coeff_a
+    global coeff_b
+    global BLIND_DURATION
+    global DETECT_DURATION
+
+    global MIN_THRESH
+    global THRESH_FACTOR
+    global NOISE_TRACK_STEP
+
+    cdef readout_state* st = <readout_state*>PyMem_Malloc(sizeof(readout_state))
+    if st == NULL:
+        raise MemoryError('Could not allocate readout state')
+    memset(st, 0, sizeof(readout_state))
+
+    cdef np.float32_t[5] SG = [-0.08571429, 0.34285714, 0.48571429, 0.34285714, -0.08571429]
+    cdef int n = 0
+    cdef int ch = 0
+
+    assert N_LEN >= FILT_LEN
+    assert N_LEN >= 5
+
+    for n in range(FILT_LEN):
+        st.coeff_a[n] = coeff_a[n]
+        st.coeff_b[n] = coeff_b[n]
+    for n in range(5):
+        st.SG[n] = SG[n]
+    for n in range(BW_LEN):
+        if n <= BW_LEN/2:
+            st.BW[n] = 2*n/BW_LEN
+        else:
+            st.BW[n] = 2-2*n/BW_LEN
+    st.blind_duration = BLIND_DURATION
+    st.detect_duration = DETECT_DURATION
+    st.track_step = NOISE_MAX_STEP
+    st.track_step_min = NOISE_TRACK_STEP
+
+    for ch in range(CHANNELS):
+        st.blind_electrodes_array[ch] = BLIND_DURATION
+        st.local_thresh[ch] = 1e30
+        st.spike_wavelet_pos[ch] = SPIKE_WAVELET_LEN
+        # start at twice the lower limit as update_MAD did
+        st.noise_median[ch] = 2*MIN_THRESH/THRESH_FACTOR if THRESH_FACTOR else 1.
+
+    st.plot_len = plot_len
+    return st
+
+cdef inline np.float32_t next_track_step(readout_state* st, np.float32_t step) noexcept nogil:
+    """step of the running noise estimate for the next sample, harmonic decay after start then constant"""
+    step = step/(1+step/NOISE_STEP_DECAY)
+    return step if step > st.track_step_min else st.track_step_min
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void detect_channels(
+        readout_state* st,
+        readout_output* out,
+        np.uint8_t* packets,
+        int nb,
+        int c0,
+        int c1) noexcept nogil:
+    """filter and detect spikes of the channels c0 to c1 for nb consecutive packages
+    the ring rows of a sample are resolved once, every stage is then a branch free loop over contiguous channels"""
+    cdef int b = 0
+    cdef int n = 0
+    cdef int ch = 0
+    cdef int loc = 0
+    cdef int out_loc = 0
+    cdef int sneo_loc = 0
+    cdef int pos_sneo_loc = 0
+    cdef np.uint32_t plot_pos = 0
+    cdef BUFF_TYPE* int_ptr
+    cdef np.uint32_t* word_ptr
+    cdef np.float32_t volt_LSB = <np.float32_t>0.195 # in uV
+
+    # rows of the ring buffers, index k is the sample k steps back
+    cdef np.int16_t* x_row[FILT_LEN]
+    cdef np.float32_t* hp_row[5]
+    cdef np.float32_t* out_row[2*K_SNEO+1]
+    cdef np.float32_t* kNEO_row[BW_LEN]
+    cdef np.float32_t* SNEO_row
+    # signal used for detection and plotting
+    cdef np.float32_t* sig_row
+    cdef np.float32_t* filt_row
+    cdef np.float32_t* dst
+    cdef np.uint8_t* spike_dst
+    cdef np.uint8_t* spike_row
+
+    cdef np.float32_t val = 0.
+    cdef np.float32_t prev = 0.
+    cdef np.float32_t peak = 0.
+    cdef np.float32_t step = 0.
+    cdef np.float32_t track_step = st.track_step
+    cdef np.float32_t noise_floor = NOISE_FLOOR
+    cdef np.uint8_t spike = 0
+    cdef np.uint8_t prev_spike = 0
+    cdef np.int32_t bl = 0
+    cdef np.int32_t next_bl = 0
+    cdef np.int32_t new_max = 0
+    cdef np.int32_t onset = 0
+    cdef np.int32_t fire = 0
+    # blind counter at an onset and after a detected spike
+    cdef np.int32_t onset_bl = -st.detect_duration
+    cdef np.int32_t release_bl = st.blind_duration - st.detect_duration
+
+    for b in range(nb):
+        int_ptr = <BUFF_TYPE*>&packets[b*PKG_LEN]
+        loc = (st.loc + b) % BUFF_LEN
+        out_loc = (st.out_loc + b) % N_LEN
+        sneo_loc = (st.sneo_loc + b) % (N_LEN+K_SNEO)
+        # sneo is always delayed
+        pos_sneo_loc = (sneo_loc + N_LEN) % (N_LEN+K_SNEO)
+        plot_pos = (st.plot_loc + b) % st.plot_len
+
+        for n in range(FILT_LEN):
+            x_row[n] = st.data_stream[(loc-n+BUFF_LEN) % BUFF_LEN]
+        for n in range(5):
+            hp_row[n] = st.filtered_hp[(out_loc-n+N_LEN) % N_LEN]
+        for n in range(2*K_SNEO+1):
+            out_row[n] = st.filtered_out[(out_loc-n+N_LEN) % N_LEN]
+        for n in range(BW_LEN):
+            kNEO_row[n] = st.kNEO[(pos_sneo_loc-n+N_LEN+K_SNEO) % (N_LEN+K_SNEO)]
+        SNEO_row = st.SNEO[pos_sneo_loc]
+
+        # from 466 on took last 2 bytes, so 468 continuous and skip 1
+        # convert value, every channel is the low half of a 32 bit word (little endian) so the loads are contiguous
+        word_ptr = <np.uint32_t*>&int_ptr[234]
+        for ch in range(c0, c1):
+            x_row[0][ch] = <np.int16_t>((word_ptr[ch] & 0xFFFF) - 2**15)
+
+        # here is standard filtering ----------------------------------------------------------------------------------------
+        # the accumulation order per channel is the same as in the sample wise filter, results are bit identical
+        # apply IIR high pass
+        for ch in range(c0, c1):
+            hp_row[0][ch] = st.coeff_b[0] * x_row[0][ch]
+        for n in range(1,FILT_LEN):
+            for ch in range(c0, c1):
+                hp_row[0][ch] = hp_row[0][ch] + st.coeff_b[n] * x_row[n][ch] - st.coeff_a[n] * hp_row[n][ch]
+
+        # convolve with SG
+        for ch in range(c0, c1):
+            out_row[0][ch] = 0.
+        for n in range(5):
+            for ch in range(c0, c1):
+                out_row[0][ch] = out_row[0][ch] + hp_row[5-1-n][ch] * st.SG[5-1-n]
+
+        IF USE_SNEO:
+            # get kSNEO
+            # signal goes from -k to +k
+            for ch in range(c0, c1):
+                kNEO_row[0][ch] = out_row[K_SNEO][ch] * out_row[K_SNEO][ch] - out_row[0][ch] * out_row[2*K_SNEO][ch]
+
+            # sig.windows.bartlett(k)
+            for ch in range(c0, c1):
+                SNEO_row[ch] = 0.
+            for n in range(BW_LEN):
+                for ch in range(c0, c1):
+                    SNEO_row[ch] = SNEO_row[ch] + kNEO_row[BW_LEN-1-n][ch] * st.BW[BW_LEN-1-n]
+            sig_row = SNEO_row
+        ELSE:
+            sig_row = out_row[0]
+
+        ## Spike Detection --------------------------------------------------------------------------------
+        # blind_electrodes_array > 0: channel is blinded, count down
+        # blind_electrodes_array < 0: onset, follow the maximum for detect_duration samples
+        # blind_electrodes_array == 0: check threshold, channel steps to 1 and is checked every second sample
+        for ch in range(c0, c1):
+            # all loads are unconditional, the branches below are selects between registers
+            IF USE_SNEO:
+                val = sig_row[ch]
+            ELSE:
+                val = abs(sig_row[ch])
+            bl = st.blind_electrodes_array[ch]
+            peak = st.max_peak[ch]
+            new_max = (bl < 0) & (val > peak)
+            onset = new_max | ((bl == 0) & (val > st.local_thresh[ch]))
+            IF USE_SNEO:
+                # onset ends when no new maximum was found for detect_duration samples
+                fire = (bl == -1) & (new_max == 0)
+                next_bl = bl + 1
+                next_bl = release_bl if fire else next_bl
+            ELSE:
+                # without SNEO an onset is not released
+                fire = 0
+                next_bl = bl + (bl == 0)
+            next_bl = onset_bl if onset else next_bl
+            next_bl = (bl - 1) if bl > 0 else next_bl
+
+            st.max_peak[ch] = val if onset else peak
+            st.blind_electrodes_array[ch] = next_bl
+            st.spike_detect[b][ch] = fire
+            st.plot_mask[ch] = bl <= 0
+            if SAVE_SPIKE_SHAPES:
+                IF USE_SNEO:
+                    st.wavelet_event[ch] = 0 if bl > 0 else (1 if new_max else 2 + fire)
+                ELSE:
+                    st.wavelet_event[ch] = 0 if bl > 0 else (1 if bl < 0 else 2)
+
+        if SAVE_SPIKE_SHAPES and out.spike_wavelet != NULL:
+            save_spike_wavelets(st, out, b, out_loc, c0, c1)
+
+        # running noise estimate over the samples that are plotted, replaces the median of the plot buffer in update_MAD
+        # the median moves by a fraction of itself towards every sample, it settles where half of the samples are above
+        filt_row = out_row[0]
+        for ch in range(c0, c1):
+            val = fabsf(sig_row[ch])
+            prev = st.noise_median[ch]
+            step = track_step*prev
+            step = step if val > prev else -step
+            step = step if st.plot_mask[ch] else 0
+            val = prev + step
+            st.noise_median[ch] = val if val > noise_floor else noise_floor
+        # separate loops, gcc does not if-convert both selects in one loop
+        for ch in range(c0, c1):
+            val = filt_row[ch]*volt_LSB
+            prev = st.noise_ms[ch]
+            step = track_step*(val*val - prev)
+            st.noise_ms[ch] = prev + (step if st.plot_mask[ch] else 0)
+        track_step = next_track_step(st, track_step)
+
+        # copy to plot, blinded channels keep the previous value
+        if out.plot_signal != NULL:
+            dst = &out.plot_signal[plot_pos*CHANNELS]
+            for ch in range(c0, c1):
+                val = sig_row[ch]
+                prev = dst[ch]
+                dst[ch] = val if st.plot_mask[ch] else prev
+        if out.plot_shared != NULL:
+            dst = &out.plot_shared[plot_pos*CHANNELS]
+            if out.do_plot_raw:
+                for ch in range(c0, c1):
+                    val = <np.float32_t>x_row[0][ch]*volt_LSB
+                    prev = dst[ch]
+                    dst[ch] = val if st.plot_mask[ch] else prev
+            else:
+                for ch in range(c0, c1):
+                    val = out_row[0][ch]*volt_LSB
+                    prev = dst[ch]
+                    dst[ch] = val if st.plot_mask[ch] else prev
+        if out.plot_spikes != NULL:
+            spike_dst = &out.plot_spikes[plot_pos*CHANNELS]
+            spike_row = st.spike_detect[b]
+            for ch in range(c0, c1):
+                spike = spike_row[ch]
+                prev_spike = spike_dst[ch]
+                spike_dst[ch] = spike if st.plot_mask[ch] else prev_spike
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void save_spike_wavelets(
+        readout_state* st,
+        readout_output* out,
+        int b,
+        int out_loc,
+        int c0,
+        int c1) noexcept nogil:
+    """copy spike shapes of the channels with a wavelet event in sample b of the block"""
+    cdef int ch = 0
+    cdef np.uint32_t base = 0
+
+    for ch in range(c0, c1):
+        if st.wavelet_event[ch] == 0:
+            continue
+        # new onset, reset wavelet position to after delay
+        if st.wavelet_event[ch] == 1:
+            st.spike_wavelet_pos[ch] = 0
+            continue
+
+        base = ch*SPIKE_WAVELET_BUF+st.spike_wavelet_id[ch]*SPIKE_WAVELET_LEN
+        # copy value
+        if st.spike_wavelet_pos[ch] < SPIKE_WAVELET_LEN:
+            out.spike_wavelet[base+st.spike_wavelet_pos[ch]] = st.filtered_out[(out_loc-SPIKE_WAVELET_DELAY+N_LEN) % N_LEN][ch]
+            st.spike_wavelet_pos[ch] = st.spike_wavelet_pos[ch] + 1
+
+        # spike detected, fill in front and increase wavelet id number
+        if st.wavelet_event[ch] == 3:
+            while st.spike_wavelet_pos[ch] < SPIKE_WAVELET_LEN:
+                out.spike_wavelet[base+st.spike_wavelet_pos[ch]] = (
+                    st.filtered_out[(out_loc-SPIKE_WAVELET_DELAY+st.spike_wavelet_pos[ch]-(st.detect_duration-1)+2*N_LEN) % N_LEN][ch])
+                st.spike_wavelet_pos[ch] = st.spike_wavelet_pos[ch] + 1
+            out.spike_wavelet_id[ch*SPIKE_WAVELET_NUM + st.spike_wavelet_id[ch]] = out.pkg_ids[b]
+            st.spike_wavelet_id[ch] = (st.spike_wavelet_id[ch]+1) % SPIKE_WAVELET_NUM
+
+@cython.cdivision(True)
+cdef void detect_block(
+        readout_state* st,
+        readout_output* out,
+        np.uint8_t* packets,
+        int nb,
+        int num_threads) noexcept nogil:
+    """process a block of nb packages, with more than one thread every thread owns a fixed channel slice"""
+    cdef int t = 0
+    cdef int c0 = 0
+    cdef int b = 0
+    # slices do not share cache lines and split into whole vectors, 4 floats with the default SSE2 build, up to 16 with INKUBE_MARCH, see setup_filter.py
+    cdef int chunk = ((CHANNELS + num_threads - 1) // num_threads + SIMD_WIDTH - 1) // SIMD_WIDTH * SIMD_WIDTH
+
+    if num_threads <= 1:
+        detect_channels(st, out, packets, nb, 0, CHANNELS)
+    else:
+        for t in prange(
+                num_threads,
+                num_threads=num_threads,
+                schedule='static',
+                chunksize=1
+            ):
+            c0 = t*chunk
+            detect_channels(st, out, packets, nb, min(c0, CHANNELS), min(c0+chunk, CHANNELS))
+
+    # move readouts
+    for b in range(nb):
+        st.track_step = next_track_step(st, st.track_step)
+    st.loc = (st.loc + nb) % BUFF_LEN
+    st.out_loc = (st.out_loc + nb) % N_LEN
+    st.sneo_loc = (st.sneo_loc + nb) % (N_LEN+K_SNEO)
+    st.plot_loc = (st.plot_loc + nb) % st.plot_len
+
+cdef void publish_noise(readout_state* st, np.float32_t* noise_stats) noexcept nogil:
+    """copy the running noise estimate to the shared array, median of the detection signal then RMS in uV per channel"""
+    cdef int ch = 0
+    for ch in range(CHANNELS):
+        noise_stats[ch] = st.noise_median[ch]
+        noise_stats[CHANNELS+ch] = sqrt(st.noise_ms[ch])
+
+cdef void set_noise_thresh(readout_state* st) noexcept nogil:
+    """set the thresholds from the running median, SPIKE_THRESH times the median and at least MIN_SPIKE_THRESH"""
+    global THRESH_FACTOR
+    global MIN_THRESH
+    cdef np.float32_t factor = THRESH_FACTOR if THRESH_FACTOR else 1
+    cdef np.float32_t lower_lim = MIN_THRESH/factor
+    cdef int ch = 0
+    for ch in range(CHANNELS):
+        st.local_thresh[ch] = factor*(st.noise_median[ch] if st.noise_median[ch] > lower_lim else lower_lim)
+
+cdef np.uint64_t write_thresh_seq(np.float32_t* thresh, np.uint64_t* seq, np.float32_t* values) noexcept nogil:
+    """publish thresholds with a seqlock, the sequence is odd while the values are written, single writer only"""
+    cdef np.uint64_t start = seq[0]
+    cdef int ch = 0
+    seq[0] = start + 1
+    seq_fence_release()
+    for ch in range(CHANNELS):
+        thresh[ch] = values[ch]
+    ring_store_release(seq, start + 2)
+    return start + 2
+
+cdef np.uint64_t read_thresh_seq(np.float32_t* thresh, np.uint64_t* seq, np.float32_t* values) noexcept nogil:
+    """copy thresholds published with a seqlock, returns the sequence of the copy or 0 if a write was in progress"""
+    cdef np.uint64_t start = ring_load_acquire(seq)
+    cdef np.float32_t[CHANNELS] copy
+    cdef int ch = 0
+    if start & 1:
+        return 0
+    for ch in range(CHANNELS):
+        copy[ch] = thresh[ch]
+    seq_fence_acquire()
+    if seq[0] != start:
+        return 0
+    for ch in range(CHANNELS):
+        values[ch] = copy[ch]
+    return start
+
+def write_thresholds(spike_thresh, thresh_seq, thresh):
+    """Publish spike thresholds to the readout, they are used while the automatic threshold update is off.
+    Args:
+        spike_thresh: shared float array of the thresholds
+        thresh_seq: shared uint64 sequence of the thresholds
+        thresh: threshold, scalar or one value per channel
+    """
+    cdef np.float32_t[::1] thresh_view = spike_thresh.get_obj()
+    cdef np.uint64_t[::1] seq_view = thresh_seq
+    cdef np.float32_t[::1] values = pnp.ascontiguousarray(
+        pnp.broadcast_to(pnp.asarray(thresh, dtype=pnp.float32), (CHANNELS,)))
+    write_thresh_seq(&thresh_view[0], &seq_view[0], &values[0])
+
+def read_thresholds(spike_thresh, thresh_seq):
+    """Return a consistent copy of the spike thresholds of the readout
+    Args:
+        spike_thresh: shared float array of the thresholds
+        thresh_seq: shared uint64 sequence of the thresholds
+    """
+    cdef np.float32_t[::1] thresh_view = spike_thresh.get_obj()
+    cdef np.uint64_t[::1] seq_view = thresh_seq
+    thresh = pnp.empty(CHANNELS, dtype=pnp.float32)
+    cdef np.float32_t[::1] values = thresh
+    while not read_thresh_seq(&thresh_view[0], &seq_view[0], &values[0]) and seq_view[0]:
+        time.sleep(0)
+    return thresh
+
+cdef struct spike_ring:
+    # packed records pkg_id << 8 | channel, the length is a power of two
+    np.uint32_t* records
+    # write, read and overrun counter, they only increase and are taken modulo the length
+    np.uint64_t* seq
+    np.uint64_t mask
+    # eventfd written when spikes are published while the reader waits, -1 if not used
+    int wake_fd
+
+cdef spike_ring open_spike_ring(spike_ring_records, spike_ring_seq) except *:
+    """get pointers to the shared spike ring, spike_ring_records is a uint32 and spike_ring_seq a uint64 RawArray"""
+    cdef np.uint32_t[::1] records_view = spike_ring_records
+    cdef np.uint64_t[::1] seq_view = spike_ring_seq
+    cdef spike_ring ring
+    cdef np.uint64_t length = records_view.shape[0]
+
+    if length == 0 or (length & (length-1)):
+        raise ValueError(f'Spike ring length must be a power of two, got {length}')
+    if seq_view.shape[0] <= SPIKE_RING_WAKE_AT:
+        raise ValueError(f'Spike ring header needs at least {SPIKE_RING_WAKE_AT+1} counters')
+
+    ring.records = &records_view[0]
+    ring.seq = &seq_view[0]
+    ring.mask = length - 1
+    ring.wake_fd = -1
+    return ring
+
+def new_spike_event():
+    """Create the wakeup event of the spike ring, None where eventfd is not available (the reader then polls)"""
+    if not hasattr(os, 'eventfd'):
+        return None
+    return os.eventfd(0, os.EFD_NONBLOCK)
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef np.uint32_t push_spikes(
+        spike_ring* ring,
+        readout_state* st,
+        np.uint32_t* pkg_ids,
+        int nb) noexcept nogil:
+    """write the spikes of a block to the ring, the readout never waits for the reader
+    spikes that do not fit are dropped and counted as overrun"""
+    cdef np.uint64_t write = ring.seq[SPIKE_RING_WRITE]
+    cdef np.uint64_t read = ring_load_acquire(&ring.seq[SPIKE_RING_READ])
+    cdef np.uint32_t dropped = 0
+    cdef int p = 0
+    cdef int ch = 0
+
+    for p in range(nb):
+        for ch in range(CHANNELS):
+            if st.spike_detect[p][ch]:
+                if write - read > ring.mask:
+                    dropped += 1
+                else:
+                    ring.records[write & ring.mask] = (pkg_ids[p] << 8) | ch
+                    write += 1
+
+    # publish records after they are written, then the package up to which the block is complete
+    cdef np.uint64_t published = ring.seq[SPIKE_RING_WRITE]
+    ring_store_release(&ring.seq[SPIKE_RING_WRITE], write)
+    if dropped:
+        ring_store_release(&ring.seq[SPIKE_RING_OVERRUN], ring.seq[SPIKE_RING_OVERRUN] + dropped)
+    ring_store_release(&ring.seq[SPIKE_RING_DETECTED], SPIKE_RING_PKG_SET | pkg_ids[nb-1])
+    wake_spike_reader(ring, write != published)
+    return dropped
+
+cdef inline np.uint8_t pkg_passed(np.uint64_t detected, np.uint64_t wake_at) noexcept nogil:
+    """True if both header packages are set and detected is at or after wake_at"""
+    return ((detected & wake_at & SPIKE_RING_PKG_SET) != 0 
+        and c_pkg_diff(<np.uint32_t>(detected - SPIKE_RING_PKG_SET), <np.uint32_t>(wake_at - SPIKE_RING_PKG_SET)) >= 0)
+
+cdef void wake_spike_reader(spike_ring* ring, np.uint8_t new_records) noexcept nogil:
+    """write the wakeup event if the reader waits for new records or for the detected package to reach its wake package
+    the flag is taken so only one event is written per wait
+    the fence orders the published counters before the flag check, the reader checks in the opposite order"""
+    cdef np.uint64_t one = 1
+    if ring.wake_fd < 0:
+        return
+    ring_fence_full()
+    if not ring.seq[SPIKE_RING_WAITING]:
+        return
+    if not new_records and not pkg_passed(ring.seq[SPIKE_RING_DETECTED], ring.seq[SPIKE_RING_WAKE_AT]):
+        return
+    if ring_exchange(&ring.seq[SPIKE_RING_WAITING], 0):
+        fd_write(ring.wake_fd, &one, sizeof(one))
+
+cdef wait_for_spikes(spike_ring* ring, np.uint64_t read, np.uint64_t wake_at):
+    """block until the readout published records after read, the detected package reached wake_at
+    (a package or'ed with SPIKE_RING_PKG_SET, 0 for none) or SPIKE_WAIT_TIMEOUT passed"""
+    if ring.wake_fd < 0:
+        time.sleep(SPIKE_POLL_INTERVAL)
+        return
+    ring.seq[SPIKE_RING_WAKE_AT] = wake_at
+    ring_exchange(&ring.seq[SPIKE_RING_WAITING], 1)
+    # records and packages published before the flag was seen are not announced, check again before sleeping
+    if (ring_load_acquire(&ring.seq[SPIKE_RING_WRITE]) == read 
+            and not pkg_passed(ring_load_acquire(&ring.seq[SPIKE_RING_DETECTED]), wake_at)):
+        select.select([ring.wake_fd], [], [], SPIKE_WAIT_TIMEOUT)
+    ring.seq[SPIKE_RING_WAITING] = 0
+    try:
+        os.eventfd_read(ring.wake_fd)
+    except BlockingIOError:
+        pass
+
+cdef np.uint32_t* open_pkg_clock(pkg_clock) except? NULL:
+    """pointer to the words of a Package_clock, NULL if pkg_clock is None"""
+    if pkg_clock is None:
+        return NULL
+    cdef np.uint32_t[::1] clock_view = pkg_clock.clock
+    if clock_view.shape[0] <= PKG_CLOCK_WAITERS:
+        raise ValueError(f'Package clock needs at least {PKG_CLOCK_WAITERS+1} words')
+    return &clock_view[0]
+
+cdef void publish_pkg_clock(np.uint32_t* clock, np.uint32_t pkg_id) noexcept nogil:
+    """publish the newest package id and wake the consumers sleeping on the clock
+    the fence orders the new sequence before the waiter check, a consumer registers before the futex compares the sequence"""
+    clock_store_release(&clock[PKG_CLOCK_ID], pkg_id)
+    clock_add(&clock[PKG_CLOCK_SEQ], 1)
+    ring_fence_full()
+    if clock[PKG_CLOCK_WAITERS]:
+        futex_wake_all(&clock[PKG_CLOCK_SEQ])
+
+def pkg_clock_wait(clock, np.uint32_t seq, double timeout):
+    """Block until the readout published a block after seq or timeout passed.
+    Args:
+        clock: shared uint32 array of a Package_clock
+        seq: publication counter read before the package id was checked
+        timeout: longest wait in s
+    Returns:
+        the current publication counter
+    """
+    cdef np.uint32_t[::1] clock_view = clock
+    cdef np.uint32_t* clock_ptr = &clock_view[0]
+    cdef timespec ts
+    ts.tv_sec = <long>timeout
+    ts.tv_nsec = <long>((timeout - ts.tv_sec)*1e9)
+    if not HAVE_FUTEX:
+        if clock_load_acquire(&clock_ptr[PKG_CLOCK_SEQ]) == seq:
+            time.sleep(min(timeout, PKG_CLOCK_POLL_INTERVAL))
+        return clock_load_acquire(&clock_ptr[PKG_CLOCK_SEQ])
+    clock_add(&clock_ptr[PKG_CLOCK_WAITERS], 1)
+    # the futex returns at once if the sequence moved on after seq was read
+    with nogil:
+        futex_wait(&clock_ptr[PKG_CLOCK_SEQ], seq, &ts)
+    clock_add(&clock_ptr[PKG_CLOCK_WAITERS], -1)
+    return clock_load_acquire(&clock_ptr[PKG_CLOCK_SEQ])
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def read_spike_ring(spike_ring_records, spike_ring_seq):
+    """Take all available spikes from the shared spike ring.
+    Args:
+        spike_ring_records: shared uint32 array with packed records pkg_id << 8 | channel
+        spike_ring_seq: shared uint64 array with the write, read and overrun counter
+    Returns:
+        spike channels (uint8), spike package ids (uint32) and the number of spikes dropped by the readout so far
+    """
+    cdef spike_ring ring = open_spike_ring(spike_ring_records, spike_ring_seq)
+    cdef np.uint64_t write = ring_load_acquire(&ring.seq[SPIKE_RING_WRITE])
+    cdef np.uint64_t read = ring.seq[SPIKE_RING_READ]
+    cdef Py_ssize_t n = <Py_ssize_t>(write - read)
+    cdef Py_ssize_t i = 0
+
+    records = pnp.empty(n, dtype=pnp.uint32)
+    cdef np.uint32_t[::1] records_view = records
+    for i in range(n):
+        records_view[i] = ring.records[(read + i) & ring.mask]
+    ring_store_release(&ring.seq[SPIKE_RING_READ], write)
+
+    return (records & 0xFF).astype(pnp.uint8), records >> 8, ring.seq[SPIKE_RING_OVERRUN]
+
+def record_dtype(filtered=False):
+    """Numpy dtype of one sample in the record ring and in recording files.
+    Args:
+        filtered: True if the filtered signal is stored next to the raw data
+    """
+    fields = [
+        ('pkg_id', pnp.uint32), 
+        ('status', pnp.uint32, (STATUS_LEN,)), 
+        ('raw', pnp.int16, (CHANNELS,))]
+    if filtered:
+        fields.append(('filtered', pnp.float32, (CHANNELS,)))
+    return pnp.dtype(fields)
+
+def read_ring_counter(ring_seq, int pos=0):
+    """Read a counter of a shared ring header, records written before the counter are visible afterwards"""
+    cdef np.uint64_t[::1] seq_view = ring_seq
+    return ring_load_acquire(&seq_view[pos])
+
+cdef struct record_ring:
+    # one record per sample as described by record_dtype, the length is a power of two
+    np.uint8_t* data
+    np.uint64_t* seq
+    np.uint64_t mask
+    np.uint32_t record_len
+    np.uint8_t filtered
+
+cdef record_ring open_record_ring(record_ring_data, record_ring_seq, np.uint8_t filtered) except *:
+    """get pointers to the shared record ring, record_ring_data is a uint8 and record_ring_seq a uint64 RawArray"""
+    cdef np.uint8_t[::1] data_view = record_ring_data
+    cdef np.uint64_t[::1] seq_view = record_ring_seq
+    cdef record_ring rec
+    cdef np.uint64_t record_len = record_dtype(filtered).itemsize
+    cdef np.uint64_t length = data_view.shape[0] // record_len
+
+    if length == 0 or (length & (length-1)) or length*record_len != <np.uint64_t>data_view.shape[0]:
+        raise ValueError(f'Record ring must hold a power of two of {record_len} byte records')
+
+    rec.data = &data_view[0]
+    rec.seq = &seq_view[0]
+    rec.mask = length - 1
+    rec.record_len = record_len
+    rec.filtered = filtered
+    return rec
+
+cdef void push_records(
+        record_ring* rec,
+        readout_state* st,
+        np.uint8_t* packets,
+        int nb,
+        int loc,
+        int out_loc) noexcept nogil:
+    """copy package id, status words, raw and filtered data of a block to the record ring
+    loc and out_loc are the ring positions of the first sample of the block, the recorder is not waited for"""
+    cdef np.uint64_t write = rec.seq[RECORD_RING_WRITE]
+    cdef np.uint8_t* dst
+    cdef np.uint32_t* status_ptr
+    cdef int p = 0
+    cdef int s = 0
+
+    for p in range(nb):
+        dst = &rec.data[(write & rec.mask)*rec.record_len]
+        status_ptr = <np.uint32_t*>&packets[p*PKG_LEN+2]
+        (<np.uint32_t*>dst)[0] = status_ptr[0]
+        for s in range(STATUS_LEN):
+            (<np.uint32_t*>&dst[RECORD_STATUS_POS])[s] = status_ptr[STATUS_POS[s]]
+        memcpy(&dst[RECORD_RAW_POS], st.data_stream[(loc+p) % BUFF_LEN], 2*CHANNELS)
+        if rec.filtered:
+            memcpy(&dst[RECORD_FILTERED_POS], st.filtered_out[(out_loc+p) % N_LEN], 4*CHANNELS)
+        write += 1
+
+    ring_store_release(&rec.seq[RECORD_RING_WRITE], write)
+
 @cython.boundscheck(False)
 @cython.initializedcheck(False)
 cdef full_readout(
         sckt, 
         int bufferSize, 
-        spike_pipe_a_write: mp.connection.Connection, 
+        spike_ring_records: mp.sharedctypes.RawArray, 
+        spike_ring_seq: mp.sharedctypes.RawArray, 
         plot_shared: mp.sharedctypes.synchronized, 
         plot_signal: mp.sharedctypes.synchronized, 
         plot_spike_wavelet: mp.sharedctypes.synchronized, 
@@ -204,7 +1122,16 @@ cdef full_readout(
         status_stream: mp.sharedctypes.synchronized, 
         temp_stream: mp.sharedctypes.synchronized, 
         current_pkg_id: mp.sharedctypes.synchronized, 
-        np.uint8_t do_plot_raw):
+        np.uint8_t do_plot_raw, 
+        record_ring_data: mp.sharedctypes.RawArray, 
+        record_ring_seq: mp.sharedctypes.RawArray, 
+        np.uint8_t record_filtered, 
+        noise_stats: mp.sharedctypes.RawArray, 
+        thresh_seq: mp.sharedctypes.RawArray, 
+        auto_thresh: mp.Value, 
+        spike_event_fd, 
+        latency_probe, 
+        pkg_clock):
 
     cdef np.float32_t[:] plot_shared_view = plot_shared.get_obj()
     cdef np.float32_t* plot_shared_ptr = <np.float32_t*> &plot_shared_view[0]
@@ -250,157 +1177,154 @@ cdef full_readout(
     
     cdef np.uint32_t[:] temp_stream_view = temp_stream.get_obj()
     cdef np.uint32_t[:] current_pkg_id_view = current_pkg_id.get_obj()
+    # newest package id for the consumers blocking on the package clock, published once per block
+    cdef np.uint32_t* pkg_clock_ptr = open_pkg_clock(pkg_clock)
     cdef np.uint32_t expected_pkg_id = 4194304 # init high value
 
     cdef np.uint8_t ch = 0
-    cdef np.uint8_t n = 0
 
     cdef np.uint16_t s = 0
     cdef np.uint16_t i = 0
 
-    global coeff_a
-    global coeff_b
     global MAX_PKG_ID
-    global BLIND_DURATION
     global DETECT_DURATION
-    global MAX_VAL
- 
-    cdef np.float32_t volt_LSB = <np.float32_t>0.195 # in uV
-
-    cdef np.float32_t[CHANNELS] local_thresh 
-
-    for ch in range(CHANNELS):
-        local_thresh[ch] = 1e30
-
 
-    cdef np.uint16_t loc = 0
-    cdef np.uint16_t plot_loc = 0
-    cdef bytearray server_message = bytearray(2048)
+    # filter and detection state of all channels
+    cdef readout_state* st = new_readout_state(OUT_BUFF_LEN)
+    cdef readout_output out
+    cdef np.uint32_t[RECV_BATCH] pkg_ids
+    out.plot_signal = plot_signal_ptr
+    out.plot_shared = plot_shared_ptr
+    out.plot_spikes = plot_spikes_ptr
+    out.spike_wavelet = plot_spike_wavelet_ptr
+    out.spike_wavelet_id = plot_spike_wavelet_id_ptr
+    out.pkg_ids = pkg_ids
+    out.do_plot_raw = do_plot_raw
+
+    cdef np.uint32_t plot_loc = 0
+    # ring of package buffers, recvmmsg fills up to RECV_BATCH packages in one call
+    cdef bytearray server_message = bytearray(RECV_BATCH*PKG_LEN)
 
     cdef np.uint32_t EMPTY_VAL = 4194304 # this is 2**22, above MAX_PKG_ID and place-holder which is not 0
 
-    cdef Py_buffer* buff_ptr 
+    cdef Py_buffer* buff_ptr
     cdef Py_buffer empty_buff # assign for initialisation
     buff_ptr = &empty_buff
     PyObject_GetBuffer(server_message, buff_ptr, 0)
-    cdef char* char_ptr = <char*>buff_ptr.buf
-    cdef BUFF_TYPE* int_ptr = <BUFF_TYPE*>buff_ptr.buf
-    cdef BUFF_TYPE[:] int_view = <BUFF_TYPE[:1024]>int_ptr
-
-    cdef np.uint32_t* status_ptr = <np.uint32_t*> &int_view[1]
-    cdef np.uint16_t* command_ptr = <np.uint16_t*> &int_view[41]
-    cdef np.uint8_t TEMP_BUF_LEN = 4*8
+    cdef np.uint8_t* packet_ring = <np.uint8_t*>buff_ptr.buf
+    # pointers are moved to the current package in the batch
+    cdef char* char_ptr = <char*>packet_ring
+    cdef BUFF_TYPE* int_ptr = <BUFF_TYPE*>packet_ring
+
+    cdef np.uint32_t* status_ptr = <np.uint32_t*> &int_ptr[1]
+    # rows of the shared temperature ring, writing past it overwrote the next shared array
+    cdef np.uint8_t TEMP_BUF_LEN = temp_stream_view.shape[0] // TEMP_DATA_LEN
     cdef np.uint8_t temp_loc = 0
     cdef np.uint8_t* recv_command_counter_ptr = <np.uint8_t*> &char_ptr[1]
-
-    cdef np.float32_t[5] SG = [-0.08571429, 0.34285714, 0.48571429, 0.34285714, -0.08571429] 
-
-    assert N_LEN >= FILT_LEN
-    assert N_LEN >= len(SG)
-
-    cdef np.float32_t[N_LEN][CHANNELS] filtered_out 
-    cdef np.float32_t[N_LEN][CHANNELS] filtered_hp
-
-    cdef np.float32_t[N_LEN+K_SNEO][CHANNELS] kNEO 
-    cdef np.float32_t[N_LEN+K_SNEO][CHANNELS] SNEO 
-
-    cdef np.float32_t[BW_LEN] BW 
-
-
-    cdef np.uint8_t[CHANNELS] spike_wavelet_pos
-    cdef np.uint8_t[CHANNELS] spike_wavelet_id
-
-    cdef np.uint16_t[CHIP_NUM] stim_command_el
-
-    cdef np.uint8_t pos_sneo_loc = 0
-
-    cdef np.uint8_t out_loc = 0
-    cdef np.uint8_t sneo_loc = 0
-
-    cdef np.uint32_t pkg_id = 0
-    cdef np.uint8_t[CHANNELS] spike_detect
-    cdef np.uint8_t[:] spike_detect_view = spike_detect
-
-    cdef np.int16_t data_stream[BUFF_LEN][(CHANNELS+2)]
-    cdef np.int16_t [:,:] stream_view = data_stream
-
-    cdef np.uint8_t[4] send_spike
-    cdef np.uint8_t[:] send_spike_view = send_spike
-    send_spike_view[:] = 0
-    cdef np.int8_t[CHANNELS] blind_electrodes_array
-    cdef np.float32_t[CHANNELS] max_peak
-
-    for ch in range(CHANNELS):
-        spike_detect[ch] = 0
-        blind_electrodes_array[ch] = BLIND_DURATION
-        max_peak[ch] = 0.
-        spike_wavelet_id[ch] = 0
-        spike_wavelet_pos[ch] = SPIKE_WAVELET_LEN
-
-        for n in range(N_LEN):
-            filtered_out[n][ch] = 0.
-            filtered_hp[n][ch] = 0.
-
-        for n in range(N_LEN+K_SNEO):
-            kNEO[n][ch] = 0.
-            SNEO[n][ch] = 0.
-    
-    for n in range(CHIP_NUM):
-        stim_command_el[n] = 0
-
-    for n in range(CHIP_NUM):
-        stim_command_el[n] = 0
-
-    for n in range(BW_LEN):
-        if n <= BW_LEN/2:
-            BW[n] = 2*n/BW_LEN
-        else:
-            BW[n] = 2-2*n/BW_LEN
-    cdef np.float32_t[:, :] filtered_hp_view = filtered_hp
-
-    cdef np.float32_t[:, :] filtered_out_view = filtered_out
-
-    cdef np.float32_t[:] BW_view = BW
-    cdef np.float32_t* SNEO_ptr = <np.float32_t*>PyMem_Malloc(CHANNELS*4*(N_LEN+K_SNEO))
-    cdef np.float32_t[:,:] SNEO_view = <np.float32_t[:(N_LEN+K_SNEO),:CHANNELS]>SNEO_ptr
-    cdef np.float32_t* kNEO_ptr = <np.float32_t*>PyMem_Malloc(CHANNELS*4*(N_LEN+K_SNEO))
-    cdef np.float32_t[:,:] kNEO_view = <np.float32_t[:(N_LEN+K_SNEO),:CHANNELS]>kNEO_ptr
-
-    for n in range(N_LEN+K_SNEO):    
-        SNEO[n] = SNEO_ptr+n*CHANNELS
-        kNEO[n] = kNEO_ptr+n*CHANNELS
-        # SNEO_view[n] = <np.float32_t[:CHANNELS]> SNEO_ptr # <np.float32_t[:CHANNELS]>
-        # SNEO_ptr = <np.float32_t*> SNEO_ptr
-    for ch in range(CHANNELS):
-        for n in range(N_LEN+K_SNEO):
-            kNEO[n][ch] = 0.
-            SNEO[n][ch] = 0.
+    cdef np.uint8_t update_thresh = 0
+
+    # running noise estimate of the state, published with every threshold update
+    cdef np.float32_t[::1] noise_stats_view
+    cdef np.float32_t* noise_stats_ptr = NULL
+    if noise_stats is not None:
+        noise_stats_view = noise_stats
+        if noise_stats_view.shape[0] < 2*CHANNELS:
+            raise ValueError(f'Noise estimate needs {2*CHANNELS} values')
+        noise_stats_ptr = &noise_stats_view[0]
+
+    # thresholds follow the running noise estimate while auto_thresh is set, else spike_thresh is taken when republished
+    # both directions go through the seqlock thresh_seq, the flag is read without its lock
+    cdef np.uint64_t[::1] thresh_seq_view
+    cdef np.uint64_t* thresh_seq_ptr = NULL
+    cdef np.uint64_t last_thresh_seq = 0
+    cdef np.uint64_t new_thresh_seq = 0
+    if thresh_seq is not None:
+        thresh_seq_view = thresh_seq
+        thresh_seq_ptr = &thresh_seq_view[0]
+    auto_thresh_flag = auto_thresh.get_obj() if hasattr(auto_thresh, 'get_obj') else auto_thresh
+
+    # detected spikes are handed to the spike processor through the shared ring
+    cdef spike_ring ring = open_spike_ring(spike_ring_records, spike_ring_seq)
+    if spike_event_fd is not None:
+        ring.wake_fd = spike_event_fd
+
+    # every sample is copied to the record ring when a recorder is attached
+    cdef record_ring rec
+    cdef np.uint8_t do_record = record_ring_data is not None
+    cdef np.uint16_t block_loc = 0
+    cdef np.uint8_t block_out_loc = 0
+    if do_record:
+        rec = open_record_ring(record_ring_data, record_ring_seq, record_filtered)
+
+    # receive and detection time of every block when the latency is measured (Latency_probe)
+    cdef np.int64_t t_recv = 0
+    cdef np.uint32_t probe_key = 0
+
+    # one message header per package buffer for recvmmsg
+    cdef int sckt_fd = sckt.fileno()
+    cdef int n_recv = 0
+    cdef int p = 0
+    cdef mmsghdr[RECV_BATCH] msgs
+    cdef iovec[RECV_BATCH] iovecs
+    memset(msgs, 0, sizeof(msgs))
+    for p in range(RECV_BATCH):
+        iovecs[p].iov_base = &packet_ring[p*PKG_LEN]
+        iovecs[p].iov_len = PKG_LEN
+        msgs[p].msg_hdr.msg_iov = &iovecs[p]
+        msgs[p].msg_hdr.msg_iovlen = 1
 
     for i in range(1024):
         server_message[i*2] = i % 256
         server_message[i*2+1] = i // 256
     for i in range(1024):
-        assert int_view[i] == i
+        assert int_ptr[i] == i
     # print(f"Constant blind: {BLIND_DURATION}, detect: {DETECT_DURATION}, filt_a {coeff_a}, filt_a {coeff_b} and max_pkg {MAX_PKG_ID}")
 
     # ---------------------------------Loop----------------------------------------------------------------------------------------------
     while True:
-        # sneo is always delayed
-        pos_sneo_loc = (sneo_loc-K_SNEO) % (N_LEN+K_SNEO)
-    
-        # receive data
-        sckt.recvfrom_into(server_message)
-    
-        # update shared current package id
-        current_pkg_id[0] = status_ptr[0]
-        pkg_id = <np.uint32_t> ((status_ptr[0] - DETECT_DURATION - K_SNEO) % MAX_PKG_ID) # for negative ID
-
-        # update status bytes
-        for s in range(STATUS_LEN):
-            # with status_stream:
-            status_stream[plot_loc*STATUS_LEN+s] = status_ptr[STATUS_POS[s]]       
+        # receive data, blocks until at least one package arrived and returns all already queued packages
+        IF USE_RECVMMSG:
+            with nogil:
+                n_recv = recvmmsg(sckt_fd, msgs, RECV_BATCH, MSG_WAITFORONE, NULL)
+            if n_recv < 0:
+                if errno == EINTR:
+                    continue
+                raise OSError(errno, 'recvmmsg failed on UDP readout socket')
+        ELSE:
+            sckt.recvfrom_into(server_message, PKG_LEN)
+            n_recv = 1
+        if latency_probe is not None:
+            t_recv = time.perf_counter_ns()
+
+        # package bookkeeping, the block is processed afterwards
+        plot_loc = st.plot_loc
+        update_thresh = 0
+        for p in range(n_recv):
+            # move package pointers to the current buffer in the ring
+            char_ptr = <char*>&packet_ring[p*PKG_LEN]
+            int_ptr = <BUFF_TYPE*>char_ptr
+            status_ptr = <np.uint32_t*> &int_ptr[1]
+            recv_command_counter_ptr = <np.uint8_t*> &char_ptr[1]
+
+            pkg_ids[p] = <np.uint32_t> ((status_ptr[0] - DETECT_DURATION - K_SNEO) % MAX_PKG_ID) # for negative ID
+
+            # update status bytes
+            for s in range(STATUS_LEN):
+                status_stream_ptr[((plot_loc+p) % OUT_BUFF_LEN)*STATUS_LEN+s] = status_ptr[STATUS_POS[s]]
+
+            for ch in range(7):
+                temp_stream_view[ch + TEMP_DATA_LEN*temp_loc] = status_ptr[5+ch]
+
+            for ch in range(4):
+                temp_stream_view[7+ch + TEMP_DATA_LEN*temp_loc] = <np.uint32_t> int_ptr[27 + 2*ch]
+
+            for ch in range(4):
+                temp_stream_view[11+ch + TEMP_DATA_LEN*temp_loc] = <np.uint32_t> int_ptr[28 + 2*ch]
+            temp_loc = (temp_loc+1) % TEMP_BUF_LEN
+
+            if not char_ptr[2]: # every 255 samples
+                update_thresh = 1
 
-        IF ONLY_STIM:
             if status_ptr[0] > expected_pkg_id:
                 print(f'Warning: Dropped {status_ptr[0] - expected_pkg_id} packages')
             expected_pkg_id = status_ptr[0]+1
@@ -411,265 +1335,204 @@ cdef full_readout(
                 recv_command_counter.send_bytes(char_ptr[1:2])
                 recv_command_counter_num = recv_command_counter_ptr[0]
 
-            plot_loc = (plot_loc+1) % OUT_BUFF_LEN
-            shared_plot_loc[0] = plot_loc
+        # shared current package id, written without the lock of the synchronized array
+        current_pkg_id_view[0] = status_ptr[0]
+        if pkg_clock_ptr != NULL:
+            publish_pkg_clock(pkg_clock_ptr, status_ptr[0])
 
+        IF ONLY_STIM:
+            st.plot_loc = (st.plot_loc + n_recv) % OUT_BUFF_LEN
+            shared_plot_loc[0] = st.plot_loc
             continue
 
+        if update_thresh:
+            if noise_stats_ptr != NULL:
+                publish_noise(st, noise_stats_ptr)
+            if auto_thresh_flag is not None and auto_thresh_flag.value:
+                set_noise_thresh(st)
+                if thresh_seq_ptr != NULL:
+                    last_thresh_seq = write_thresh_seq(spike_thresh_ptr, thresh_seq_ptr, st.local_thresh)
+            elif thresh_seq_ptr != NULL and ring_load_acquire(thresh_seq_ptr) != last_thresh_seq:
+                # a write in progress is picked up with the next update
+                new_thresh_seq = read_thresh_seq(spike_thresh_ptr, thresh_seq_ptr, st.local_thresh)
+                if new_thresh_seq:
+                    last_thresh_seq = new_thresh_seq
 
-
-        if not char_ptr[2]: # every 255 samples
-            with spike_thresh:
-                if (local_thresh[0] != spike_thresh[0]) and spike_thresh[0]:
-                    for ch in range(CHANNELS):
-                        local_thresh[ch] = spike_thresh[ch]
-        
         if SAVE_SPIKE_SHAPES:
             plot_spike_wavelet.acquire()
 
-        # iterate over channels, parallelised
-        for ch in prange(
-                CHANNELS, 
-                nogil=True, 
-                num_threads=5, # one uses around 80% of one CPU core
-                schedule='static', 
-                chunksize=48
-            ): 
-            # from 466 on took last 2 bytes, so 468 continuous and skip 1 # range(CHANNELS): #
-            # convert value
-            spike_detect[ch] = 0
-            stream_view[loc][2+ch] = int_view[234+2*ch] - 2**15
-
-            # here is standard filtering ----------------------------------------------------------------------------------------
-            # apply IIR high pass
-
-            filtered_hp_view[out_loc,ch] = coeff_b[0] * stream_view[loc,2+ch]
-            for n in range(1,FILT_LEN):
-                filtered_hp_view[out_loc,ch] = (
-                    filtered_hp_view[out_loc,ch] 
-                    + coeff_b[n] * stream_view[loc-n,2+ch] 
-                    - coeff_a[n] * filtered_hp_view[out_loc-n,ch]) 
-
-            # convolve with SG
-            filtered_out_view[out_loc,ch] = 0.
-            for n in range(5):
-                filtered_out_view[out_loc,ch] = (
-                    filtered_out_view[out_loc,ch] 
-                    + filtered_hp_view[out_loc+n-(5-1),ch] * SG[5-1-n]) 
-
-            IF USE_SNEO:
-                # get kSNEO
-                # signal goes from -k to +k
-                kNEO_view[pos_sneo_loc, ch] = (
-                    filtered_out_view[out_loc-K_SNEO, ch] * filtered_out_view[out_loc-K_SNEO, ch] 
-                    - filtered_out_view[out_loc, ch] * filtered_out_view[out_loc-2*K_SNEO, ch])
-
-                # sig.windows.bartlett(k)
-                # conv(kNEO[sneo_loc-(5*K_SNEO):sneo_loc-K_SNEO+1], BW, <np.float32_t*>SNEO[sneo_loc-K_SNEO], 4*K_SNEO+1)
-                SNEO_view[pos_sneo_loc, ch] = 0.
-                for n in range(BW_LEN):
-                    SNEO_view[pos_sneo_loc, ch] = (
-                        SNEO_view[pos_sneo_loc, ch]
-                        + kNEO_view[pos_sneo_loc-(BW_LEN-1)+n, ch] * BW_view[BW_LEN-1-n])
-                # no smooting
-                # SNEO_view[pos_sneo_loc, ch] = kNEO_view[sneo_loc-K_SNEO, ch]
-
-            ## Spike Detection --------------------------------------------------------------------------------
-            # if channel is still blinded ignore
-            if blind_electrodes_array[ch] > 0:
-                # reduce blind duration sample counter
-                blind_electrodes_array[ch] = blind_electrodes_array[ch] - 1
-            else:
-                # if currently in onset
-                if blind_electrodes_array[ch] < 0:
-                    # when max is surpassed new onset
-                    IF USE_SNEO:
-                        if SNEO_view[pos_sneo_loc,ch] > max_peak[ch]:
-                            # new onset here
-                            blind_electrodes_array[ch] = -DETECT_DURATION
-                            max_peak[ch] = SNEO_view[pos_sneo_loc,ch]   
-
-                            # reset wavelet position to after delay
-                            spike_wavelet_pos[ch] = 0
-                        else:
-                            blind_electrodes_array[ch] = blind_electrodes_array[ch] + 1  
-
-                            # copy value 
-                            if SAVE_SPIKE_SHAPES:                  
-                                if spike_wavelet_pos[ch] < SPIKE_WAVELET_LEN: 
-                                    plot_spike_wavelet_ptr[ch*SPIKE_WAVELET_BUF+spike_wavelet_id[ch]*SPIKE_WAVELET_LEN+spike_wavelet_pos[ch]] = (
-                                        filtered_out_view[out_loc-SPIKE_WAVELET_DELAY,ch]) # filtered_out_view[out_loc-K_SNEO,ch]) # SNEO_view[pos_sneo_loc, ch]) # 
-                                    spike_wavelet_pos[ch] = spike_wavelet_pos[ch] + 1
-
-                            if blind_electrodes_array[ch] == 0:
-                                # blind electrodes carries number of samples on which electrode is blinded and cannot detect spikes
-                                blind_electrodes_array[ch] = BLIND_DURATION - DETECT_DURATION # ensure that positive?
-                                spike_detect[ch] = 1
-
-                                # fill in front and increase wavelet id number
-                                if SAVE_SPIKE_SHAPES:                                    
-                                    while spike_wavelet_pos[ch] < SPIKE_WAVELET_LEN:
-                                        plot_spike_wavelet_ptr[ch*SPIKE_WAVELET_BUF+spike_wavelet_id[ch]*SPIKE_WAVELET_LEN+spike_wavelet_pos[ch]] = (
-                                            filtered_out_view[out_loc-SPIKE_WAVELET_DELAY+spike_wavelet_pos[ch]-(DETECT_DURATION-1),ch]) # filtered_out_view[out_loc-K_SNEO,ch]) # SNEO_view[pos_sneo_loc, ch]) # 
-                                        spike_wavelet_pos[ch] = spike_wavelet_pos[ch] + 1
-                                    plot_spike_wavelet_id_ptr[ch*SPIKE_WAVELET_NUM + spike_wavelet_id[ch]] = pkg_id
-                                    spike_wavelet_id[ch] = (spike_wavelet_id[ch]+1) % SPIKE_WAVELET_NUM
-                    ELSE:
-                        if abs(filtered_out_view[out_loc,ch]) > max_peak[ch]:
-                            # new onset here
-                            blind_electrodes_array[ch] = -DETECT_DURATION
-                            max_peak[ch] = abs(filtered_out_view[out_loc,ch])
-
-                        # reset wavelet position to after delay
-                        spike_wavelet_pos[ch] = 0
-                else:
-                    blind_electrodes_array[ch] = blind_electrodes_array[ch] + 1  
-
-                    # copy value 
-                    if SAVE_SPIKE_SHAPES:                  
-                        if spike_wavelet_pos[ch] < SPIKE_WAVELET_LEN: 
-                            plot_spike_wavelet_ptr[ch*SPIKE_WAVELET_BUF+spike_wavelet_id[ch]*SPIKE_WAVELET_LEN+spike_wavelet_pos[ch]] = (
-                                filtered_out_view[out_loc-SPIKE_WAVELET_DELAY,ch]) # filtered_out_view[out_loc-K_SNEO,ch]) # SNEO_view[pos_sneo_loc, ch]) # 
-                            spike_wavelet_pos[ch] = spike_wavelet_pos[ch] + 1
-
-                    if blind_electrodes_array[ch] == 0:
-                        # blind electrodes carries number of samples on which electrode is blinded and cannot detect spikes
-                        blind_electrodes_array[ch] = BLIND_DURATION - DETECT_DURATION # ensure that positive?
-                        spike_detect[ch] = 1
-
-                        # fill in front and increase wavelet id number
-                        if SAVE_SPIKE_SHAPES:                                    
-                            while spike_wavelet_pos[ch] < SPIKE_WAVELET_LEN:
-                                plot_spike_wavelet_ptr[ch*SPIKE_WAVELET_BUF+spike_wavelet_id[ch]*SPIKE_WAVELET_LEN+spike_wavelet_pos[ch]] = (
-                                    filtered_out_view[out_loc-SPIKE_WAVELET_DELAY+spike_wavelet_pos[ch]-(DETECT_DURATION-1),ch]) # filtered_out_view[out_loc-K_SNEO,ch]) # SNEO_view[pos_sneo_loc, ch]) # 
-                                spike_wavelet_pos[ch] = spike_wavelet_pos[ch] + 1
-                            plot_spike_wavelet_id_ptr[ch*SPIKE_WAVELET_NUM + spike_wavelet_id[ch]] = pkg_id
-                            spike_wavelet_id[ch] = (spike_wavelet_id[ch]+1) % SPIKE_WAVELET_NUM                                
-                    # if channel threshold is crossed and electrode not blinded
-                    else:
-                        IF USE_SNEO:
-                            if SNEO_view[pos_sneo_loc,ch] > (local_thresh[ch]):
-                                # onset here
-                                blind_electrodes_array[ch] = -DETECT_DURATION
-                                max_peak[ch] = SNEO_view[pos_sneo_loc,ch] 
-                        ELSE:
-                            if abs(filtered_out_view[out_loc,ch]) > local_thresh[ch]:
-                                # onset here
-                                blind_electrodes_array[ch] = -DETECT_DURATION
-                                max_peak[ch] = abs(filtered_out_view[out_loc,ch])
-                # copy to plot
-            
-                # with plot_signal:
-                IF USE_SNEO:
-                    plot_signal_ptr[plot_loc*CHANNELS+ch] = SNEO_view[pos_sneo_loc, ch] # filtered_out[out_loc][ch] # 
-                ELSE:
-                    plot_signal_ptr[plot_loc*CHANNELS+ch] = filtered_out[out_loc][ch]
-                # with plot_shared:
-                if do_plot_raw:            
-                    plot_shared_ptr[plot_loc*CHANNELS+ch] = <np.float32_t>data_stream[loc][2+ch]*volt_LSB
-                else:
-                    plot_shared_ptr[plot_loc*CHANNELS+ch] = filtered_out[out_loc][ch]*volt_LSB
-                
-                # with plot_spikes:
-                plot_spikes_ptr[plot_loc*CHANNELS+ch] = spike_detect[ch]
-
+        # filter and detect the whole block, one OpenMP fork/join per block instead of per sample
+        block_loc = st.loc
+        block_out_loc = st.out_loc
+        with nogil:
+            detect_block(st, &out, packet_ring, n_recv, READOUT_THREADS)
 
-        for ch in range(7):
-            temp_stream_view[ch + TEMP_DATA_LEN*temp_loc] = status_ptr[5+ch]
+            # send out spikes to the ring
+            push_spikes(&ring, st, pkg_ids, n_recv)
 
-        for ch in range(4):
-            temp_stream_view[7+ch + TEMP_DATA_LEN*temp_loc] = <np.uint32_t> int_view[27 + 2*ch]
+            if do_record:
+                push_records(&rec, st, packet_ring, n_recv, block_loc, block_out_loc)
 
-        for ch in range(4):
-            temp_stream_view[11+ch + TEMP_DATA_LEN*temp_loc] = <np.uint32_t> int_view[28 + 2*ch]
-
-        # send out spikes to pipe
-        
-        send_spike[1] = pkg_id % 256 # char_ptr[2]
-        send_spike[2] = pkg_id >> 8 % 256 # char_ptr[3]
-        send_spike[3] = pkg_id >> 16 % 256 # char_ptr[4]
+        if latency_probe is not None:
+            # the packet generator writes its send time to the end of the package
+            probe_key = (<np.uint32_t*>&packet_ring[(n_recv-1)*PKG_LEN+2])[0]
+            latency_probe.stamp('pkg_sent', probe_key, (<np.int64_t*>&packet_ring[(n_recv-1)*PKG_LEN+PKG_TIME_POS])[0])
+            latency_probe.stamp('pkg_received', probe_key, t_recv)
+            latency_probe.stamp('pkg_detected', probe_key)
 
-        for ch in range(CHANNELS): # needs gil
-            if spike_detect[ch] == 1:
-                send_spike[0] = ch
-                spike_pipe_a_write.send_bytes(send_spike_view[:4])
-                spike_detect[ch] = 0
+        shared_plot_loc[0] = st.plot_loc
 
-        if status_ptr[0] > expected_pkg_id:
-            print(f'Warning: Dropped {status_ptr[0] - expected_pkg_id} packages')
-        expected_pkg_id = status_ptr[0]+1
 
-        # update package and receive counters
-        if recv_command_counter_num != recv_command_counter_ptr[0]:
-            # print('Sending recv counter', <np.uint8_t>char_ptr[1])
-            recv_command_counter.send_bytes(char_ptr[1:2])
-            recv_command_counter_num = recv_command_counter_ptr[0]
+cdef class SpikeDetector:
+    """Readout filter and spike detection without a socket, the state persists across calls.
+    Long recordings can be processed in consecutive chunks with the same result as one call.
+    Args:
+        thresh: spike detection threshold, scalar or one value per channel
+        filt_b: high pass numerator coefficients, the module constants if None
+        filt_a: high pass denominator coefficients, the module constants if None
+    """
+    cdef readout_state* st
 
-        # move readouts
-        out_loc = (out_loc+1) % (N_LEN) # FILT_LEN
-        sneo_loc = (sneo_loc+1) % (N_LEN+K_SNEO)
-        loc = (loc+1) % BUFF_LEN
-        plot_loc = (plot_loc+1) % OUT_BUFF_LEN
-        shared_plot_loc[0] = plot_loc
-        temp_loc = (temp_loc+1) % TEMP_BUF_LEN
+    def __cinit__(self, thresh, filt_b=None, filt_a=None):
+        global MAX_PKG_ID
+        if MAX_PKG_ID == 0:
+            raise RuntimeError('Constants are not set, call set_constants first')
+        self.st = new_readout_state(1)
+        cdef int n = 0
+        if filt_b is not None and filt_a is not None:
+            if len(filt_b) != FILT_LEN or len(filt_a) != FILT_LEN:
+                raise ValueError(f'Filter needs {FILT_LEN} coefficients')
+            for n in range(FILT_LEN):
+                self.st.coeff_b[n] = filt_b[n]
+                self.st.coeff_a[n] = filt_a[n]
+        self.set_thresh(thresh)
+
+    def __dealloc__(self):
+        PyMem_Free(self.st)
+
+    def set_thresh(self, thresh):
+        """set the spike detection threshold, scalar or one value per channel"""
+        thresh_array = pnp.broadcast_to(pnp.asarray(thresh, dtype=pnp.float32), (CHANNELS,))
+        cdef int ch = 0
+        for ch in range(CHANNELS):
+            self.st.local_thresh[ch] = thresh_array[ch]
+
+    def noise(self):
+        """return the running median of the absolute detection signal and the RMS of the filtered signal in uV per channel"""
+        median = pnp.empty(CHANNELS, dtype=pnp.float32)
+        rms = pnp.empty(CHANNELS, dtype=pnp.float32)
+        cdef int ch = 0
+        for ch in range(CHANNELS):
+            median[ch] = self.st.noise_median[ch]
+            rms[ch] = sqrt(self.st.noise_ms[ch])
+        return median, rms
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def process(
+            self,
+            const np.uint8_t[:, ::1] packets,
+            int block_len=RECV_BATCH,
+            int num_threads=1,
+            return_signal=True):
+        """Filter and detect spikes in the next packages of the stream.
+        Args:
+            packets: uint8 array of shape (n, 2048) with the packages as sent by the FPGA
+            block_len: number of packages processed per parallel region, at most RECV_BATCH
+            num_threads: number of OpenMP threads
+            return_signal: also return the detection signal, skipped for fast replays
+        Returns:
+            spike channels (uint8), spike package ids (uint32) and the detection signal (float32, shape (n, CHANNELS)) or None
+        """
+        global MAX_PKG_ID
+        global DETECT_DURATION
 
+        if packets.shape[1] != PKG_LEN:
+            raise ValueError(f'Packages must be {PKG_LEN} bytes long, got {packets.shape[1]}')
+        if block_len < 1 or block_len > RECV_BATCH:
+            raise ValueError(f'block_len must be between 1 and {RECV_BATCH}')
+
+        cdef readout_state* st = self.st
+        cdef Py_ssize_t n_pkg = packets.shape[0]
+        cdef Py_ssize_t start = 0
+        cdef int nb = 0
+        cdef int p = 0
+        cdef int ch = 0
+        cdef np.uint32_t* status_ptr
+        cdef np.float32_t[:, ::1] signal_view
+
+        spike_ch = []
+        spike_pkg = []
+
+        cdef readout_output out
+        cdef np.uint32_t[RECV_BATCH] pkg_ids
+        memset(&out, 0, sizeof(out))
+        out.pkg_ids = pkg_ids
+
+        # the plot ring of the state is the signal of this call
+        st.plot_loc = 0
+        st.plot_len = max(n_pkg, 1)
+        signal = None
+        if return_signal:
+            signal = pnp.zeros((max(n_pkg, 1), CHANNELS), dtype=pnp.float32)
+            signal_view = signal
+            out.plot_signal = &signal_view[0, 0]
+
+        while start < n_pkg:
+            nb = min(block_len, n_pkg - start)
+            for p in range(nb):
+                status_ptr = <np.uint32_t*>&packets[start+p, 2]
+                pkg_ids[p] = <np.uint32_t> ((status_ptr[0] - DETECT_DURATION - K_SNEO) % MAX_PKG_ID)
+
+            with nogil:
+                detect_block(st, &out, <np.uint8_t*>&packets[start, 0], nb, num_threads)
+
+            for p in range(nb):
+                for ch in range(CHANNELS):
+                    if st.spike_detect[p][ch] == 1:
+                        spike_ch.append(ch)
+                        spike_pkg.append(pkg_ids[p])
+            start += nb
+
+        return (
+            pnp.array(spike_ch, dtype=pnp.uint8),
+            pnp.array(spike_pkg, dtype=pnp.uint32),
+            None if signal is None else signal[:n_pkg])
+
+def run_detection(
+        packets,
+        thresh,
+        int block_len=RECV_BATCH,
+        int num_threads=1):
+    """Run the readout filter and spike detection on UDP packages without a socket.
+    Args:
+        packets: uint8 array of shape (n, 2048) with the packages as sent by the FPGA
+        thresh: spike detection threshold, scalar or one value per channel
+        block_len: number of packages processed per parallel region, at most RECV_BATCH
+        num_threads: number of OpenMP threads
+    Returns:
+        spike channels (uint8), spike package ids (uint32) and the detection signal (float32, shape (n, CHANNELS))
+    """
+    return SpikeDetector(thresh).process(packets, block_len, num_threads)
 
 
 
 def update_MAD(
-        sneo_shared, 
-        filtered_shared, 
+        noise_stats, 
         update_time, 
-        spike_thresh, 
-        update_thresh_bool, 
         shared_noise, 
         mea_mapping, 
         noise_bins, 
         noise_max
     ): 
-    import pickle
-    ''' Update median of signal on all electrodes, {CHANNELS} elements vector '''
-    cdef np.float32_t[CHANNELS] thresh
-    global THRESH_FACTOR
-    global MIN_THRESH
-    cdef np.uint8_t ch = 0
-    cdef np.uint8_t i = 0
-    with spike_thresh:
-        thresh[ch] = spike_thresh[ch]
-    if THRESH_FACTOR == 0:
-        THRESH_FACTOR = 1
-    cdef np.float32_t lower_lim = MIN_THRESH/THRESH_FACTOR # uV
-    median_array = 2 * lower_lim * pnp.ones((1,CHANNELS))
-    std_vector = pnp.zeros((CHANNELS))
-    cdef np.uint8_t init_counter = 5
-
-    for ch in range(CHANNELS):
-        thresh[ch] = THRESH_FACTOR*lower_lim
+    ''' Update the noise histogram of the GUI from the running noise estimate of the readout
+    noise_stats holds the median of the absolute detection signal and the RMS of the filtered signal, see publish_noise
+    the spike thresholds are set by the readout itself, see set_noise_thresh '''
+    noise = pnp.frombuffer(noise_stats, dtype=pnp.float32)[:2*CHANNELS].reshape(2, CHANNELS)
 
     while True:
-        if init_counter:
-            time.sleep(.5)
-            init_counter -= 1
-        else: 
-            time.sleep(update_time)
-
-        if update_thresh_bool.value:
-            if init_counter:
-                median_array = median_array*0.75 + 0.25 * pnp.median(
-                    pnp.abs(
-                        pnp.asarray(sneo_shared[:OUT_BUFF_LEN//4*CHANNELS], dtype=pnp.float32)).reshape(-1,CHANNELS), 
-                    axis=0)
-            else:
-                median_array = median_array*0.75 + 0.25 * pnp.median(
-                    pnp.abs(
-                        pnp.asarray(sneo_shared, dtype=pnp.float32)).reshape(-1,CHANNELS), 
-                    axis=0)
-            median_array[0,median_array[0,:]<lower_lim] = lower_lim
-            with spike_thresh:
-                for ch in range(CHANNELS):
-                    spike_thresh[ch] = THRESH_FACTOR * median_array[0,ch]
-        std_vector = pnp.std(pnp.asarray(filtered_shared[:OUT_BUFF_LEN//16*CHANNELS], dtype=pnp.float32).reshape(-1,CHANNELS), axis=0)
-        std_vector[std_vector>noise_max] = noise_max
+        time.sleep(update_time)
+        std_vector = pnp.minimum(noise[1], noise_max)
 
         with shared_noise:
             for mea_id in range(mea_mapping.shape[0]):
@@ -678,7 +1541,8 @@ def update_MAD(
 
 
 def c_spike_poll_process(
-    spike_pipe: mp.connection.Connection,   
+    spike_ring_records, 
+    spike_ring_seq, 
     segment_ids: mp.sharedctypes.synchronized, 
     detected_spike_share_send: mp.connection.Connection,   
     map_matrix, 
@@ -687,38 +1551,49 @@ def c_spike_poll_process(
     store_event, 
     period_over_event, 
     spont_event, 
+    spike_event_fd=None, 
+    latency_probe=None, 
+    spont_flush_pkgs=50_000, 
+    spont_flush_spikes=MAX_LIST_LEN, 
+    spont_flush_time=0., 
 ):
+    """Sort the spikes of the ring into closed loop segments or spontaneous chunks and send them to main.
+    A closed loop segment segment_ids [start, end] is sent as soon as the readout published that all spikes up to its end
+    are in the ring, also when no spike follows it.
+    A spontaneous chunk is sent when it spans spont_flush_pkgs packages, holds spont_flush_spikes spikes or
+    spont_flush_time seconds have passed since its first spike. The time limit is also checked while no spikes arrive,
+    with spont_flush_time = 0 the span of spont_flush_pkgs in seconds is used, 0 for both disables the timer.
+    """
     print(f'PID:{os.getpid()} - Started spike poll process.')
     # store mode 0: discard all, 1: save all, 2: segment, segment_ids [start, end]
-    cdef bytearray spike_buffer_bytes = bytearray(5)
-    spike_buffer_bytes[4] = 0
-
-    global MAX_PKG_ID
-    cdef np.int32_t MAX_PKG_ID_half = MAX_PKG_ID//2
-
-    cdef Py_buffer* buff_ptr 
-    cdef Py_buffer empty_buff # assign for initialisation
-    buff_ptr = &empty_buff
-    PyObject_GetBuffer(spike_buffer_bytes, buff_ptr, 0)
-    cdef char* char_ptr = <char*>buff_ptr.buf
-    cdef np.uint32_t* pkg_ptr = <np.uint32_t*>&char_ptr[1]
-
-    cdef np.uint32_t spont_lim = 0
-    cdef np.uint8_t low_lim = 0
+    # spikes are drained in bulk from the ring written by the readout
+    cdef spike_ring ring = open_spike_ring(spike_ring_records, spike_ring_seq)
+    if spike_event_fd is not None:
+        ring.wake_fd = spike_event_fd
+    cdef np.uint64_t read = ring.seq[SPIKE_RING_READ]
+    # events are read once per drained batch
+    cdef np.uint8_t spont = 0
+    cdef np.uint8_t period_over = 0
+    cdef np.uint64_t write = 0
+    cdef np.uint64_t detected = 0
+    cdef np.uint64_t overrun = 0
+    cdef np.uint32_t record = 0
+    cdef np.uint8_t spike_ch = 0
+    cdef np.uint32_t spike_pkg = 0
+
+    # last package of the open spontaneous chunk
+    cdef np.uint32_t spont_end = 0
+    # segment boundaries are read once per drained batch
+    cdef np.uint32_t segment_start = 0
+    cdef np.uint32_t segment_end = 0
+    cdef np.int8_t segment_pos = 0
 
     cdef np.uint32_t[:] segment_ids_view = segment_ids.get_obj()
     cdef np.uint32_t* segment_ids_ptr = <np.uint32_t*>&segment_ids_view[0]
 
-    cdef np.uint8_t i = 0
-    cdef np.uint8_t j = 0
-
-    cdef np.uint16_t n = 0
-    cdef np.float32_t pkg_in_ms = 1e3/FS
-
-    networks_spike_mat = pnp.empty((NETWORK_NUM, ELECTRODES), dtype=object)
-    for i in range(NETWORK_NUM):
-        for j in range(ELECTRODES):
-            networks_spike_mat[i,j] = tuple()
+    spike_mat_shape = (NETWORK_NUM, ELECTRODES)
+    channel_cells = Spike_matrix.channel_cells(map_matrix, spike_mat_shape)
+    cdef np.uint64_t spont_chunk_id = 0
     cdef np.uint32_t list_len = 0 # delete every 240*
 
     cdef np.uint32_t[MAX_LIST_LEN] spike_store_pkg_a
@@ -727,7 +1602,6 @@ def c_spike_poll_process(
     cdef np.uint8_t* current_ch_ptr = &spike_store_ch_a[0]
     cdef np.uint32_t* current_pkg_ptr = &spike_store_pkg_a[0]
 
-    cdef np.uint32_t local_segment_id = 0
 
     for list_len in range(MAX_LIST_LEN):
         spike_store_ch_a[list_len] = 0
@@ -738,54 +1612,82 @@ def c_spike_poll_process(
     cdef np.uint32_t[:] spike_store_pkg_view = spike_store_pkg_a
     cdef np.uint8_t[:] spike_store_ch_view = spike_store_ch_a
 
-    cdef np.uint32_t max_spont_list_delay = 50_000 # 26_000 # 1.5 sec and fits uint16
+    cdef np.uint32_t max_spont_list_delay = spont_flush_pkgs # 0 to cut chunks only by spike count and time
+    cdef np.uint32_t max_spont_list_len = min(max(spont_flush_spikes, 1), MAX_LIST_LEN)
+    cdef double spont_flush_wall = spont_flush_time if spont_flush_time > 0 else spont_flush_pkgs/FS
+    cdef double spont_chunk_start = 0.
 
 
     while True:
+        # the detected package is read first, all its spikes are then among the written records
+        detected = ring_load_acquire(&ring.seq[SPIKE_RING_DETECTED])
+        write = ring_load_acquire(&ring.seq[SPIKE_RING_WRITE])
+        if write == read:
+            segment_start = segment_ids_ptr[0]
+            segment_end = segment_ids_ptr[1]
+            if (spont and list_len and spont_flush_wall > 0 
+                    and time.monotonic() - spont_chunk_start >= spont_flush_wall and spont_event.is_set()):
+                # no spikes arrived, the open chunk is sent on the timer
+                send_spont_chunk(
+                    detected_spike_share_send, spike_store_ch_view, spike_store_pkg_view, list_len, 
+                    spont_chunk_id, channel_cells, spike_mat_shape)
+                spont_chunk_id += 1
+                list_len = 0
+            elif (segment_start < <np.uint32_t>MAX_PKG_ID and segment_end < <np.uint32_t>MAX_PKG_ID 
+                    and store_event.is_set() and not period_over_event.is_set()):
+                if segment_closed(detected, segment_start, segment_end):
+                    # no spike followed the segment, it is closed by the detected package
+                    send_segment(
+                        detected_spike_share_send, spike_store_ch_view, spike_store_pkg_view, list_len, 
+                        segment_start, segment_end, channel_cells, spike_mat_shape, latency_probe)
+                    list_len = 0
+                    period_over_event.set()
+                    period_over = 1
+                else:
+                    # sleep until the readout announces spikes or passes the end of the open segment
+                    wait_for_spikes(&ring, read, SPIKE_RING_PKG_SET | segment_end)
+            else:
+                # sleep until the readout announces spikes
+                wait_for_spikes(&ring, read, 0)
+            continue
+
         if store_event.is_set(): 
-            if spike_pipe.poll():
-                spike_pipe.recv_bytes_into(spike_buffer_bytes)
-                       
-                if pkg_ptr[0] > segment_ids[1]: # this is the case for stimulation/relevant period
-                    if not period_over_event.is_set():
-                        local_segment_id = segment_ids[0]
-
-                        list_len = min(list_len, MAX_LIST_LEN)
-                        for n in range(list_len):
-                            networks_spike_mat[map_matrix[spike_store_ch_a[n]][0], map_matrix[spike_store_ch_a[n]][1]] += (
-                                <np.float32_t> (spike_store_pkg_a[n] - local_segment_id) * pkg_in_ms, )
-                        print(pkg_ptr[0])
-                        print(segment_ids[1])
-                        print('In stim phase')
-                        detected_spike_share_send.send(networks_spike_mat)
-                        
-                        for i in range(NETWORK_NUM):
-                            for j in range(ELECTRODES):
-                                networks_spike_mat[i,j] = tuple()
+            spont = spont_event.is_set()
+            period_over = period_over_event.is_set()
+            segment_start = segment_ids_ptr[0]
+            segment_end = segment_ids_ptr[1]
+            while read != write:
+                record = ring.records[read & ring.mask]
+                read += 1
+                spike_ch = record & 0xFF
+                spike_pkg = record >> 8
+
+                segment_pos = c_segment_position(spike_pkg, segment_start, segment_end)
+                if segment_pos > 0: # this is the case for stimulation/relevant period
+                    if not period_over:
+                        send_segment(
+                            detected_spike_share_send, spike_store_ch_view, spike_store_pkg_view, list_len, 
+                            segment_start, segment_end, channel_cells, spike_mat_shape, latency_probe)
                         list_len = 0     
 
                         period_over_event.set()
+                        period_over = 1
                     
-                elif pkg_ptr[0] < segment_ids[0]: # if smaller                            
+                elif segment_pos < 0: # before the segment
                     pass
                 else: # for spontaneous spike readout or inside period case
-                    current_ch_ptr[list_len] = char_ptr[0]
-                    current_pkg_ptr[list_len] = pkg_ptr[0]
+                    current_ch_ptr[list_len] = spike_ch
+                    current_pkg_ptr[list_len] = spike_pkg
 
-                    if spont_event.is_set():
+                    if spont:
                         if not list_len:
-                            spont_lim = (pkg_ptr[0] + max_spont_list_delay)
-                            if spont_lim > MAX_PKG_ID:
-                                low_lim = 1
-                                spont_lim = spont_lim - MAX_PKG_ID
-                            else:
-                                low_lim = 0
+                            spont_end = c_pkg_add(spike_pkg, max_spont_list_delay)
+                            spont_chunk_start = time.monotonic()
 
                         list_len += 1
                         if (
-                                list_len >= MAX_LIST_LEN 
-                                or ((not (low_lim)) and pkg_ptr[0] > spont_lim) # past limit
-                                or (low_lim and (pkg_ptr[0] < spont_lim)) # or reset to start number if limit past max_pkg_id
+                                list_len >= max_spont_list_len 
+                                or (max_spont_list_delay and c_pkg_diff(spike_pkg, spont_end) > 0) # past the package span
                         ):
                             # copy_thread = threading.Thread(
                             #     target = copy_data_to_pipe, 
@@ -796,17 +1698,10 @@ def c_spike_poll_process(
                             #     )
                             # )
                             # copy_thread.start()
-                            print(list_len)
-                            for n in range(list_len):
-                                print(spike_store_ch_a[n])
-                                print(spike_store_ch_view[n])
-
-                            detected_spike_share_send.send(
-                                (
-                                    pnp.array(spike_store_ch_view[:list_len], copy=True, dtype=pnp.uint8), 
-                                    pnp.array(spike_store_pkg_view[:list_len], copy=True, dtype=pnp.uint32)
-                                )
-                            )
+                            send_spont_chunk(
+                                detected_spike_share_send, spike_store_ch_view, spike_store_pkg_view, list_len, 
+                                spont_chunk_id, channel_cells, spike_mat_shape)
+                            spont_chunk_id += 1
                             
                             current_ch_ptr = &spike_store_ch_a[0]
                             current_pkg_ptr = &spike_store_pkg_a[0]      
@@ -815,14 +1710,94 @@ def c_spike_poll_process(
                             spike_store_ch_view = spike_store_ch_a
 
                             list_len = 0  
-                    else:
+                    elif list_len < MAX_LIST_LEN - 1:
+                        # a full segment buffer keeps overwriting its last entry instead of writing past the array
                         list_len += 1
-        else:
-            if spike_pipe.poll():
-                spike_pipe.recv_bytes_into(spike_buffer_bytes)
 
+            # the readout passed the segment end, no later spike can fall into the segment
+            if not period_over and segment_closed(detected, segment_start, segment_end):
+                send_segment(
+                    detected_spike_share_send, spike_store_ch_view, spike_store_pkg_view, list_len, 
+                    segment_start, segment_end, channel_cells, spike_mat_shape, latency_probe)
+                list_len = 0
+                period_over_event.set()
+                period_over = 1
+
+            # latency budget of a chunk that receives spikes but reaches neither the spike nor the package limit
+            if spont and list_len and spont_flush_wall > 0 and time.monotonic() - spont_chunk_start >= spont_flush_wall:
+                send_spont_chunk(
+                    detected_spike_share_send, spike_store_ch_view, spike_store_pkg_view, list_len, 
+                    spont_chunk_id, channel_cells, spike_mat_shape)
+                spont_chunk_id += 1
                 list_len = 0
+        else:
+            read = write
+
+            list_len = 0
+
+        # hand the processed records back to the readout
+        ring_store_release(&ring.seq[SPIKE_RING_READ], read)
+
+        if ring.seq[SPIKE_RING_OVERRUN] != overrun:
+            print(f'Warning: Spike ring overrun, readout dropped {ring.seq[SPIKE_RING_OVERRUN] - overrun} spikes')
+            overrun = ring.seq[SPIKE_RING_OVERRUN]
+
+
+cdef inline np.uint8_t segment_closed(np.uint64_t detected, np.uint32_t segment_start, np.uint32_t segment_end) noexcept nogil:
+    """True if the segment is a closed loop segment and the detected package passed its end"""
+    if segment_start >= <np.uint32_t>MAX_PKG_ID or segment_end >= <np.uint32_t>MAX_PKG_ID:
+        return 0
+    return (detected & SPIKE_RING_PKG_SET) != 0 and c_pkg_diff(<np.uint32_t>(detected - SPIKE_RING_PKG_SET), segment_end) >= 0
+
+cdef send_segment(
+        detected_spike_share_send, 
+        np.uint8_t[:] spike_store_ch_view, 
+        np.uint32_t[:] spike_store_pkg_view, 
+        np.uint32_t list_len, 
+        np.uint32_t segment_start, 
+        np.uint32_t segment_end, 
+        channel_cells, 
+        spike_mat_shape, 
+        latency_probe, 
+    ):
+    """Send the first list_len stored spikes as closed loop segment with times relative to its start"""
+    list_len = min(list_len, MAX_LIST_LEN)
+    detected_spike_share_send.send(
+        map_spikes(
+            spike_store_ch_view[:list_len], 
+            spike_store_pkg_view[:list_len], 
+            segment_start, 
+            channel_cells, 
+            spike_mat_shape, 
+        )
+    )
+    if latency_probe is not None:
+        latency_probe.stamp('segment_spikes_sent', segment_end)
 
+cdef send_spont_chunk(
+        detected_spike_share_send, 
+        np.uint8_t[:] spike_store_ch_view, 
+        np.uint32_t[:] spike_store_pkg_view, 
+        np.uint32_t list_len, 
+        np.uint64_t chunk_id, 
+        channel_cells, 
+        spike_mat_shape, 
+    ):
+    """Send the first list_len stored spikes as spontaneous chunk, it is serialised once here and main only forwards the bytes"""
+    detected_spike_share_send.send(
+        encode_chunk(
+            chunk_id, 
+            0, 
+            map_spikes(
+                spike_store_ch_view[:list_len], 
+                spike_store_pkg_view[:list_len], 
+                0, 
+                channel_cells, 
+                spike_mat_shape, 
+                True, 
+            ), 
+        )
+    )
 
 cpdef copy_data_to_pipe(
         detected_spike_share_send: mp.connection.Connection, 
@@ -838,26 +1813,96 @@ cpdef copy_data_to_pipe(
     )
 
 
-cpdef c_map_spikes_to_matrix_tuple(
+cpdef c_map_spikes_to_matrix(
         spike_store_ch,
         spike_store_pkg, 
         np.uint32_t start_id, 
-        networks_spike_mat_empty, 
         map_matrix, 
+        shape, 
         np.uint32_t list_len
     ):
-    cdef np.uint16_t n = 0
-    cdef np.float32_t pkg_in_ms = 1e3/FS
-
-    print(spike_store_ch[:list_len])
-    print(type(spike_store_ch))
-    network_elecs = map_matrix[spike_store_ch[:list_len]]
-    
+    """Map a chunk of detected spikes (receive channel, package id) to a Spike_matrix with times in ms after start_id"""
     # TODO: if assembling from two alternating packages do here 
     list_len = min(list_len, MAX_LIST_LEN)
-    for n in range(list_len):
-        networks_spike_mat_empty[network_elecs[n][0], network_elecs[n][1]] += (
-            <np.float32_t> (spike_store_pkg[n] - start_id) * pkg_in_ms, )
-    return networks_spike_mat_empty
+    return map_spikes(
+        spike_store_ch[:list_len], 
+        spike_store_pkg[:list_len], 
+        start_id, 
+        Spike_matrix.channel_cells(map_matrix, shape), 
+        shape, 
+    )
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def map_spikes(
+        const np.uint8_t[::1] spike_store_ch, 
+        const np.uint32_t[::1] spike_store_pkg, 
+        np.uint32_t start_id, 
+        const np.uint16_t[:] channel_cells, 
+        shape, 
+        bint package_times=False, 
+    ):
+    """Sort a chunk of spikes by network and electrode with a counting sort over the cells.
+    Spikes of receive channels without a cell (UNMAPPED_CELL or past the end of channel_cells) are dropped.
+    Args:
+        spike_store_ch: receive channel of every spike
+        spike_store_pkg: package id of every spike
+        start_id: package id of time 0, the times are the signed distance with wraparound at MAX_PKG_ID
+        channel_cells: cell nw*electrodes + el of every receive channel, see Spike_matrix.channel_cells
+        shape: (networks, electrodes)
+        package_times: times in ms after package 0 without wraparound for spontaneous chunks, start_id is not used
+    Returns:
+        Spike_matrix: spike times in ms after start_id, in arrival order within a cell
+    """
+    cdef Py_ssize_t n_spikes = min(spike_store_ch.shape[0], spike_store_pkg.shape[0])
+    cdef Py_ssize_t n_cells = shape[0]*shape[1]
+    cdef np.float32_t pkg_in_ms = 1e3/FS
+    cdef np.uint16_t[256] cell_table
+    cdef np.uint16_t unmapped = UNMAPPED_CELL
+    cdef Py_ssize_t n = 0
+    cdef Py_ssize_t k = 0
+    cdef np.uint16_t cell = 0
+    cdef np.uint32_t pos = 0
+    cdef np.int64_t pkg_offset = 0
+
+    if n_cells >= unmapped or channel_cells.shape[0] > 256 or (
+            channel_cells.shape[0] and pnp.max(pnp.where(pnp.equal(channel_cells, unmapped), 0, channel_cells)) >= n_cells):
+        raise ValueError(f"Channel cells do not fit the spike matrix of shape {shape}")
+    # every byte of the sentinel is 0xFF, channels past the end of channel_cells are unmapped
+    memset(cell_table, 0xFF, sizeof(cell_table))
+    for k in range(channel_cells.shape[0]):
+        cell_table[k] = channel_cells[k]
+
+    times = pnp.empty(n_spikes, dtype=pnp.float32)
+    index = pnp.empty(n_spikes, dtype=pnp.uint16)
+    offsets = pnp.zeros(n_cells + 1, dtype=pnp.uint32)
+    fill = pnp.empty(n_cells, dtype=pnp.uint32)
+    cdef np.float32_t[::1] times_view = times
+    cdef np.uint16_t[::1] index_view = index
+    cdef np.uint32_t[::1] offsets_view = offsets
+    cdef np.uint32_t[::1] fill_view = fill
+
+    with nogil:
+        # count the spikes per cell, the prefix sum gives the start of every cell
+        for n in range(n_spikes):
+            cell = cell_table[spike_store_ch[n]]
+            if cell != unmapped:
+                offsets_view[cell + 1] += 1
+        for k in range(n_cells):
+            offsets_view[k + 1] += offsets_view[k]
+            fill_view[k] = offsets_view[k]
+        for n in range(n_spikes):
+            cell = cell_table[spike_store_ch[n]]
+            if cell == unmapped:
+                continue
+            pos = fill_view[cell]
+            fill_view[cell] = pos + 1
+            if package_times:
+                pkg_offset = spike_store_pkg[n]
+            else:
+                pkg_offset = c_pkg_diff(spike_store_pkg[n], start_id)
+            times_view[pos] = <np.float32_t>pkg_offset * pkg_in_ms
+            index_view[pos] = cell
 
+    n_spikes = offsets[n_cells]
+    return Spike_matrix(times[:n_spikes], offsets, shape, index[:n_spikes])
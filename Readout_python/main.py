@@ -1,8 +1,8 @@
 """
 This script is the main entry point for the Readout_python application. It sets up various processes and threads for data readout, spike processing, stimulation, and plotting.
 Functions:
-    clear_spikes: Continuously clears spikes from the spike pipes.
-    transmit_spontaneous: Transmits spontaneous spikes to the spike queue and/or raster plot.
+    clear_spikes: Continuously clears spikes from the spike ring.
+    transmit_spontaneous: Transmits spontaneous spikes to the spike stream and the spike queue.
     main: The main function that starts all the processes and threads.
 """
 
@@ -19,12 +19,6 @@ import copy
 import multiprocessing.connection as con
 import datetime
 
-from inkubeSpike import (
-    receive_process, 
-    update_MAD, 
-    c_spike_poll_process, 
-    c_map_spikes_to_matrix_tuple)
-
 from Client_config import (
     FS, 
     CONTROL_NETWORKS,
@@ -53,16 +47,44 @@ from Client_config import (
     SHARED_NOISE_MAX, 
     PC_IP, 
     TEST_SERVER, 
+    TEST_USB_LOOPBACK, 
     NETWORK_SAVE_SPIKES, 
+    SPIKE_RING_LEN, 
+    SPIKE_RING_HEADER, 
+    DO_RECORD, 
+    RECORD_FILTERED, 
+    RECORD_RING_LEN, 
+    RECORD_CHUNK_LEN, 
+    RECORD_FILE_LEN, 
+    DATA_FOLDER, 
+    NOISE_UPDATE_TIME, 
+    SPIKE_STREAM_PORT, 
+    SPIKE_STREAM_QUEUE_LEN, 
+    SPONT_FLUSH_PKGS, 
+    SPONT_FLUSH_SPIKES, 
+    SPONT_FLUSH_TIME, 
 )
 
+from inkubeSpike import (
+    receive_process, 
+    update_MAD, 
+    c_spike_poll_process, 
+    read_spike_ring, 
+    new_spike_event, 
+    record_dtype)
+
+from Data_recorder import record_process
+from Package_clock import Package_clock
+from Spike_stream import Spike_stream_server, decode_chunk
+
 from Plot_stream import (
     plot_process, 
     save_shapes_process)
 from onsite_Stimulation_processor import (
     control_connection_process, 
     stim_segmentation, 
-    blind_send)
+    blind_send, 
+    Stim_timing)
 from Send_commands import (
     prepare_commands_process,
     send_write_to_register, 
@@ -72,6 +94,7 @@ from Send_commands import (
 
 from USB_communication import (
     USB_com, 
+    UDP_test_com, 
     send_commands_process_USB, 
     relay_fpga_commands_process, 
 )
@@ -81,16 +104,16 @@ if not LINUX:
 else:
     import fcntl
 
-def clear_spikes(pipe_a, sleep_duration=0.01):
+def clear_spikes(spike_ring, spike_ring_seq, sleep_duration=0.01):
     """
-    Continuously clears spikes from the spike pipes.
+    Continuously clears spikes from the spike ring.
     Args:
-        pipe_a: The spike pipe.
+        spike_ring: The shared ring of packed spike records.
+        spike_ring_seq: The write, read and overrun counter of the spike ring.
         sleep_duration: The duration to sleep between checks for spikes.
     """
     while True:
-        while pipe_a.poll():
-            _ = np.frombuffer(pipe_a.recv_bytes(4), dtype=np.uint8)
+        _ = read_spike_ring(spike_ring, spike_ring_seq)
         time.sleep(sleep_duration)
 
 def transmit_spontaneous(
@@ -100,57 +123,48 @@ def transmit_spontaneous(
         spont_event, 
         started_pkg, 
         process_id = 0,
+        spike_stream = None, 
     ):
     """
-    Transmits spontaneous spikes to the spike queue and/or raster plot.
+    Transmits spontaneous spikes to the spike stream and the spike queue.
     Args:
-        pipe_in: The input spike pipe.
+        pipe_in: The input spike pipe, carries the chunks encoded by the spike processor.
         spont_spike_q: The queue for transmitting spontaneous spikes.
         transmit: Flag indicating whether to transmit spikes.
         spont_event: The event for controlling transmission of spontaneous spikes.
         started_pkg: The timestamp of the started package.
         process_id: The ID of the process.
+        spike_stream: Spike_stream_server that forwards the encoded chunks unchanged to its subscribers.
     """
-    spike_mat = []
-    networks_spike_mat = np.empty((NETWORK_NUM, ELECTRODES), dtype=object)
-    for i in range(NETWORK_NUM):
-        for j in range(ELECTRODES):
-            networks_spike_mat[i,j] = tuple()
     response = {
         'spontaneous': True, 
         'stim_recv': False, 
-        'spontaneous_spikes': spike_mat, 
+        'spontaneous_spikes': None, 
         'timestamp': datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3], 
         'pkg_id': started_pkg, 
         'process_id': process_id, 
     }
+    queue_dropped = 0
     print(f'Start transmitting with shift of {started_pkg}')
     while True:
         while spont_event.is_set():
-            while pipe_in.poll():
-                spike_mat=pipe_in.recv()
-                num_elements = len(spike_mat[0])
-                print(f"Read spontaneous chunks of size {num_elements}")
-
-                if (transmit) and spike_mat[0].shape:
-                    c_map_spikes_to_matrix_tuple(
-                        spike_mat[0], 
-                        spike_mat[1], 
-                        0, 
-                        networks_spike_mat, 
-                        ELECTRODE_MAPPING.mapping_recv2network, 
-                        num_elements, 
-                    )
-                    
-                    if transmit:
-                        if not spont_spike_q.full():
-                            response['timestamp'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-                            response['spontaneous_spikes'] = np.copy(networks_spike_mat)
-                            spont_spike_q.put(response)
-
-                    for i in range(NETWORK_NUM):
-                        for j in range(ELECTRODES):
-                            networks_spike_mat[i,j] = tuple()
+            while pipe_in.poll(.1):
+                frame = pipe_in.recv()
+                if not transmit:
+                    continue
+                if spike_stream is not None:
+                    spike_stream.publish(frame)
+
+                chunk = decode_chunk(frame)
+                print(f"Read spontaneous chunk {chunk['chunk_id']} of size {chunk['spontaneous_spikes'].times.shape[0]}")
+                if spont_spike_q.full():
+                    queue_dropped += 1
+                    print(f"Warning: Spontaneous spike queue full, dropped {queue_dropped} chunks")
+                else:
+                    response['timestamp'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+                    response['chunk_id'] = chunk['chunk_id']
+                    response['spontaneous_spikes'] = chunk['spontaneous_spikes']
+                    spont_spike_q.put(response)
         spont_event.wait()
 
 
@@ -160,9 +174,21 @@ if __name__ == "__main__":
     """
     print(f'PID:{os.getpid()} - This is the main process.')
 
-    spike_pipe_a_r, spike_pipe_a_w = mp.Pipe(duplex=False)
+    # shared ring for detected spikes, written by the readout and drained in bulk by the spike processor
+    spike_ring = mp_shared.RawArray(c_uint32, SPIKE_RING_LEN)
+    spike_ring_seq = mp_shared.RawArray(c_uint64, SPIKE_RING_HEADER)
+    # wakes the spike processor when the readout published spikes
+    spike_event = new_spike_event()
 
-    # make sure the buffer for the pipe for spikes is large enough
+    # shared ring for the recorded data stream, written by the readout and written to disk by the recorder
+    if DO_RECORD:
+        record_ring = mp_shared.RawArray(c_uint8, RECORD_RING_LEN * record_dtype(RECORD_FILTERED).itemsize)
+        record_ring_seq = mp_shared.RawArray(c_uint64, 4)
+    else:
+        record_ring = None
+        record_ring_seq = None
+
+    # make sure the buffer for the pipes of the stimulation and plot data is large enough
     if not LINUX:
         con.BUFSIZE = 2**18
     else:
@@ -188,6 +214,10 @@ if __name__ == "__main__":
     newest_recv_pkg[1] = 2**22
     newest_recv_pkg[2] = 2**22
     newest_recv_pkg[3] = 0
+    # newest package id published by the readout per block, the stimulation processes block on it
+    pkg_clock = Package_clock()
+    # period timing of the closed and open loop stimulation, changed with the 'timing' command
+    stim_timing = Stim_timing()
     
     plot_spike_wavelet = mp_shared.synchronized(mp_shared.RawArray(c_float, SPIKE_WAVELET_SHAPE[0]*SPIKE_WAVELET_SHAPE[1]*SPIKE_WAVELET_SHAPE[2]))
     plot_spike_wavelet_id = mp_shared.synchronized(mp_shared.RawArray(c_uint32, SPIKE_WAVELET_SHAPE[0]*SPIKE_WAVELET_SHAPE[1]))
@@ -200,6 +230,10 @@ if __name__ == "__main__":
         
 
     spike_thresh_array = mp_shared.synchronized(mp_shared.RawArray(c_float, CHANNELS))
+    # running noise estimate of the readout, median of the detection signal and RMS of the filtered signal per channel
+    noise_stats = mp_shared.RawArray(c_float, 2*CHANNELS)
+    # seqlock sequence of spike_thresh_array, odd while the thresholds are written
+    spike_thresh_seq = mp_shared.RawArray(c_uint64, 1)
     shared_noise_array = mp_shared.synchronized(mp_shared.RawArray(c_float, MEA_NUM*SHARED_NOISE_BINS))
 
     plot_spikes = mp_shared.synchronized(mp_shared.RawArray(c_uint8, PLOT_BUF_LEN * CHANNELS))
@@ -224,6 +258,8 @@ if __name__ == "__main__":
     spont_event = mp.Event()
     if not TEST_SERVER:
         com = USB_com()
+    elif TEST_USB_LOOPBACK:
+        com = UDP_test_com()
     else:
         com = None
         
@@ -231,6 +267,8 @@ if __name__ == "__main__":
         ip=CONTROL_CLIENT_IP, 
         port=CONTROL_CLIENT_PORT, 
         medium_port=ENV_CONTROL_PORT)
+    spike_stream = Spike_stream_server(CONTROL_CLIENT_IP, SPIKE_STREAM_PORT, SPIKE_STREAM_QUEUE_LEN)
+    spike_stream.start()
       
     time.sleep(0.1)
 
@@ -264,7 +302,8 @@ if __name__ == "__main__":
             UDP_rcv_port,
             PC_IP, 
             CLIENT_RECV_PORT, 
-            spike_pipe_a_w,
+            spike_ring, 
+            spike_ring_seq, 
             plot_shared,
             plot_sig,
             plot_spike_wavelet, 
@@ -277,18 +316,37 @@ if __name__ == "__main__":
             plot_temp,
             newest_recv_pkg,
             int(DO_PLOT_RAW),
+            record_ring, 
+            record_ring_seq, 
+            int(RECORD_FILTERED), 
+            noise_stats, 
+            spike_thresh_seq, 
+            update_thresh_bool, 
+            spike_event, 
         ),
+        kwargs={'pkg_clock': pkg_clock}, 
     )
 
+    if DO_RECORD:
+        p_record = mp.Process(
+            target=record_process,
+            name="data_recorder",
+            args=(
+                record_ring, 
+                record_ring_seq, 
+                RECORD_FILTERED, 
+                f'{DATA_FOLDER}/recording', 
+                RECORD_FILE_LEN, 
+                RECORD_CHUNK_LEN, 
+            )
+        )
+
     mea_mapping = np.array([ELECTRODE_MAPPING.mea2recv(range(i*60, (i+1)*60)) for i in range(MEA_NUM)])
     t_update = threading.Thread(
         target=update_MAD, 
         args=(
-            plot_sig, 
-            plot_shared, 
-            2.1, 
-            spike_thresh_array, 
-            update_thresh_bool, 
+            noise_stats, 
+            NOISE_UPDATE_TIME, 
             shared_noise_array, 
             mea_mapping, 
             SHARED_NOISE_BINS, 
@@ -321,7 +379,8 @@ if __name__ == "__main__":
         target=c_spike_poll_process,
         name="spike_processor",
         args=(
-            spike_pipe_a_r, 
+            spike_ring, 
+            spike_ring_seq, 
             segment_ids, 
             detected_spike_share_send, 
             ELECTRODE_MAPPING.mapping_recv2network, 
@@ -330,7 +389,13 @@ if __name__ == "__main__":
             store_event, 
             period_over_event, 
             spont_event, 
-        )
+            spike_event, 
+        ), 
+        kwargs={
+            'spont_flush_pkgs': SPONT_FLUSH_PKGS, 
+            'spont_flush_spikes': SPONT_FLUSH_SPIKES, 
+            'spont_flush_time': SPONT_FLUSH_TIME, 
+        }, 
     )
 
     # process for segmenting into time periods and stimulating, closed loop stimulation
@@ -339,7 +404,7 @@ if __name__ == "__main__":
         name="stim_segmentation",
         args=(
             command_pipe_send,
-            newest_recv_pkg,
+            pkg_clock,
             plot_channels,
             raster_plot_pipe_send,
             segment_ids, 
@@ -347,6 +412,7 @@ if __name__ == "__main__":
             detected_spike_share_recv,
             period_over_event, 
             stim_event, 
+            stim_timing, 
         ),
     )
 
@@ -356,9 +422,10 @@ if __name__ == "__main__":
         name="blind send",
         args=(
             command_pipe_send,
-            newest_recv_pkg,            
+            pkg_clock,            
             stim_pipe_server,                       
             blind_send_event, 
+            stim_timing, 
         ),
     )
 
@@ -393,6 +460,8 @@ if __name__ == "__main__":
 
     # start processess ------------------------------------------------------------------------
     p_spikes.start()
+    if DO_RECORD:
+        p_record.start()
     p_command_transmit.start()
 
     # wait for the UDP port to be set, port to establish uplink communication is sent through USB with downlink
@@ -408,7 +477,7 @@ if __name__ == "__main__":
         p_spike_readout_a.start()
     else:
         p_recv = mp.Process(
-            target=clear_spikes, args=(spike_pipe_a_r, 0.001))
+            target=clear_spikes, args=(spike_ring, spike_ring_seq, 0.001))
         p_recv.start()  # no clearing when processing of spikes
 
     time.sleep(.5)
@@ -442,7 +511,8 @@ if __name__ == "__main__":
             TRANSMIT_SPONT_SPIKES, 
             spont_event, 
             started_pkg, 
-        )
+        ), 
+        kwargs={'spike_stream': spike_stream}, 
     )
     store_event.clear()
     stim_event.clear()
@@ -510,7 +580,7 @@ if __name__ == "__main__":
                                 name="stim_segment",
                                 args=(
                                     command_pipe_send,
-                                    newest_recv_pkg,
+                                    pkg_clock,
                                     plot_channels,
                                     raster_plot_pipe_send,
                                     segment_ids, 
@@ -518,6 +588,7 @@ if __name__ == "__main__":
                                     detected_spike_share_recv,
                                     period_over_event, 
                                     stim_event, 
+                                    stim_timing, 
                                 ),
                             )
 
@@ -570,11 +641,22 @@ if __name__ == "__main__":
                             print("Warning: Invalid digaux key")
                         set_digaux(send_pipe_send, value=digaux_val, pkg_id=new_value)
 
+                    elif command_key == 'timing':
+                        ''' Set the stimulation period timing in ms, applied from the next period '''
+                        try:
+                            timing = stim_timing.set_ms(new_value)
+                            print(f"Set stimulation timing to cycle {timing['cycle']/FS*1e3:.1f} ms, "
+                                  f"response {timing['response_period']/FS*1e3:.1f} ms, min delay {timing['min_delay']/FS*1e3:.1f} ms")
+                        except ValueError as e:
+                            print(f"Warning: {e}")
+
                     else:
                         print("Warning: Invalid command key")
     except KeyboardInterrupt:
         print("interrupted!")
     p_spikes.terminate()
+    if DO_RECORD:
+        p_record.terminate()
     
     if DO_STIMULATE:
         p_stimulator.terminate()
@@ -7,7 +7,10 @@ from datetime import date
 from datetime import datetime
 from multiprocessing.managers import BaseManager
 import multiprocessing.connection as con
+import multiprocessing.sharedctypes as mp_shared
 import socket
+import collections
+from ctypes import c_uint32
 
 # Get current date
 today = date.today()
@@ -31,20 +34,333 @@ from Client_config import (
     ARTEFACT_CANCELLATION, 
 )
 
-from Send_commands import write_to_register
+from Send_commands import write_to_register, Frame_compiler
+from inkubeSpike import Segment_schedule, pkg_add, pkg_diff
+from Latency_probe import probe_stamp
+from Spike_matrix import Spike_matrix
+
+STIM_TIMING_VERSION = 0 # incremented with every change, the stimulation processes apply a new timing from their next period
+STIM_TIMING_POS = {
+    'cycle': 1, # packages between two stimulation periods, STIMULUS_CYCLE
+    'min_delay': 2, # packages between the stimulus deadline and the period start, MIN_PKG_DELAY
+    'response_period': 3, # packages of the closed loop response segment, RESPONSE_IMPORTANT_PERIOD
+    'start_delay': 4, # packages from the start of the segmentation to the first period, START_ID_INIT
+    'detect_delay': 5, # packages stim_segmentation waits past the segment end for its spikes, MAX_SPIKE_DETECT_DELAY
+    'command_delay': 6, # packages between sending a command and its execution in open loop, MIN_STIM_COMMAND_DELAY
+    'profile': 7, # 1 to report the time used per closed loop period, see Cycle_profile
+}
+STIM_TIMING_LEN = 8
+CYCLE_PROFILE_LEN = 1000 # periods kept for the cycle profile
+CYCLE_PROFILE_STEP = 50 # periods between two cycle profile reports
+STIM_PROGRAM_CACHE_LEN = 64 # compiled stimulus matrices kept per stimulation process
+STIM_PROGRAM_REGISTER = 'register' # stimulus id of a program registration on the stim pipe, see Stim_program_cache
+STIM_QUEUE_LEN = 8 # closed loop periods a stimulus can be queued ahead, see Stim_period_queue
+STIM_RECV_POLL_TIMEOUT = 0.01 # seconds the receiving thread of Stim_period_queue waits on the stim pipe before it checks stim_event
+
+class Stim_timing:
+    """Timing of the closed and open loop stimulation in packages, shared with the stimulation processes.
+    The control client changes it with the 'timing' command in ms, e.g. {'timing': {'cycle': 50, 'min_delay': 20}}.
+    A change is applied from the next period, a new cycle also moves the following periods.
+    """
+    def __init__(self):
+        self.values = mp_shared.synchronized(mp_shared.RawArray(c_uint32, STIM_TIMING_LEN))
+        defaults = {
+            'cycle': STIMULUS_CYCLE, 
+            'min_delay': MIN_PKG_DELAY, 
+            'response_period': RESPONSE_IMPORTANT_PERIOD, 
+            'start_delay': START_ID_INIT, 
+            'detect_delay': MAX_SPIKE_DETECT_DELAY, 
+            'command_delay': MIN_STIM_COMMAND_DELAY, 
+            'profile': 0, 
+        }
+        for key, value in defaults.items():
+            self.values[STIM_TIMING_POS[key]] = value
+
+    def version(self):
+        return self.values[STIM_TIMING_VERSION]
+
+    def read(self):
+        """Consistent copy of the timing in packages and its version"""
+        with self.values.get_lock():
+            timing = {key: self.values[pos] for key, pos in STIM_TIMING_POS.items()}
+            timing['version'] = self.values[STIM_TIMING_VERSION]
+        return timing
+
+    def set_ms(self, timing_ms):
+        """Change the timing with values in ms, 'profile' is a flag. Invalid timings raise a ValueError.
+        Returns:
+            dict: the new timing in packages
+        """
+        for key in timing_ms:
+            if key not in STIM_TIMING_POS:
+                raise ValueError(f"Invalid timing key {key}, valid are {list(STIM_TIMING_POS)}")
+        with self.values.get_lock():
+            timing = {key: self.values[pos] for key, pos in STIM_TIMING_POS.items()}
+            for key, value in timing_ms.items():
+                timing[key] = int(bool(value)) if key == 'profile' else int(round(value*1e-3*FS))
+            if timing['cycle'] <= 0 or timing['cycle'] >= MAX_PKG_ID//2:
+                raise ValueError(f"Cycle of {timing['cycle']} packages is out of range")
+            if timing['response_period'] + timing['min_delay'] >= timing['cycle']:
+                raise ValueError(
+                    f"Response period and command delay of {(timing['response_period'] + timing['min_delay'])/FS*1e3:.1f} ms "
+                    f"do not fit into the cycle of {timing['cycle']/FS*1e3:.1f} ms")
+            for key, pos in STIM_TIMING_POS.items():
+                self.values[pos] = timing[key]
+            self.values[STIM_TIMING_VERSION] += 1
+        return timing
+
+class Cycle_profile:
+    """Time used per closed loop period from the segment start until the stimulus of the client was received.
+    A period needs this time plus min_delay to relay the commands, the largest use gives the smallest cycle without skips.
+    """
+    def __init__(self, profile_len=CYCLE_PROFILE_LEN):
+        self.used = collections.deque(maxlen=profile_len)
+        self.periods = 0
+        self.late = 0
+        self.missed = 0
+
+    def add(self, used, received, skipped):
+        """Add a period that used a number of packages, received is False if the stimulus did not arrive in time"""
+        self.periods += 1
+        self.missed += skipped
+        if received:
+            self.used.append(used)
+        else:
+            self.late += 1
+
+    def report(self, timing):
+        """Percentiles of the used time and the smallest cycle for the current response period and min_delay in ms"""
+        report = {
+            'periods': self.periods, 
+            'late': self.late, 
+            'missed': self.missed, 
+            'cycle_ms': timing['cycle']/FS*1e3, 
+        }
+        if self.used:
+            used = np.array(self.used)/FS*1e3
+            report.update({
+                'used_p50_ms': float(np.percentile(used, 50)), 
+                'used_p99_ms': float(np.percentile(used, 99)), 
+                'used_max_ms': float(used.max()), 
+                'min_cycle_ms': float(used.max() + timing['min_delay']/FS*1e3), 
+            })
+        return report
+
+class Stim_program:
+    """Stimulus matrix compiled into the commands of one period, the package ids are added when it is sent.
+    Args:
+        stim_matrix: rows of (delay in packages before the period start, network, electrode)
+        artefact_flags: add the onset commands to the first and the offset commands to the last pulse
+    """
+    def __init__(self, stim_matrix, artefact_flags=False):
+        stim_matrix = np.asarray(stim_matrix)
+        self.stim_delays = -np.unique(-stim_matrix[:, 0])
+        self.stim_matrix = stim_matrix[np.argsort(-stim_matrix[:, 0]),:]
+        # flag is 0, no onset or offset command, just pulses
+        self.flags = np.zeros(self.stim_delays.shape[0], dtype=int)
+        if artefact_flags:
+            self.flags[0] += 1
+            self.flags[-1] += 2
+        self.electrodes = [
+            ELECTRODE_MAPPING.network2mea(self.stim_matrix[np.equal(self.stim_matrix[:, 0], stim_delay),1:])
+            for stim_delay in self.stim_delays]
+        self.stim_chips = [ELECTRODE_MAPPING.mea2stim_chip(electrodes) for electrodes in self.electrodes]
+
+    def stim_pkgs(self, start_id):
+        """Package id of every pulse of a period starting at start_id"""
+        return [
+            int((start_id-stim_delay)%MAX_PKG_ID) if stim_delay >= 0
+            else int(0x80000000 - stim_delay) # for negative relative delay in samples
+            for stim_delay in self.stim_delays]
+
+    def encode(self, frame_compiler, start_id):
+        """Commands of a period starting at start_id for the command pipe, (package id, frame, flag) per pulse"""
+        return [
+            (stim_pkg, frame_compiler.encode(stim_pkg, *self.stim_chips[delay_num], self.flags[delay_num]), self.flags[delay_num])
+            for delay_num, stim_pkg in enumerate(self.stim_pkgs(start_id))]
+
+class Stim_program_cache:
+    """Compiled stimulus programs of a stimulation process.
+    Stimulus matrices are cached by their content with LRU eviction, paradigms that repeat the same matrix compile it once.
+    A client can also register a program with ('register', (program_id, stim_matrix)) on the stim pipe and then send
+    program_id instead of the matrix. Registered programs are not evicted, they belong to the running stimulation process.
+    Args:
+        artefact_flags: add the onset and offset commands, see Stim_program
+        cache_len: number of matrices kept in the cache
+    """
+    def __init__(self, artefact_flags=False, cache_len=STIM_PROGRAM_CACHE_LEN):
+        self.artefact_flags = artefact_flags
+        self.cache_len = cache_len
+        self.programs = collections.OrderedDict()
+        self.registered = {}
+        self.hits = 0
+        self.misses = 0
+
+    def register(self, program_id, stim_matrix):
+        self.registered[program_id] = Stim_program(stim_matrix, self.artefact_flags)
+        print(f"Registered stimulus program {program_id} with {len(stim_matrix)} pulses")
+
+    def get(self, stimulus):
+        """Program of a stimulus matrix or of a registered program id, None if there is nothing to send"""
+        if not isinstance(stimulus, np.ndarray):
+            program = self.registered.get(stimulus)
+            if program is None:
+                print(f"Warning: Unknown stimulus program {stimulus}")
+            return program
+        if not stimulus.shape[0]:
+            return None
+
+        key = (stimulus.dtype.str, stimulus.shape, stimulus.tobytes())
+        program = self.programs.get(key)
+        if program is None:
+            self.misses += 1
+            program = Stim_program(stimulus, self.artefact_flags)
+            self.programs[key] = program
+            if len(self.programs) > self.cache_len:
+                self.programs.popitem(last=False)
+        else:
+            self.hits += 1
+            self.programs.move_to_end(key)
+        return program
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'cached': len(self.programs), 'registered': len(self.registered)}
+
+class Stim_period_queue:
+    """Stimuli of the coming closed loop periods with their command frames encoded ahead of the deadline.
+    A thread receives the stimuli of the client, (period index, stim_matrix or registered program id), while
+    stim_segmentation reads out the current period. It only reads the stim pipe while stim_event is set and is joined
+    when it is cleared, so blind_send is the only reader of the pipe in open loop mode. A stimulus is compiled and encoded for the start of its period as
+    soon as it arrives, for the next period or up to queue_len periods ahead. At the deadline of the next period,
+    min_delay before its start, or as soon as the client answered for it, stim_segmentation commits the frames to the
+    command pipe. A later stimulus for a queued period replaces it, an empty one cancels it.
+    Args:
+        stim_programs: Stim_program_cache of the process, only used by the receiving thread
+        queue_len: periods a stimulus can be queued ahead
+    """
+    def __init__(self, stim_programs, queue_len=STIM_QUEUE_LEN):
+        self.stim_programs = stim_programs
+        self.queue_len = queue_len
+        self.frame_compiler = Frame_compiler()
+        self.condition = threading.Condition()
+        self.periods = {} # period index: program, start id the frames are encoded for, commands
+        self.next_period = None
+        self.next_start = 0
+        self.cycle = 0
+        self.answered = False
+        self.receiver = None
+        self.queued = 0
+        self.committed = 0
+        self.cancelled = 0
+        self.expired = 0
+        self.reencoded = 0
+
+    def start(self, stim_pipe_server, stim_event):
+        """Receive the stimuli in a thread until stim_event is cleared"""
+        self.receiver = threading.Thread(target=self.receive_thread, args=(stim_pipe_server, stim_event), daemon=True)
+        self.receiver.start()
+
+    def stop(self):
+        """Join the receiving thread after stim_event was cleared, the queued periods are dropped"""
+        self.receiver.join()
+        with self.condition:
+            self.expired += len(self.periods)
+            self.periods.clear()
+            self.next_period = None
+            self.answered = False
+
+    def receive_thread(self, stim_pipe_server, stim_event):
+        while stim_event.is_set():
+            if not stim_pipe_server.poll(STIM_RECV_POLL_TIMEOUT):
+                continue
+            stim_id, stim_matrix = stim_pipe_server.recv()
+            try:
+                if stim_id == STIM_PROGRAM_REGISTER:
+                    self.stim_programs.register(*stim_matrix)
+                else:
+                    self.put(stim_id, stim_matrix)
+            except Exception as e:
+                print(f"Warning: Invalid stimulus {stim_id} with {e}")
+
+    def set_next(self, period, start_id, cycle):
+        """Move on to the next period, the queued periods before it expire.
+        It is set before the response is sent, so the answer of the client is not taken for a stimulus queued ahead,
+        and again with the start after skipped periods or a new timing."""
+        with self.condition:
+            for queued in list(self.periods):
+                if not 0 <= queued - period < self.queue_len:
+                    del self.periods[queued]
+                    self.expired += 1
+            if period != self.next_period:
+                self.answered = False
+            self.next_period = period
+            self.next_start = start_id
+            self.cycle = cycle
+
+    def put(self, period, stimulus):
+        """Queue the stimulus of a period and encode its frames"""
+        program = self.stim_programs.get(stimulus)
+        with self.condition:
+            if self.next_period is None or not 0 <= period - self.next_period < self.queue_len:
+                print(f"Mismatch received {period} for period {self.next_period}")
+                return
+            if program is None:
+                self.cancelled += self.periods.pop(period, None) is not None
+            else:
+                start_id = pkg_add(self.next_start, (period - self.next_period)*self.cycle)
+                self.periods[period] = (program, start_id, program.encode(self.frame_compiler, start_id))
+                self.queued += 1
+            if period == self.next_period:
+                self.answered = True
+                self.condition.notify_all()
+
+    def wait_answer(self, timeout):
+        """Block until the client sent the stimulus of the next period, for Package_clock.wait_until"""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.answered, timeout)
+
+    def take(self, period, start_id):
+        """Remove the stimulus of a period, the frames are encoded again if the period moved since it was queued.
+        Returns:
+            Stim_program and its commands for the command pipe, None and () without a stimulus
+        """
+        with self.condition:
+            entry = self.periods.pop(period, None)
+            if entry is None:
+                return None, ()
+            program, encoded_start, commands = entry
+            if encoded_start != start_id:
+                commands = program.encode(self.frame_compiler, start_id)
+                self.reencoded += 1
+            self.committed += 1
+            return program, commands
+
+    def stats(self):
+        return {
+            'queued': self.queued, 
+            'committed': self.committed, 
+            'cancelled': self.cancelled, 
+            'expired': self.expired, 
+            'reencoded': self.reencoded, 
+            'frames': self.frame_compiler.stats(), 
+        }
 
 def blind_send(
     command_pipe: con.Connection,
-    newest_receive_pkg_id,          
+    pkg_clock,          
     stim_pipe_server,                         
     blind_send_event, 
+    stim_timing=None, 
 ):
     print(f'PID:{os.getpid()} - Started blind stim process.')
+    if stim_timing is None:
+        stim_timing = Stim_timing()
     stim_id = 0
     index = 0
     recv_flag = False
     last_index_rec = 0
     stim_matrix = np.array([])
+    stim_programs = Stim_program_cache()
 
     response = {
         'spikes': None, 
@@ -58,20 +374,16 @@ def blind_send(
 
     
     while True:
-        start_id = ((newest_receive_pkg_id[0]//STIMULUS_CYCLE)*STIMULUS_CYCLE + START_ID_INIT) % MAX_PKG_ID
+        # open loop periods without a response segment
+        timing = stim_timing.read()
+        schedule = Segment_schedule((pkg_clock.now()//timing['cycle'])*timing['cycle'] + timing['start_delay'], timing['cycle'], 0)
+        start_id = schedule.start
 
         while blind_send_event.is_set():         
-            current_receive_id = newest_receive_pkg_id[0]
-            while (
-                    MAX_PKG_ID//2 < ((
-                        start_id - current_receive_id # When this term is negative break
-                        + ((3*MAX_PKG_ID)//2)) % MAX_PKG_ID)):
-                time.sleep(1e-3)
-                # print("Waiting for end of segment")
-                current_receive_id = newest_receive_pkg_id[0]        
+            pkg_clock.wait_until(start_id)
 
             # index is the number of period
-            index = start_id // STIMULUS_CYCLE
+            index = start_id // schedule.cycle
 
             # send out data and index
             response['index'] = index
@@ -82,71 +394,50 @@ def blind_send(
             recv_flag = False
             
             # move to next period ---------------------------------------------------------------------------------------------
-            start_id = (start_id + STIMULUS_CYCLE) % MAX_PKG_ID
-
-            # check whether send out point can be reached or delay of processing is too big ?, otherwise skipo period
-            current_receive_id = newest_receive_pkg_id[0]
-            while (
-                    MAX_PKG_ID//2 > ((
-                        start_id-MIN_PKG_DELAY - current_receive_id # When this term is positive break
-                        + ((3*MAX_PKG_ID)//2)) % MAX_PKG_ID)):
-                start_id = (start_id + STIMULUS_CYCLE) % MAX_PKG_ID
-                current_receive_id = newest_receive_pkg_id[0]
+            if stim_timing.version() != timing['version']:
+                timing = stim_timing.read()
+                schedule = Segment_schedule(start_id, timing['cycle'], 0)
+                print(f"New timing from period {index+1}: {timing}")
+            schedule.advance()
+
+            # skip the periods whose send out point can not be reached because the delay of processing is too big
+            skipped = schedule.skip_to(pkg_clock.now(), timing['min_delay'])
+            start_id = schedule.start
+            if skipped:
                 print(
-                    f"Missed period {index}, increased to start_id {start_id} with overhead {(start_id-newest_receive_pkg_id[0])/FS*1000 :.3f}"
+                    f"Missed {skipped} period(s) after {index}, increased to start_id {start_id} with overhead {pkg_diff(start_id, pkg_clock.now())/FS*1000 :.3f}"
                 )     
 
             # Here the wait period ends ----------------------------------------------
-            current_receive_id = newest_receive_pkg_id[0]
-            while ((
-                        MAX_PKG_ID//2 < ((
-                            start_id-MIN_PKG_DELAY - current_receive_id # When this term is negative break
-                            + ((3*MAX_PKG_ID)//2)) % MAX_PKG_ID))):
-                time.sleep(1e-3)
-                current_receive_id = newest_receive_pkg_id[0]
-                # print(f"Waiting for commands at {start_id} at current receive {current_receive_id}")
-                if stim_pipe_server.poll():
-                    # set amplitude or delays here
-                    stimulus = stim_pipe_server.recv()
-                    stim_id, stim_matrix = stimulus
-                    if stim_id != index + 1:
-                        stim_matrix = np.array([])
-                        print(f"Mismatch received {stim_id} for period {index+1}")                    
-                    else:
-                        recv_flag = True
-                        break
-
-            if stim_matrix.shape[0]:
-                
-                # print(f"Min Distance for stim: {stimulus_timing_min_dist}")
-                stim_delays = -np.unique(-stim_matrix[:, 0])
-                stim_matrix = stim_matrix[np.argsort(-stim_matrix[:, 0]),:]
-
-                # flag is 0, no onset or offset command, just pulses
-                all_flags = np.zeros(stim_delays.shape[0], dtype=int)              
+            while pkg_clock.wait_until(pkg_add(start_id, -timing['min_delay']), stim_pipe_server.poll):
+                # set amplitude or delays here
+                stimulus = stim_pipe_server.recv()
+                stim_id, stim_matrix = stimulus
+                if stim_id == STIM_PROGRAM_REGISTER:
+                    stim_programs.register(*stim_matrix)
+                    stim_matrix = np.array([])
+                elif stim_id != index + 1:
+                    stim_matrix = np.array([])
+                    print(f"Mismatch received {stim_id} for period {index+1}")                    
+                else:
+                    recv_flag = True
+                    break
+
+            program = stim_programs.get(stim_matrix)
+            if program is not None:
+                stim_delays = program.stim_delays
+                stim_matrix = program.stim_matrix
 
                 if stim_delays.shape[0] > 7: # as the fifo is too small send the packages delayed
                     stim_pkgs = (start_id-stim_delays)%MAX_PKG_ID
                     for delay_num, stim_pkg in enumerate(stim_pkgs):
                         # block until just before stim command
-                        current_receive_id = newest_receive_pkg_id[0]
-                        while ((
-                                MAX_PKG_ID//2 < ((
-                                    stim_pkg-MIN_STIM_COMMAND_DELAY - current_receive_id # When this term is negative break
-                                    + ((3*MAX_PKG_ID)//2)) % MAX_PKG_ID))):
-                            time.sleep(1e-3)
-                            current_receive_id = newest_receive_pkg_id[0]
-
-                        command_pipe.send(
-                            (
-                                stim_pkg, 
-                                ELECTRODE_MAPPING.network2mea(stim_matrix[np.equal(stim_matrix[:, 0], stim_delays[delay_num]),1:]), 
-                                all_flags[delay_num]
-                            )
-                        )
+                        pkg_clock.wait_until(pkg_add(stim_pkg, -timing['command_delay']))
+
+                        command_pipe.send((stim_pkg, program.electrodes[delay_num], program.flags[delay_num]))
                     if not index % PRINT_STEP:
                         print(
-                            f"stimulate commands sent out stepwise: {(start_id-newest_receive_pkg_id[0])/FS*1000 :.3f} ms before stim with points {stim_pkgs} - {start_id}"
+                            f"stimulate commands sent out stepwise: {pkg_diff(start_id, pkg_clock.now())/FS*1000 :.3f} ms before stim with points {stim_pkgs} - {start_id}"
                         )
                 elif stim_delays.shape[0]: # this is the standard case where all commands are sent at once ahead of time
                     for delay_num, stim_delay in enumerate(stim_delays):
@@ -154,26 +445,22 @@ def blind_send(
                             stim_pkg = (start_id-stim_delay)%MAX_PKG_ID
                         else:
                             stim_pkg = 0x80000000 - stim_delay # for negative rerlative delay in samples
-                        command_pipe.send(
-                            (
-                                stim_pkg, 
-                                ELECTRODE_MAPPING.network2mea(stim_matrix[np.equal(stim_matrix[:, 0], stim_delay),1:]), 
-                                all_flags[delay_num]
-                            )
-                        )  
+                        command_pipe.send((stim_pkg, program.electrodes[delay_num], program.flags[delay_num]))
                     if not index % PRINT_STEP:
                         print(
-                            f"stimulate commands sent out: {(start_id-newest_receive_pkg_id[0])/FS*1000 :.3f} ms before stim with points {stim_delays} - {start_id}"
+                            f"stimulate commands sent out: {pkg_diff(start_id, pkg_clock.now())/FS*1000 :.3f} ms before stim with points {stim_delays} - {start_id}"
                         )
 
                 response['stim'] = stim_matrix
-                
+
+                stim_matrix = np.array([])
+            else:
                 stim_matrix = np.array([])
         blind_send_event.wait()
 
 def stim_segmentation(
     command_pipe: con.Connection,
-    newest_receive_pkg_id,
+    pkg_clock,
     plot_channels,
     raster_plot_pipe,
     segment_ids,
@@ -181,10 +468,15 @@ def stim_segmentation(
     detected_spike_share_recv,  
     period_over_event, 
     stim_event, 
+    stim_timing=None, 
+    latency_probe=None, 
 ):
-    """readout recorded spikes and send out stimulation"""
+    """readout recorded spikes and send out stimulation, the periods follow stim_timing (Client_config if None)
+    latency_probe (Latency_probe) is stamped with the responses, stimuli and queued commands, None for no stamps"""
 
     print(f'PID:{os.getpid()} - Started stim segmentation process.')
+    if stim_timing is None:
+        stim_timing = Stim_timing()
     # print("Emptying pipes")
     # while stim_pipe_server.poll():
     #     print("Somehow stim detected")
@@ -197,16 +489,15 @@ def stim_segmentation(
     # STIMULUS_CYCLE roughly 250 ms
     # RESPONSE_IMPORTANT_PERIOD roughly  20 ms
 
-    networks_spike_mat = np.empty((NETWORK_NUM, ELECTRODES), dtype=object)
-    for j in np.ndindex(networks_spike_mat.shape):
-        networks_spike_mat[j] = tuple()
-
-    empty_spike_mat = np.copy(networks_spike_mat)
+    empty_spike_mat = Spike_matrix.empty((NETWORK_NUM, ELECTRODES))
+    networks_spike_mat = empty_spike_mat
 
     index = 0
     recv_flag = False
     last_index_rec = 0
     stim_matrix = np.array([])
+    # the stimuli are received by the thread of the queue, also for later periods
+    period_queue = Stim_period_queue(Stim_program_cache(ARTEFACT_CANCELLATION))
 
     response = {
         'spikes': networks_spike_mat, 
@@ -219,34 +510,30 @@ def stim_segmentation(
     PRINT_STEP = 10
 
     # block until readout processing begins
-    while newest_receive_pkg_id[0] == 2**22:
-        time.sleep(1e-3)
+    pkg_clock.wait_started()
 
     print(f"Start Spike Processor")
     
     while True:
-        start_id = ((newest_receive_pkg_id[0]//STIMULUS_CYCLE)*STIMULUS_CYCLE + START_ID_INIT) % MAX_PKG_ID
+        timing = stim_timing.read()
+        cycle_profile = Cycle_profile()
+        schedule = Segment_schedule(
+            (pkg_clock.now()//timing['cycle'])*timing['cycle'] + timing['start_delay'], timing['cycle'], timing['response_period'])
+        start_id = schedule.start
         # with segment_ids:
-        segment_ids[0] = start_id
-        if ((start_id+RESPONSE_IMPORTANT_PERIOD) % MAX_PKG_ID) < segment_ids[0]:
-            segment_ids[1] = MAX_PKG_ID-1
-        else:
-            segment_ids[1] = (start_id+RESPONSE_IMPORTANT_PERIOD) % MAX_PKG_ID
+        segment_ids[0] = schedule.start
+        segment_ids[1] = schedule.end
         period_over_event.clear()
 
-        print(f"Starting segmentation with {segment_ids[0]} to {segment_ids[1]} at {newest_receive_pkg_id[0]}")
+        print(f"Starting segmentation with {segment_ids[0]} to {segment_ids[1]} at {pkg_clock.now()}")
+        period_queue.start(stim_pipe_server, stim_event)
         while stim_event.is_set():
             # Wait here depending on index
             with segment_ids:
-                upper_wait_limit = (segment_ids[1]+MAX_SPIKE_DETECT_DELAY) % MAX_PKG_ID
-            current_receive_id = newest_receive_pkg_id[0]
-            while (not period_over_event.is_set() and (
-                    MAX_PKG_ID//2 < ((
-                        upper_wait_limit - current_receive_id # When this term is negative break
-                        + ((3*MAX_PKG_ID)//2)) % MAX_PKG_ID))):
-                time.sleep(1e-3)
-                # print("Waiting for end of segment")
-                current_receive_id = newest_receive_pkg_id[0]
+                upper_wait_limit = pkg_add(segment_ids[1], timing['detect_delay'])
+            # the spike processor sets period_over_event when the spikes of the segment are sent
+            pkg_clock.wait_until(upper_wait_limit, period_over_event.wait)
+            current_receive_id = pkg_clock.now()
 
             if period_over_event.is_set(): 
                 while detected_spike_share_recv.poll():
@@ -255,11 +542,12 @@ def stim_segmentation(
                 while detected_spike_share_recv.poll():
                     detected_spike_share_recv.recv()
                 period_over_event.set()
-                networks_spike_mat = np.copy(empty_spike_mat)           
+                networks_spike_mat = empty_spike_mat
 
             # index is the number of period
             last_index_rec = index
-            index = start_id // STIMULUS_CYCLE
+            index = start_id // schedule.cycle
+            segment_start = start_id
 
             # send out data and index
             response['spikes'] = networks_spike_mat
@@ -267,86 +555,60 @@ def stim_segmentation(
             response['index'] = index
             response['stim_recv'] = recv_flag
 
+            # the next period is set before the response, the answer of the client may arrive at once
+            period_queue.set_next(index + 1, pkg_add(start_id, schedule.cycle), schedule.cycle)
             stim_pipe_server.send(response)
+            segment_end = segment_ids[1]
+            probe_stamp(latency_probe, 'segment_response_sent', segment_end)
 
 
             if not index % PRINT_STEP:
                 print(
-                    f"{(current_receive_id-start_id)/FS*1000 :.3f} ms:: Finished for period {index}"
+                    f"{pkg_diff(current_receive_id, start_id)/FS*1000 :.3f} ms:: Finished for period {index}"
                 )
             recv_flag = False
             
             # move to next period ---------------------------------------------------------------------------------------------
-            start_id = (start_id + STIMULUS_CYCLE) % MAX_PKG_ID
-
-            # ? check whether send out point can be reached or delay of processing is too big ?
-            current_receive_id = newest_receive_pkg_id[0]
-            while (
-                    MAX_PKG_ID//2 > ((
-                        start_id-MIN_PKG_DELAY - current_receive_id # When this term is negative break
-                        + ((3*MAX_PKG_ID)//2)) % MAX_PKG_ID)):
-                start_id = (start_id + STIMULUS_CYCLE) % MAX_PKG_ID
-                current_receive_id = newest_receive_pkg_id[0]
+            if stim_timing.version() != timing['version']:
+                timing = stim_timing.read()
+                schedule = Segment_schedule(start_id, timing['cycle'], timing['response_period'])
+                cycle_profile = Cycle_profile()
+                print(f"New timing from period {index+1}: {timing}")
+            schedule.advance()
+
+            # skip the periods whose send out point can not be reached because the delay of processing is too big
+            skipped = schedule.skip_to(pkg_clock.now(), timing['min_delay'])
+            start_id = schedule.start
+            if skipped:
                 print(
-                    f"Missed period {index}, increased to start_id {start_id} with overhead {(start_id-newest_receive_pkg_id[0])/FS*1000 :.3f}"
+                    f"Missed {skipped} period(s) after {index}, increased to start_id {start_id} with overhead {pkg_diff(start_id, pkg_clock.now())/FS*1000 :.3f}"
                 )     
 
-            segment_ids[0] = start_id
-            if ((start_id+RESPONSE_IMPORTANT_PERIOD) % MAX_PKG_ID) < segment_ids[0]:
-                segment_ids[1] = MAX_PKG_ID-1
-            else:
-                segment_ids[1] = (start_id+RESPONSE_IMPORTANT_PERIOD) % MAX_PKG_ID
+            segment_ids[0] = schedule.start
+            segment_ids[1] = schedule.end
 
             # Here the wait period ends ----------------------------------------------
-            current_receive_id = newest_receive_pkg_id[0]
-            while ((
-                        MAX_PKG_ID//2 < ((
-                            start_id-MIN_PKG_DELAY - current_receive_id # When this term is negative break
-                            + ((3*MAX_PKG_ID)//2)) % MAX_PKG_ID))):
-                time.sleep(1e-3)
-                current_receive_id = newest_receive_pkg_id[0]
-                # print(f"Waiting for commands at {start_id} at current receive {current_receive_id}")
-                if stim_pipe_server.poll():
-                    # set amplitude or delays here
-                    stimulus = stim_pipe_server.recv()
-                    stim_id, stim_matrix = stimulus
-                    if stim_id != index + 1:
-                        stim_matrix = np.array([])
-                        print(f"Mismatch received {stim_id} for period {index+1}")                    
-                    else:
-                        recv_flag = True
-                        break
-
-            if stim_matrix.shape[0]:
-                
-                # print(f"Min Distance for stim: {stimulus_timing_min_dist}")
-
-                stim_delays = -np.unique(-stim_matrix[:, 0])
-                stim_matrix = stim_matrix[np.argsort(-stim_matrix[:, 0]),:]
-
-                all_flags = np.zeros(stim_delays.shape[0], dtype=int)                
-
-                # flag is 0, add onset or offset command, just pulses
-                if ARTEFACT_CANCELLATION:
-                    all_flags[0] += 1
-                    all_flags[-1] += 2
-            
-                for delay_num, stim_delay in enumerate(stim_delays):
-                    if stim_delay >= 0:
-                        stim_pkg = (start_id-stim_delay)%MAX_PKG_ID
-                    else:
-                        stim_pkg = 0x80000000 - stim_delay # for negative rerlative delay in samples
-                    command_pipe.send(
-                        (
-                            stim_pkg, 
-                            ELECTRODE_MAPPING.network2mea(stim_matrix[np.equal(stim_matrix[:, 0], stim_delay),1:]), 
-                            all_flags[delay_num]
-                        )
-                    )     
-                    # print(f'Received stim electrodes are {ELECTRODE_MAPPING.network2mea(stim_matrix[np.equal(stim_matrix[:, 0], stim_delay),1:])}, because mapping is {ELECTRODE_MAPPING.network2mea(np.array([[n//15, n%15] for n in range(60)]))} and received is {stim_matrix} at {stim_delay}')           
-                    # print(f"Sending out with {stim_delay}, and flags {all_flags[delay_num]}, shape is {len(ELECTRODE_MAPPING.network2mea(stim_matrix[np.equal(stim_matrix[:, 0], stim_delay),1:]))}")
+            # the frames of the next period are committed when the client answered or at the deadline if it was queued ahead
+            period_queue.set_next(index + 1, start_id, schedule.cycle)
+            if pkg_clock.wait_until(pkg_add(start_id, -timing['min_delay']), period_queue.wait_answer):
+                recv_flag = True
+                probe_stamp(latency_probe, 'stimulus_received', segment_end)
+
+            if timing['profile']:
+                cycle_profile.add(pkg_diff(pkg_clock.now(), segment_start), recv_flag, skipped)
+                if not cycle_profile.periods % CYCLE_PROFILE_STEP:
+                    response['cycle_profile'] = cycle_profile.report(timing)
+                    print(f"Cycle profile: {response['cycle_profile']}")
+
+            program, commands = period_queue.take(index + 1, start_id)
+            if program is not None:
+                stim_matrix = program.stim_matrix
+
+                for command in commands:
+                    command_pipe.send(command)
+                    probe_stamp(latency_probe, 'commands_queued', command[0])
             else:
-                stim_delays = (0)
+                stim_matrix = np.array([])
             
 
             # start readout again
@@ -354,7 +616,7 @@ def stim_segmentation(
 
             if not index % PRINT_STEP:
                 print(
-                    f"stimulate commands sent out: {(start_id-newest_receive_pkg_id[0])/FS*1000 :.3f} ms before stim with points {stim_delays} - {start_id}"
+                    f"stimulate commands sent out: {pkg_diff(start_id, pkg_clock.now())/FS*1000 :.3f} ms before stim with points {program.stim_delays if program is not None else []} - {start_id}, programs {period_queue.stim_programs.stats()}, queue {period_queue.stats()}"
                 )
                 # print(f"Timing: Wait for period {t1*1e3:.3f} plus poll total {t2*1e3:.3f} Spike conversion {t3*1e3:.3f} put on q {t4*1e3:.3f} wait for stim {t5*1e3:.3f} receive commands {t6*1e3:.3f}  send {t7*1e3:.3f}")
 
@@ -381,7 +643,8 @@ def stim_segmentation(
             response['stim'] = stim_matrix
             
             stim_matrix = np.array([])
-            skipped_period = False
+        # the stim pipe belongs to blind_send until stim_event is set again
+        period_queue.stop()
         stim_event.wait()
 
 
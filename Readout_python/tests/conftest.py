@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the modules of Readout_python are imported by name, inkubeSpike has to be built there with setup_filter.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+# Spike_matrix and Spike_stream are shared with the client, as for Client_config
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Communication'))
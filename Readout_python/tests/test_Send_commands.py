@@ -0,0 +1,90 @@
+"""
+Frame_compiler of Send_commands.py against the word by word encoder of prepare_commands_process it replaced.
+"""
+import copy
+import random
+
+import numpy as np
+import pytest
+
+from Client_config import ELECTRODE_MAPPING, MAX_PKG_ID, STIMULATION_DURATION, DISCHARGE_TIME, WORD_LENGTH_IN_BYTES
+from Send_commands import (
+    DELAYS_FLAG_DEPENDENT,
+    EMPTY_COMMAND_WORD,
+    ONSET_COMMAND,
+    OFFSET_COMMAND,
+    STIMULATION_ON_REG,
+    STIMULATION_POL,
+    Frame_compiler,
+    get_command_pos_from_source,
+    set_stimulus_timing_local,
+    write_to_register,
+)
+
+def reference_encode(pkg_id, electrode_array, position_flag):
+    """Command frame as built by prepare_commands_process before Frame_compiler.
+    The old code byte-swapped the combined discharge mask of a chip with several electrodes, it is written in the
+    order of the stimulation on write here as by Frame_compiler."""
+    stimulus_timing_local = set_stimulus_timing_local(STIMULATION_DURATION, DISCHARGE_TIME)
+    command_frame = copy.copy(EMPTY_COMMAND_WORD) * len(DELAYS_FLAG_DEPENDENT[position_flag])
+
+    def write(package_num, command_pos, command):
+        pos = command_pos * 4 + package_num * WORD_LENGTH_IN_BYTES
+        command_frame[pos:pos + len(command)] = command
+
+    for pos, delay_num in enumerate(DELAYS_FLAG_DEPENDENT[position_flag]):
+        send_pkg_id = np.uint32((pkg_id + stimulus_timing_local[delay_num]) % MAX_PKG_ID + (pkg_id & 0x80000000))
+        write(pos, 1, bytearray([(send_pkg_id >> (i * 8)) % 256 for i in range(4)]))
+
+    if position_flag == 1 or position_flag == 3:
+        command_frame[8:WORD_LENGTH_IN_BYTES] = ONSET_COMMAND
+        start_package = 1
+    else:
+        start_package = 0
+    if position_flag == 2 or position_flag == 3:
+        command_frame[-WORD_LENGTH_IN_BYTES + 8 :] = OFFSET_COMMAND
+
+    stim_chips = []
+    for electrode_source in ELECTRODE_MAPPING.mea2stim(electrode_array):
+        mea = electrode_source // 60
+        chip = (electrode_source % 60) // 15
+        el = electrode_source % 15
+        command_pos = get_command_pos_from_source((mea, chip)) + 1
+        stim_el_pos = np.uint16(1 << el)
+        d = [(stim_el_pos >> 8) % 256, stim_el_pos % 256]  # MSB, LSB
+        if command_pos not in stim_chips:
+            write(start_package, command_pos, write_to_register(STIMULATION_ON_REG, d))
+            write(start_package + 1, command_pos, write_to_register(STIMULATION_POL, [0x00] * 2))
+            write(start_package + 2, command_pos, write_to_register(STIMULATION_ON_REG, [0] * 2))
+            write(start_package + 2, command_pos + 1, write_to_register(48, d))
+            write(start_package + 3, command_pos, write_to_register(48, [0] * 2))
+            write(start_package + 3, command_pos + 1, write_to_register(STIMULATION_POL, [0xFF] * 2))
+            stim_chips.append(command_pos)
+        else:
+            pos = command_pos * 4 + start_package * WORD_LENGTH_IN_BYTES
+            d_temp = command_frame[pos:pos + 2]
+            d_flipped = [d[1], d[0]]  # now LSB leading
+            d_combined = [d_flipped[i] + d_temp[i] for i in range(2)]
+            write(start_package, command_pos, bytearray(d_combined))
+            write(start_package + 2, command_pos + 1, write_to_register(48, d_combined[::-1]))
+    return command_frame
+
+def compiled_encode(frame_compiler, pkg_id, electrode_array, position_flag):
+    stim_chips, stim_bits = ELECTRODE_MAPPING.mea2stim_chip(electrode_array)
+    return frame_compiler.encode(pkg_id, stim_chips, stim_bits, position_flag)
+
+@pytest.mark.parametrize('position_flag', [0, 1, 2, 3])
+def test_frame_compiler_matches_reference(position_flag):
+    rng = random.Random(position_flag)
+    n_electrodes = ELECTRODE_MAPPING.mapping_mea2fpga.shape[0]
+    frame_compiler = Frame_compiler(cache_len=4)
+    for pkg_id in [0, 1_000, MAX_PKG_ID - 3, 0x80000000]:
+        for n_stim in [1, 2, 5, 16]:
+            electrode_array = np.array(rng.sample(range(n_electrodes), n_stim))
+            expected = reference_encode(pkg_id, electrode_array, position_flag)
+            assert compiled_encode(frame_compiler, pkg_id, electrode_array, position_flag) == expected
+            # a cached frame only gets the new package ids
+            expected = reference_encode(pkg_id + 7, electrode_array, position_flag)
+            assert compiled_encode(frame_compiler, pkg_id + 7, electrode_array, position_flag) == expected
+    assert frame_compiler.stats()['hits'] == 16
+    assert frame_compiler.stats()['cached'] == 4
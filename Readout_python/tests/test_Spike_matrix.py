@@ -0,0 +1,47 @@
+"""
+Compressed sparse row Spike_matrix of Communication/Spike_matrix.py and its binary form.
+"""
+import numpy as np
+import pytest
+
+from Spike_matrix import Spike_matrix
+
+SHAPE = (3, 4) # (networks, electrodes)
+
+def example_matrix():
+    # cells nw*electrodes + el, the spikes of cell 5 arrive in the order 1.5, 0.5
+    cells = [5, 0, 11, 5]
+    times = [1.5, 2., 3., 0.5]
+    return Spike_matrix.from_cells(cells, times, SHAPE)
+
+def test_from_cells_groups_by_cell():
+    spike_mat = example_matrix()
+    assert spike_mat.offsets.shape[0] == SHAPE[0]*SHAPE[1] + 1
+    np.testing.assert_array_equal(spike_mat.index, [0, 5, 5, 11])
+    np.testing.assert_array_equal(spike_mat[0, 0], [2.])
+    np.testing.assert_array_equal(spike_mat[1, 1], [1.5, 0.5])
+    np.testing.assert_array_equal(spike_mat[2, 3], [3.])
+    np.testing.assert_array_equal(spike_mat[-1, -1], [3.])
+    assert spike_mat[0, 1].shape[0] == 0
+    assert [times.shape[0] for times in spike_mat[1]] == [0, 2, 0, 0]
+
+def test_bytes_round_trip():
+    spike_mat = example_matrix()
+    buffer = b'\x00'*3 + spike_mat.to_bytes()
+    decoded = Spike_matrix.from_bytes(buffer, 3)
+    assert decoded.shape == SHAPE
+    np.testing.assert_array_equal(decoded.offsets, spike_mat.offsets)
+    np.testing.assert_array_equal(decoded.times, spike_mat.times)
+    np.testing.assert_array_equal(decoded.index, spike_mat.index)
+
+def test_empty_round_trip():
+    decoded = Spike_matrix.from_bytes(Spike_matrix.empty(SHAPE).to_bytes())
+    assert decoded.shape == SHAPE
+    assert decoded.times.shape[0] == 0
+    assert not np.any(decoded.offsets)
+
+def test_invalid_offsets_and_index():
+    with pytest.raises(ValueError):
+        Spike_matrix(np.zeros(0), np.zeros(SHAPE[0]*SHAPE[1]), SHAPE)
+    with pytest.raises(IndexError):
+        example_matrix()[SHAPE[0], 0]
@@ -0,0 +1,64 @@
+"""
+Chunk encoding and TCP framing of the spontaneous spike stream, Communication/Spike_stream.py, over localhost.
+"""
+import time
+
+import numpy as np
+import pytest
+
+from Spike_matrix import Spike_matrix
+from Spike_stream import (
+    CHUNK_HEADER,
+    encode_chunk,
+    decode_chunk,
+    Spike_stream,
+    Spike_stream_server,
+    Spike_stream_subscriber,
+)
+
+SHAPE = (2, 3) # (networks, electrodes)
+TIMEOUT = 5. # in s
+
+def example_matrix():
+    return Spike_matrix.from_cells([4, 1, 4], [0.25, 1., 2.], SHAPE)
+
+def test_chunk_round_trip():
+    chunk = decode_chunk(encode_chunk(7, 123_456, example_matrix()))
+    assert chunk['chunk_id'] == 7
+    assert chunk['pkg_id'] == 123_456
+    np.testing.assert_array_equal(chunk['spontaneous_spikes'].times, example_matrix().times)
+    np.testing.assert_array_equal(chunk['spontaneous_spikes'].offsets, example_matrix().offsets)
+
+def test_chunk_with_invalid_magic():
+    frame = bytearray(encode_chunk(7, 0, example_matrix()))
+    frame[:4] = b'XXXX'
+    with pytest.raises(ValueError):
+        decode_chunk(frame)
+    assert len(frame) == CHUNK_HEADER.size + len(example_matrix().to_bytes())
+
+def test_subscriber_drops_oldest_frame():
+    subscriber = Spike_stream_subscriber(None, 2)
+    assert subscriber.put(b'a')
+    assert subscriber.put(b'b')
+    assert not subscriber.put(b'c')
+    assert subscriber.dropped == 1
+    assert list(subscriber.queue) == [b'b', b'c']
+
+def test_stream_frames_chunks_over_tcp():
+    server = Spike_stream_server(port=0)
+    server.start()
+    try:
+        with Spike_stream(*server.server_socket.getsockname(), timeout=TIMEOUT) as stream:
+            t_end = time.perf_counter() + TIMEOUT
+            while not server.subscribers and time.perf_counter() < t_end:
+                time.sleep(1e-3)
+            for chunk_id in range(3):
+                assert server.publish(encode_chunk(chunk_id, 100*chunk_id, example_matrix())) == 0
+            chunks = [next(stream) for _ in range(3)]
+    finally:
+        server.close()
+
+    assert [chunk['chunk_id'] for chunk in chunks] == [0, 1, 2]
+    assert [chunk['pkg_id'] for chunk in chunks] == [0, 100, 200]
+    assert all(chunk['dropped'] == 0 for chunk in chunks)
+    np.testing.assert_array_equal(chunks[-1]['spontaneous_spikes'][1, 1], [0.25, 2.])
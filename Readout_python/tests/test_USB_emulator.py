@@ -0,0 +1,102 @@
+"""
+USB_transfer_engine against the emulated SoC of USB_emulator, without hardware.
+Every word carries its sequence number in bytes 4:8 (the execution package id of a command word), the SoC records the
+executed words and the tests check that every word was executed exactly once and in order.
+"""
+import time
+import threading
+import multiprocessing as mp
+
+import pytest
+
+from Client_config import USB_PREAMBLE, COMMAND_IDS, WORD_LENGTH_IN_BYTES
+from USB_communication import USB_com, USB_transfer_engine
+from USB_emulator import Emulated_SoC, Emulated_transport
+
+FRAME_WORDS = 4 # command words per frame on the send pipe
+TIMEOUT = 10. # in s, the old engine stalled for 1 s per lost transfer and did not finish in this time
+
+def command_frame(first_word, words=FRAME_WORDS):
+    frame = bytearray(WORD_LENGTH_IN_BYTES * words)
+    for i in range(words):
+        frame[i*WORD_LENGTH_IN_BYTES+4:i*WORD_LENGTH_IN_BYTES+8] = (first_word + i).to_bytes(4, byteorder='little')
+    return frame
+
+def word_number(word):
+    return int.from_bytes(word[4:8], byteorder='little')
+
+def start_engine(device, loss=0., delay=0., batch_words=1, window_words=8, seed=0):
+    """Run a USB_transfer_engine on an Emulated_transport in a daemon thread, returns the sending end of its pipe"""
+    recv_pkg_recv, recv_pkg_send = mp.Pipe(duplex=False)
+    send_pipe_recv, send_pipe_send = mp.Pipe(duplex=False)
+    com = USB_com(Emulated_transport(device, recv_pkg_send, delay, loss, seed))
+    engine = USB_transfer_engine(com, recv_pkg_recv, 100e-3, batch_words, window_words)
+    threading.Thread(target=engine.run, args=(send_pipe_recv, ), daemon=True).start()
+    return send_pipe_send
+
+def wait_for(condition, timeout=TIMEOUT):
+    t_end = time.perf_counter() + timeout
+    while not condition() and time.perf_counter() < t_end:
+        time.sleep(1e-3)
+    return condition()
+
+class Recorder:
+    """on_command of the Emulated_SoC, keeps the executed commands"""
+    def __init__(self):
+        self.commands = []
+
+    def __call__(self, command_id, word):
+        self.commands.append((command_id, word))
+
+    def words(self):
+        return [word_number(word) for command_id, word in self.commands if command_id == COMMAND_IDS['intan']]
+
+@pytest.mark.parametrize('loss, delay, batch_words, window_words', [
+    (0., 0., 1, 8),
+    (0.05, 1e-3, 1, 8),
+    (0.05, 1e-3, 1, 64),
+    (0.05, 1e-3, 16, 64),
+    (0.2, 0., 4, 16),
+])
+def test_words_executed_once_in_order(loss, delay, batch_words, window_words):
+    frames = 100
+    recorder = Recorder()
+    device = Emulated_SoC(recorder)
+    send_pipe = start_engine(device, loss, delay, batch_words, window_words)
+    for n in range(frames):
+        send_pipe.send((2, command_frame(n*FRAME_WORDS)))
+
+    assert wait_for(lambda: len(recorder.commands) >= frames*FRAME_WORDS), \
+        f"Executed {len(recorder.commands)} of {frames*FRAME_WORDS} words in {TIMEOUT} s, {device.stats()}"
+    time.sleep(.05)
+    assert recorder.words() == list(range(frames*FRAME_WORDS))
+
+def test_port_resets_receive_counter():
+    recorder = Recorder()
+    device = Emulated_SoC(recorder)
+    send_pipe = start_engine(device, loss=0.05, delay=1e-3)
+    for n in range(10):
+        send_pipe.send((2, command_frame(n*FRAME_WORDS)))
+    assert wait_for(lambda: len(recorder.words()) >= 10*FRAME_WORDS)
+
+    send_pipe.send((1, 0x1234))
+    for n in range(10, 20):
+        send_pipe.send((2, command_frame(n*FRAME_WORDS)))
+    assert wait_for(lambda: len(recorder.words()) >= 20*FRAME_WORDS), device.stats()
+    time.sleep(.05)
+
+    assert device.port == 0x1234
+    assert recorder.words() == list(range(20*FRAME_WORDS))
+    # the port is the first command after the reset, the 40 words after it follow with the receive ids 2 to 41
+    assert [command_id for command_id, word in recorder.commands].count(COMMAND_IDS['port']) == 1
+    assert device.recv_counter == 1 + 10*FRAME_WORDS
+
+def test_resent_word_is_rejected():
+    device = Emulated_SoC()
+    transfer = bytearray((USB_PREAMBLE | COMMAND_IDS['intan']).to_bytes(8, byteorder='big')) + command_frame(0, 1)
+    transfer[8] = 1 # receive id
+    transfer[9] = 0xFF # the receive id is checked
+    assert device.handle(transfer) == 1
+    assert device.handle(transfer) == 1
+    assert device.stats()['executed'] == 1
+    assert device.stats()['rejected'] == 1
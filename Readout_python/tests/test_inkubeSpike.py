@@ -0,0 +1,87 @@
+"""
+Pure functions of the compiled inkubeSpike module, built in place with setup_filter.py before the tests run.
+"""
+import numpy as np
+import pytest
+
+from Client_config import FS, MAX_PKG_ID
+from Spike_matrix import Spike_matrix, UNMAPPED_CELL
+from inkubeSpike import map_spikes, pkg_add, pkg_diff, pkg_reached, segment_position, Segment_schedule
+
+SHAPE = (2, 4) # (networks, electrodes)
+CHANNEL_CELLS = np.array([0, 5, 7, UNMAPPED_CELL], dtype=np.uint16) # receive channel 3 is not part of a network
+PKG_IN_MS = np.float32(1e3/FS)
+
+def spikes(channels, pkgs):
+    return np.array(channels, dtype=np.uint8), np.array(pkgs, dtype=np.uint32)
+
+def test_map_spikes_sorts_by_cell():
+    channels, pkgs = spikes([2, 0, 1, 2], [110, 120, 130, 140])
+    spike_mat = map_spikes(channels, pkgs, 100, CHANNEL_CELLS, SHAPE)
+    np.testing.assert_array_equal(spike_mat.offsets, [0, 1, 1, 1, 1, 1, 2, 2, 4])
+    np.testing.assert_allclose(spike_mat[0, 0], [20*PKG_IN_MS])
+    np.testing.assert_allclose(spike_mat[1, 1], [30*PKG_IN_MS])
+    np.testing.assert_allclose(spike_mat[1, 3], [10*PKG_IN_MS, 40*PKG_IN_MS])
+
+def test_map_spikes_across_the_package_wrap():
+    start_id = MAX_PKG_ID - 10
+    channels, pkgs = spikes([0, 0, 0], [MAX_PKG_ID - 5, 0, 20])
+    spike_mat = map_spikes(channels, pkgs, start_id, CHANNEL_CELLS, SHAPE)
+    np.testing.assert_allclose(spike_mat[0, 0], np.array([5, 10, 30], dtype=np.float32)*PKG_IN_MS)
+
+def test_map_spikes_package_times_of_spontaneous_chunks():
+    channels, pkgs = spikes([0, 1], [MAX_PKG_ID - 5, 3])
+    spike_mat = map_spikes(channels, pkgs, 0, CHANNEL_CELLS, SHAPE, True)
+    np.testing.assert_allclose(spike_mat[0, 0], [np.float32(MAX_PKG_ID - 5)*PKG_IN_MS])
+    np.testing.assert_allclose(spike_mat[1, 1], [3*PKG_IN_MS])
+
+def test_map_spikes_drops_unmapped_channels():
+    # channel 3 is UNMAPPED_CELL and channel 200 has no entry in the channel cells
+    channels, pkgs = spikes([3, 0, 200, 3], [101, 102, 103, 104])
+    spike_mat = map_spikes(channels, pkgs, 100, CHANNEL_CELLS, SHAPE)
+    assert spike_mat.times.shape[0] == 1
+    np.testing.assert_array_equal(spike_mat.index, [0])
+    np.testing.assert_allclose(spike_mat[0, 0], [2*PKG_IN_MS])
+
+def test_from_spikes_drops_unmapped_channels():
+    map_matrix = np.array([[0, 0], [1, 1], [1, 3], [-1, -1]])
+    spike_mat = Spike_matrix.from_spikes([3, 0, 200, 2], [101, 102, 103, 104], 100, map_matrix, SHAPE, PKG_IN_MS)
+    np.testing.assert_array_equal(spike_mat.index, [0, 7])
+    np.testing.assert_allclose(spike_mat.times, np.array([2, 4], dtype=np.float32)*PKG_IN_MS)
+
+def test_pkg_diff_across_the_wrap():
+    assert pkg_diff(5, MAX_PKG_ID - 5) == 10
+    assert pkg_diff(MAX_PKG_ID - 5, 5) == -10
+    assert pkg_add(MAX_PKG_ID - 5, 10) == 5
+    assert pkg_add(5, -10) == MAX_PKG_ID - 5
+    assert pkg_reached(5, MAX_PKG_ID - 5)
+    assert not pkg_reached(MAX_PKG_ID - 5, 5)
+
+def test_segment_position_across_the_wrap():
+    start, end = MAX_PKG_ID - 10, 10
+    assert segment_position(MAX_PKG_ID - 20, start, end) == -1
+    assert segment_position(MAX_PKG_ID - 1, start, end) == 0
+    assert segment_position(10, start, end) == 0
+    assert segment_position(11, start, end) == 1
+
+def test_segment_schedule_across_the_wrap():
+    schedule = Segment_schedule(MAX_PKG_ID - 10, 100, 20)
+    assert (schedule.start, schedule.end, schedule.next_start) == (MAX_PKG_ID - 10, 10, 90)
+    assert schedule.position(5) == 0
+    assert schedule.position(11) == 1
+    schedule.advance()
+    assert (schedule.start, schedule.end) == (90, 110)
+
+def test_segment_schedule_skips_unreachable_segments():
+    schedule = Segment_schedule(MAX_PKG_ID - 10, 100, 20)
+    # the start of the first segment is 40 packages away, 50 are needed before it
+    assert schedule.skip_to(MAX_PKG_ID - 50, 50) == 1
+    assert schedule.start == 90
+    assert schedule.skip_to(0, 50) == 0
+    # at package 400 the first start at least 50 packages ahead is 490, 4 segments after 90
+    assert schedule.skip_to(400, 50) == 4
+    assert schedule.start == 490
+
+def test_segment_schedule_rejects_a_cycle_past_half_the_counter():
+    with pytest.raises(ValueError):
+        Segment_schedule(0, MAX_PKG_ID // 2, 0)
@@ -0,0 +1,75 @@
+"""
+Stimulation programs and the closed loop period queue of onsite_Stimulation_processor, without readout or hardware.
+"""
+import threading
+import multiprocessing as mp
+
+import numpy as np
+import pytest
+
+from Client_config import FS
+from onsite_Stimulation_processor import Stim_period_queue, Stim_program_cache, Stim_timing
+
+STIM_MATRIX = np.array([[20, 0, 1], [10, 2, 3]]) # rows of (delay, network, electrode)
+
+def test_receiver_leaves_stim_pipe_when_stim_event_cleared():
+    stim_pipe_server, stim_pipe_client = mp.Pipe()
+    stim_event = threading.Event()
+    stim_event.set()
+    period_queue = Stim_period_queue(Stim_program_cache())
+    period_queue.set_next(1, 1000, 100)
+    period_queue.start(stim_pipe_server, stim_event)
+
+    stim_pipe_client.send((1, STIM_MATRIX))
+    assert period_queue.wait_answer(1.)
+    stim_event.clear()
+    period_queue.stop()
+    assert not period_queue.receiver.is_alive()
+    assert period_queue.take(1, 1000) == (None, ())
+
+    # the stimuli sent after the closed loop stopped are left for blind_send
+    stim_pipe_client.send((2, STIM_MATRIX))
+    assert stim_pipe_server.poll(1.)
+    stim_id, stim_matrix = stim_pipe_server.recv()
+    assert stim_id == 2
+    np.testing.assert_array_equal(stim_matrix, STIM_MATRIX)
+
+def test_stim_timing_in_packages():
+    stim_timing = Stim_timing()
+    version = stim_timing.version()
+    timing = stim_timing.set_ms({'cycle': 100, 'min_delay': 20, 'profile': 5})
+    assert timing['cycle'] == round(100e-3*FS)
+    assert timing['min_delay'] == round(20e-3*FS)
+    assert timing['profile'] == 1
+    assert stim_timing.version() == version + 1
+    assert stim_timing.read()['cycle'] == timing['cycle']
+
+@pytest.mark.parametrize('timing_ms', [
+    {'period': 100}, # unknown key
+    {'cycle': 0},
+    {'cycle': -10},
+    {'cycle': 1e6}, # past half of the package counter
+    {'cycle': 50, 'response_period': 30, 'min_delay': 20}, # no time left to send the stimulus
+])
+def test_stim_timing_rejects_invalid_values(timing_ms):
+    stim_timing = Stim_timing()
+    before = stim_timing.read()
+    with pytest.raises(ValueError):
+        stim_timing.set_ms(timing_ms)
+    assert stim_timing.read() == before
+
+def test_stim_program_cache_evicts_least_recently_used():
+    stim_programs = Stim_program_cache(cache_len=2)
+    stim_programs.register('registered', STIM_MATRIX)
+    matrices = [STIM_MATRIX + [[delay, 0, 0]] for delay in (1, 2, 3)]
+    first = stim_programs.get(matrices[0])
+    stim_programs.get(matrices[1])
+    assert stim_programs.get(matrices[0]) is first # a hit moves it to the end
+    stim_programs.get(matrices[2]) # evicts matrices[1]
+    assert stim_programs.get(matrices[0]) is first
+    assert stim_programs.stats() == {'hits': 2, 'misses': 3, 'cached': 2, 'registered': 1}
+    stim_programs.get(matrices[1])
+    assert stim_programs.stats()['misses'] == 4
+    # registered programs do not take part in the eviction
+    assert stim_programs.get('registered') is stim_programs.registered['registered']
+    assert stim_programs.get(np.zeros((0, 3))) is None